@@ -42,7 +42,7 @@ class AffineCoupling(nn.Module):
         # version 1, srflow (use FCN)
         scale = torch.sigmoid(scale + 2.) + 1e-4
         z2 = (z2 + shift) * scale
-        logdet += thops.sum(torch.log(scale), dim=[1, 2])
+        logdet += thops.sum(torch.log(scale.float()), dim=[1, 2])
         
         z = thops.cat_feature(z1, z2)
 
@@ -58,7 +58,7 @@ class AffineCoupling(nn.Module):
         scale = torch.sigmoid(scale + 2.) + 1e-4
         z2 = (z2 / scale) -shift
         
-        logdet -= thops.sum(torch.log(scale), dim=[1, 2])
+        logdet -= thops.sum(torch.log(scale.float()), dim=[1, 2])
 
         z = thops.cat_feature(z1, z2)
 
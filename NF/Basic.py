@@ -92,7 +92,10 @@ class GaussianDiag:
 
     @staticmethod
     def logp(mean, logs, x):
-        likelihood = GaussianDiag.likelihood(mean, logs, x)
+        # evaluated in fp32 under autocast, it is accumulated into the log-determinant
+        if mean is not None and logs is not None:
+            mean, logs = mean.float(), logs.float()
+        likelihood = GaussianDiag.likelihood(mean, logs, x.float())
         if len(x.shape) == 2:
             return thops.sum(likelihood, dim=[1])
         elif len(x.shape) == 3:
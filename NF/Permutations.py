@@ -70,7 +70,9 @@ class InvertibleConv1x1(nn.Module): # 3D version
         """
         log-det = log|abs(|W|)| * pixels
         """
-        weight, dlogdet = self.get_weight(input, reverse)
+        # slogdet and inverse stay in fp32 under autocast
+        with torch.autocast(input.device.type, enabled=False):
+            weight, dlogdet = self.get_weight(input, reverse)
         if not reverse:
             z = F.conv1d(input, weight) # fc layer, ie, permute channel
             if logdet is not None:
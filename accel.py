@@ -0,0 +1,108 @@
+# Faster execution paths for the Generator
+
+import copy
+import warnings
+
+import torch
+import torch.nn as nn
+
+import pdb
+
+COMPILE_MODES = ("none", "compile", "trace")
+PRECISIONS = ("fp32", "int8", "bf16", "int8+bf16")
+
+def compile_model(model, mode="none", example_input=None):
+    """
+    Wrap a model with torch.compile or TorchScript tracing, falling back to eager.
+
+    The returned callable shares its parameters with model, so checkpoints are
+    still saved from and loaded into the eager model.
+
+    Args:
+    model (nn.Module): model to accelerate.
+    mode (str): "none", "compile" (torch.compile) or "trace" (torch.jit.trace).
+    example_input (Tensor): input used to trace, and to trigger compilation
+        early so that failures fall back to eager here rather than mid-run.
+
+    Returns:
+    callable: the compiled model, or model itself if compilation is unavailable.
+    """
+    if mode == "none":
+        return model
+    if mode not in COMPILE_MODES:
+        raise ValueError("unknown compile mode {}, expected one of {}".format(mode, COMPILE_MODES))
+
+    try:
+        if mode == "compile":
+            if not hasattr(torch, "compile"):
+                raise RuntimeError("torch.compile needs torch >= 2.0")
+            compiled = torch.compile(model)
+            if example_input is not None:
+                compiled(example_input)
+        else:
+            if example_input is None:
+                raise RuntimeError("tracing needs an example input")
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                compiled = torch.jit.trace(model, example_input, check_trace=False)
+    except Exception as e:
+        print("=> {} unavailable ({}: {}), running eager".format(mode, type(e).__name__, e))
+        return model
+
+    print("=> using {} model".format(mode))
+    return compiled
+
+AMP_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+class AutocastFeatures(nn.Module):
+    """
+    Runs the Generator's MLP and conv stack under autocast.
+
+    The evidential head (softplus/tanh and the +1 on alpha) stays in fp32, so
+    that alpha - 1 and v keep their precision in the uncertainty estimates and
+    the losses computed from them. The wrapper shares the parameters of model,
+    so it can be trained and checkpointed through model.
+    """
+    def __init__(self, model, device_type="cpu", dtype=torch.bfloat16):
+        super(AutocastFeatures, self).__init__()
+        self.model = model
+        self.device_type = device_type
+        self.dtype = dtype
+
+    def forward(self, sp):
+        with torch.autocast(self.device_type, dtype=self.dtype):
+            x = self.model.features(sp)
+        return self.model.head(x.float())
+
+def reduce_precision(model, precision="fp32"):
+    """
+    Forward-only copy of a model at reduced precision.
+
+    "int8" applies dynamic int8 quantization to the Linear layers (the
+    sparams_subnet MLP), "bf16" runs the MLP and conv stack under bf16
+    autocast, and "int8+bf16" combines both. The returned model is
+    for inference only and does not share parameters with model.
+
+    Args:
+    model (nn.Module): fp32 model.
+    precision (str): one of PRECISIONS.
+
+    Returns:
+    nn.Module: the reduced-precision model, or model itself for "fp32".
+    """
+    if precision == "fp32":
+        return model
+    if precision not in PRECISIONS:
+        raise ValueError("unknown precision {}, expected one of {}".format(precision, PRECISIONS))
+
+    device_type = next(model.parameters()).device.type
+    if "int8" in precision:
+        if device_type != "cpu":
+            raise ValueError("int8 dynamic quantization runs on CPU only")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            model = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+    if "bf16" in precision:
+        model = AutocastFeatures(model, device_type)
+    print("=> using {} inference".format(precision))
+    return model
@@ -0,0 +1,107 @@
+# Gradient-based acquisition optimization
+
+import torch
+
+import pdb
+
+def epistemic_std(evidential_output):
+    """
+    Epistemic standard deviation sqrt(beta / (v * (alpha - 1))) of the NIG output.
+
+    Args:
+    evidential_output (Tensor): Generator output of shape (B, 4, L).
+
+    Returns:
+    Tensor: the epistemic standard deviation of shape (B, L).
+    """
+    gamma, v, alpha, beta = torch.chunk(evidential_output, 4, dim=1)
+    return torch.sqrt(beta / (v * (alpha - 1 + 1e-6)))[:, 0]
+
+def min_distances(inputs, points, chunk_size=4096, offset=None):
+    """
+    Distance from every row of inputs to its nearest row of points.
+
+    Args:
+    inputs (Tensor): query points of shape (N, D).
+    points (Tensor): reference points of shape (M, D).
+    chunk_size (int): number of reference points compared at once.
+    offset (int): inputs[i] is points[offset + i] and is not its own neighbour (default: none).
+
+    Returns:
+    Tensor: the nearest-neighbour distances of shape (N,).
+    """
+    distances = torch.full((inputs.shape[0],), float('inf'), dtype=inputs.dtype, device=inputs.device)
+    for start in range(0, points.shape[0], chunk_size):
+        new_distances = torch.cdist(inputs, points[start:start + chunk_size])
+        if offset is not None:
+            rows = torch.arange(inputs.shape[0], device=inputs.device).unsqueeze(1) + offset
+            cols = torch.arange(start, start + new_distances.shape[1], device=inputs.device).unsqueeze(0)
+            new_distances = new_distances.masked_fill(rows == cols, float('inf'))
+        distances = torch.min(distances, new_distances.min(dim=1)[0])
+    return distances
+
+def acquisition_scores(g_model, inputs, train_params, lam):
+    """
+    Acquisition lam * mean epistemic std + distance to the training set, per input.
+    """
+    var = epistemic_std(g_model(inputs))
+    return lam * var.mean(1) + min_distances(inputs, train_params)
+
+def optimize_acquisition(g_model, seeds, train_params, lam, steps=100, lr=1e-2,
+                         repulsion=1.0, chunk_size=None, log_every=0):
+    """
+    Refine a batch of seeds with projected gradient ascent on the acquisition.
+
+    Every seed climbs lam * mean epistemic std + distance to the training set,
+    plus repulsion times the distance to its nearest other seed so that the
+    batch does not collapse onto the same maximum. After each step the seeds
+    are projected back into [-1, 1]^dsp.
+
+    Args:
+    g_model (nn.Module): trained evidential Generator (weights are kept fixed).
+    seeds (Tensor): initial parameters of shape (N, dsp).
+    train_params (Tensor): training parameters of shape (M, dsp).
+    lam (float): coefficient balancing uncertainty and proximity.
+    steps (int): number of ascent steps.
+    lr (float): Adam step size.
+    repulsion (float): weight of the nearest-seed distance term.
+    chunk_size (int): seeds forwarded at once, None for the whole batch.
+    log_every (int): print the mean acquisition every given number of steps.
+
+    Returns:
+    Tensor: the optimized parameters of shape (N, dsp).
+    """
+    requires_grad = [p.requires_grad for p in g_model.parameters()]
+    for p in g_model.parameters():
+        p.requires_grad_(False)
+
+    inputs = seeds.detach().clone().clamp_(-1., 1.).requires_grad_(True)
+    optimizer = torch.optim.Adam([inputs], lr=lr)
+    chunk_size = chunk_size or inputs.shape[0]
+
+    for step in range(steps):
+        optimizer.zero_grad()
+        # the other seeds are held fixed within a step, so the objective
+        # separates over chunks and the gradients can be accumulated
+        anchors = inputs.detach()
+        total = 0.
+        for start in range(0, inputs.shape[0], chunk_size):
+            sub_inputs = inputs[start:start + chunk_size]
+            score = acquisition_scores(g_model, sub_inputs, train_params, lam)
+            if repulsion > 0 and inputs.shape[0] > 1:
+                score = score + repulsion * min_distances(sub_inputs, anchors, offset=start)
+            (-score.sum()).backward()
+            total += score.sum().item()
+        optimizer.step()
+
+        # project back into the parameter box
+        with torch.no_grad():
+            inputs.clamp_(-1., 1.)
+
+        if log_every and (step + 1) % log_every == 0:
+            print("====> Step: {} Average acquisition: {:.6f}".format(step + 1, total / inputs.shape[0]))
+
+    for p, flag in zip(g_model.parameters(), requires_grad):
+        p.requires_grad_(flag)
+
+    return inputs.detach()
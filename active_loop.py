@@ -0,0 +1,296 @@
+# Active learning orchestrator: select -> simulate -> ingest -> retrain
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import shlex
+import time
+import shutil
+import asyncio
+import argparse
+
+import numpy as np
+
+from yeast import read_data_from_file, active_set_indices, ACTIVE_ROOT
+
+import pdb
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Active Learning Orchestrator")
+
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed of selection and training (default: 0)")
+    parser.add_argument("--resume", type=str, required=True,
+                        help="checkpoint of the surrogate used by the first round")
+    parser.add_argument("--rounds", type=int, default=1,
+                        help="number of active learning rounds (default: 1)")
+    parser.add_argument("--lam", type=float, default=25.0,
+                        help="active learning lambda parameter (default: 25)")
+    parser.add_argument("--run-root", type=str, default=ACTIVE_ROOT,
+                        help="directory holding the run_lambda* folders")
+
+    parser.add_argument("--dsp", type=int, default=28,
+                        help="dimensions of the simulation parameters (default: 28)")
+    parser.add_argument("--dspe", type=int, default=512,
+                        help="dimensions of the simulation parameters' encode (default: 512)")
+    parser.add_argument("--ch", type=int, default=4,
+                        help="channel multiplier (default: 4)")
+
+    parser.add_argument("--n-candidates", type=int, default=480000,
+                        help="number of candidates run for selection")
+    parser.add_argument("--k", type=int, default=2400,
+                        help="number of selected samples per round")
+    parser.add_argument("--set-size", type=int, default=100,
+                        help="parameters per simulation set (default: 100)")
+    parser.add_argument("--select-args", type=str, default="",
+                        help="extra arguments passed to select_param.py")
+
+    parser.add_argument("--backend", type=str, default="subprocess",
+                        help="simulator backend: subprocess or surrogate (default: subprocess)")
+    parser.add_argument("--sim-command", type=str, default="",
+                        help="shell command running the simulator in a set folder, {set_dir} is substituted")
+    parser.add_argument("--surrogate", type=str, default="",
+                        help="checkpoint answering the surrogate backend (default: --resume)")
+    parser.add_argument("--dmin", type=float, default=None,
+                        help="minimum of C42a_dat for the surrogate backend (default: from the dataset)")
+    parser.add_argument("--dmax", type=float, default=None,
+                        help="maximum of C42a_dat for the surrogate backend (default: from the dataset)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="simulation sets run concurrently (default: 4)")
+
+    parser.add_argument("--epochs", type=int, default=750,
+                        help="training epochs per round (default: 750)")
+    parser.add_argument("--train-args", type=str, default="--lr 5e-4 --log-every 10",
+                        help="extra arguments passed to train.py")
+
+    return parser.parse_args()
+
+def write_atomic(path, write):
+    # write through a temporary file so readers never see a partial file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as file:
+        write(file)
+    os.replace(tmp_path, path)
+
+def simulation_done(set_dir):
+    return all(os.path.exists(os.path.join(set_dir, name)) for name in ("C42a_dat", "PF_C42a_set_of_100"))
+
+class SubprocessSimulator:
+    """
+    Runs the simulator as a local subprocess inside each set folder.
+    """
+    def __init__(self, command):
+        if not command:
+            raise ValueError("the subprocess backend needs --sim-command")
+        self.command = command
+
+    async def run(self, set_dir):
+        proc = await asyncio.create_subprocess_shell(self.command.format(set_dir=set_dir), cwd=set_dir)
+        returncode = await proc.wait()
+        if returncode != 0:
+            raise RuntimeError("simulator exited with code {} in {}".format(returncode, set_dir))
+        if not simulation_done(set_dir):
+            raise RuntimeError("simulator left no C42a_dat/PF_C42a_set_of_100 in {}".format(set_dir))
+
+class SurrogateSimulator:
+    """
+    Stand-in simulator answering each set with the Generator mean, for testing the loop.
+    """
+    def __init__(self, checkpoint, dsp, dspe, ch, dmin=None, dmax=None):
+        import torch
+        from generator import Generator
+        from yeast import ReadYeastDataset
+
+        self.torch = torch
+        self.g_model = Generator(dsp, dspe, ch, 4, dropout=False)
+        self.g_model.load_state_dict(torch.load(checkpoint, map_location="cpu")["g_model_state_dict"])
+        self.g_model.eval()
+        if dmin is None or dmax is None:
+            _, _, _, dmin, dmax = ReadYeastDataset(active=False)
+        self.dmin, self.dmax = dmin, dmax
+
+    async def run(self, set_dir):
+        await asyncio.to_thread(self.simulate, set_dir)
+
+    def simulate(self, set_dir):
+        params = read_data_from_file(os.path.join(set_dir, "list_of_parameters"))
+        params_slice = self.torch.from_numpy(params[:, np.r_[0:25, 32:35]]).float()
+        with self.torch.no_grad():
+            gamma = self.g_model(params_slice)[:, 0].numpy()
+        C42a_dat = ((gamma + 1) * (self.dmax - self.dmin) / 2) + self.dmin
+
+        write_atomic(os.path.join(set_dir, "C42a_dat"),
+                     lambda file: np.savetxt(file, C42a_dat, fmt="%.6f", delimiter='\t'))
+        write_atomic(os.path.join(set_dir, "PF_C42a_set_of_100"),
+                     lambda file: np.savetxt(file, np.zeros((params.shape[0], 1)), fmt="%.6f", delimiter='\t'))
+
+class ActiveLearningLoop:
+    """
+    Drives rounds of select -> simulate -> ingest -> retrain for one lambda.
+
+    The progress is checkpointed to run_lambda*/orchestrator_state.json after
+    every step, so a killed round resumes where it stopped: finished sets are
+    not simulated again and a finished selection is not redone.
+    """
+    def __init__(self, args, simulator):
+        self.args = args
+        self.simulator = simulator
+        self.run_dir = os.path.join(args.run_root, "run_lambda" + str(int(args.lam)))
+        self.state_path = os.path.join(self.run_dir, "orchestrator_state.json")
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.state = self.load_state()
+
+    def load_state(self):
+        if os.path.isfile(self.state_path):
+            with open(self.state_path) as file:
+                state = json.load(file)
+            print("=> resuming round {} at stage {}".format(state["round"], state["stage"]))
+            return state
+        return {"round": 0, "stage": "select", "checkpoint": self.args.resume, "sets": {}, "history": []}
+
+    def save_state(self):
+        write_atomic(self.state_path, lambda file: json.dump(self.state, file, indent=2))
+
+    async def run(self):
+        while self.state["round"] < self.args.rounds:
+            print("=> active learning round {}".format(self.state["round"]))
+            if self.state["stage"] == "select":
+                await self.select()
+            if self.state["stage"] == "simulate":
+                await self.simulate()
+            if self.state["stage"] == "retrain":
+                await self.retrain()
+
+    async def run_script(self, script, script_args):
+        cmd = [sys.executable, "-u", script] + script_args
+        print("=> running {}".format(" ".join(cmd)))
+        proc = await asyncio.create_subprocess_exec(*cmd, cwd=REPO_DIR)
+        returncode = await proc.wait()
+        if returncode != 0:
+            raise RuntimeError("{} exited with code {}".format(script, returncode))
+
+    async def select(self):
+        args = self.args
+        await self.run_script("select_param.py", [
+            "--seed", str(args.seed + self.state["round"]), "--dsp", str(args.dsp),
+            "--dspe", str(args.dspe), "--ch", str(args.ch),
+            "--n-candidates", str(args.n_candidates), "--k", str(args.k),
+            "--resume", self.state["checkpoint"], "--lam", str(args.lam),
+            "--active", "--run-root", args.run_root] + shlex.split(args.select_args))
+
+        # pre-screening may leave fewer than k parameter sets to simulate
+        selected = read_data_from_file(os.path.join(self.run_dir, "list_of_parameters"))
+
+        # the set folders of this round are fixed before any of them is written
+        if not self.state["sets"]:
+            first = max(active_set_indices(self.run_dir), default=0) + 1
+            n_sets = (selected.shape[0] - 1) // args.set_size + 1 if selected.shape[0] else 0
+            self.state["sets"] = {str(i): "pending" for i in range(first, first + n_sets)}
+            self.save_state()
+
+        for j, i in enumerate(sorted(self.state["sets"], key=int)):
+            set_dir = os.path.join(self.run_dir, "set" + i)
+            os.makedirs(set_dir, exist_ok=True)
+            chunk = selected[j * args.set_size:(j + 1) * args.set_size]
+            write_atomic(os.path.join(set_dir, "list_of_parameters"),
+                         lambda file: np.savetxt(file, chunk, fmt="%.6f", delimiter='\t'))
+
+        self.state["stage"] = "simulate"
+        self.save_state()
+
+    async def simulate(self):
+        semaphore = asyncio.Semaphore(self.args.workers)
+
+        async def simulate_set(i):
+            set_dir = os.path.join(self.run_dir, "set" + i)
+            if self.state["sets"][i] == "ingested":
+                return
+            if not simulation_done(set_dir):
+                async with semaphore:
+                    print("=> simulating set{}".format(i))
+                    await self.simulator.run(set_dir)
+            self.state["sets"][i] = "simulated"
+            self.save_state()
+
+            # ingest as soon as the set is finished, while others still run
+            await asyncio.to_thread(self.ingest, set_dir)
+            self.state["sets"][i] = "ingested"
+            self.save_state()
+            print("=> ingested set{}".format(i))
+
+        results = await asyncio.gather(*(simulate_set(i) for i in sorted(self.state["sets"], key=int)),
+                                       return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            for error in errors:
+                print("=> {}".format(error))
+            raise RuntimeError("{} simulation sets failed, rerun to resume".format(len(errors)))
+
+        self.state["stage"] = "retrain"
+        self.save_state()
+
+    def ingest(self, set_dir):
+        params = read_data_from_file(os.path.join(set_dir, "list_of_parameters"))
+        C42a_dat = read_data_from_file(os.path.join(set_dir, "C42a_dat"))
+        PF_C42a = read_data_from_file(os.path.join(set_dir, "PF_C42a_set_of_100"))
+        if not (params.shape[0] == C42a_dat.shape[0] == PF_C42a.shape[0]):
+            raise ValueError("{}: {} parameters, {} C42a_dat rows and {} PF_C42a rows".format(
+                set_dir, params.shape[0], C42a_dat.shape[0], PF_C42a.shape[0]))
+        if not np.isfinite(C42a_dat).all():
+            raise ValueError("{}: C42a_dat contains non-finite values".format(set_dir))
+
+    async def retrain(self):
+        import checkpoint as ckpt
+
+        args = self.args
+        started = time.time()
+        await self.run_script("train.py", [
+            "--seed", str(args.seed), "--dsp", str(args.dsp), "--dspe", str(args.dspe),
+            "--ch", str(args.ch), "--loss", "Evidential", "--active", "--lam", str(args.lam),
+            "--run-root", args.run_root, "--epochs", str(args.epochs),
+            "--check-every", str(args.epochs)] + shlex.split(args.train_args))
+
+        # keep a copy per round, the next retrain overwrites the same file name
+        network_str = "model_Evidential_seed" + str(args.seed) + "_active" + str(int(args.lam))
+        # the last epoch this round wrote, earlier than --epochs when --patience stops the run; files of
+        # previous rounds share the run's name, so older ones are ignored
+        models_dir = os.path.join(REPO_DIR, "models")
+        written = [(epoch, path) for epoch, paths in ckpt.periodic_checkpoints(models_dir, network_str).items() for path in paths
+                   if path.endswith(".pth.tar") and os.path.getmtime(path) >= started]
+        if not written:
+            raise RuntimeError("train.py wrote no {}_*.pth.tar checkpoint to {} in this round".format(network_str, models_dir))
+        _, checkpoint = max(written)
+        os.makedirs(os.path.join(self.run_dir, "checkpoints"), exist_ok=True)
+        round_checkpoint = os.path.join(self.run_dir, "checkpoints", "round{}.pth.tar".format(self.state["round"]))
+        shutil.copyfile(checkpoint, round_checkpoint)
+
+        self.state["history"].append({"round": self.state["round"], "sets": sorted(self.state["sets"], key=int),
+                                      "checkpoint": round_checkpoint})
+        self.state["checkpoint"] = round_checkpoint
+        self.state["round"] += 1
+        self.state["stage"] = "select"
+        self.state["sets"] = {}
+        self.save_state()
+
+# the main function
+def main(args):
+    # log hyperparameters
+    print(args)
+
+    if args.backend == "subprocess":
+        simulator = SubprocessSimulator(args.sim_command)
+    elif args.backend == "surrogate":
+        simulator = SurrogateSimulator(args.surrogate or args.resume, args.dsp, args.dspe, args.ch,
+                                       args.dmin, args.dmax)
+    else:
+        raise ValueError("unknown simulator backend {}".format(args.backend))
+
+    asyncio.run(ActiveLearningLoop(args, simulator).run())
+
+if __name__ == "__main__":
+    main(parse_args())
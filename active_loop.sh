@@ -0,0 +1,7 @@
+#!bin/sh
+#PBS -N yeast_active_loop_lambda25
+#PBS -l walltime=12:00:00
+#PBS -l nodes=1:ppn=8:gpus=1
+
+python -u active_loop.py --seed 0 --dsp 28 --rounds 2 --lam 25 --resume models/model_Evidential_600.pth.tar --backend subprocess --sim-command "sh run_simulation.sh {set_dir}" --workers 8
+# python -u active_loop.py --seed 0 --dsp 28 --rounds 1 --lam 25 --resume models/model_Evidential_600.pth.tar --backend surrogate --run-root /tmp/active_test --n-candidates 10000 --epochs 10
@@ -0,0 +1,126 @@
+# convergence and throughput of mixed precision against fp32 training on synthetic data
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import math
+import time
+import argparse
+
+import numpy as np
+
+import torch
+import torch.optim as optim
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generator import Generator
+from NF.FlowNet_surrogate import ParamFlowNetCond
+import loss_helper
+import accel
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mixed Precision Convergence Benchmark")
+
+    parser.add_argument("--amp", type=str, nargs='+', default=["none", "bf16"],
+                        help="precisions to compare (default: none bf16)")
+    parser.add_argument("--models", type=str, nargs='+', default=["Evidential", "NF"],
+                        help="models to train (default: Evidential NF)")
+    parser.add_argument("--steps", type=int, default=300,
+                        help="training steps per run (default: 300)")
+    parser.add_argument("--batch-size", type=int, default=32,
+                        help="batch size (default: 32)")
+    parser.add_argument("--n-train", type=int, default=2048,
+                        help="synthetic training rows (default: 2048)")
+    parser.add_argument("--log-every", type=int, default=50,
+                        help="report the test loss every given number of steps (default: 50)")
+
+    return parser.parse_args()
+
+def synthetic_data(n, seed=0):
+    # smooth ring profiles in [-1, 1] driven by the first parameters
+    rng = np.random.RandomState(seed)
+    params = rng.rand(n, 28) * 2 - 1
+    angles = np.linspace(0, 2 * np.pi, 400, endpoint=False)
+    data = np.tanh(params[:, :1] + params[:, 1:2] * np.sin(angles)[None] + params[:, 2:3] * np.cos(2 * angles)[None])
+    data = data + 0.02 * rng.randn(n, 400)
+    return torch.from_numpy(params).float(), torch.from_numpy(np.clip(data, -1, 1)).float()
+
+def train_evidential(amp, params, data, test_params, test_data, args):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    g_model = Generator(28, 512, 4, 4)
+    g_forward = g_model if amp == "none" else accel.AutocastFeatures(g_model, "cpu", accel.AMP_DTYPES[amp])
+    g_optimizer = optim.Adam(g_model.parameters(), lr=5e-4)
+    scaler = torch.amp.GradScaler("cpu", enabled=amp == "fp16")
+
+    def step(idx):
+        g_optimizer.zero_grad()
+        loss = loss_helper.EvidentialRegression(data[idx].unsqueeze(1), g_forward(params[idx]), coeff=1e-2)
+        scaler.scale(loss).backward()
+        scaler.step(g_optimizer)
+        scaler.update()
+
+    def test_loss():
+        with torch.no_grad():
+            return loss_helper.EvidentialRegression(test_data.unsqueeze(1), g_model(test_params), coeff=1e-2).item()
+
+    return step, test_loss
+
+def train_nf(amp, params, data, test_params, test_data, args):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    g_model = ParamFlowNetCond(C=1, K=3, K_cond=3)
+    g_optimizer = optim.Adam(g_model.parameters(), lr=1e-4)
+    scaler = torch.amp.GradScaler("cpu", enabled=amp == "fp16")
+    amp_dtype = accel.AMP_DTYPES.get(amp, torch.float32)
+
+    def step(idx):
+        g_optimizer.zero_grad()
+        with torch.autocast("cpu", dtype=amp_dtype, enabled=amp != "none"):
+            _, _, logdet, _, _ = g_model(data[idx].unsqueeze(1), params[idx])
+        loss = (-logdet / (math.log(2) * data.shape[1])).mean()
+        scaler.scale(loss).backward()
+        scaler.step(g_optimizer)
+        scaler.update()
+
+    def test_loss():
+        with torch.no_grad():
+            _, _, logdet, _, _ = g_model(test_data.unsqueeze(1), test_params)
+        return (-logdet / (math.log(2) * test_data.shape[1])).mean().item()
+
+    return step, test_loss
+
+# the main function
+def main(args):
+    print(args)
+    params, data = synthetic_data(args.n_train)
+    test_params, test_data = synthetic_data(256, seed=1)
+    builders = {"Evidential": train_evidential, "NF": train_nf}
+
+    for model in args.models:
+        curves, rates = {}, {}
+        for amp in args.amp:
+            step, test_loss = builders[model](amp, params, data, test_params, test_data, args)
+            torch.manual_seed(1)
+            curve, elapsed = [], 0.
+            for i in range(args.steps):
+                idx = torch.randint(0, params.shape[0], (args.batch_size,))
+                start = time.perf_counter()
+                step(idx)
+                elapsed += time.perf_counter() - start
+                if (i + 1) % args.log_every == 0:
+                    curve.append(test_loss())
+            curves[amp], rates[amp] = curve, args.steps / elapsed
+
+        print("=> {}: test loss every {} steps".format(model, args.log_every))
+        print("{:>6} {:>10} ".format("amp", "steps/s") + " ".join("{:>9d}".format((i + 1) * args.log_every) for i in range(len(curves[args.amp[0]]))))
+        for amp in args.amp:
+            print("{:>6} {:>10.1f} ".format(amp, rates[amp]) + " ".join("{:>9.4f}".format(x) for x in curves[amp]))
+
+if __name__ == "__main__":
+    main(parse_args())
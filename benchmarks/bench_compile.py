@@ -0,0 +1,84 @@
+# benchmark of eager vs compiled Generator training and inference on CPU
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.optim as optim
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generator import Generator
+import loss_helper
+import accel
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compiled Generator Benchmark")
+
+    parser.add_argument("--modes", type=str, nargs='+', default=list(accel.COMPILE_MODES),
+                        help="execution modes to benchmark")
+    parser.add_argument("--dsp", type=int, default=28,
+                        help="dimensions of the simulation parameters (default: 28)")
+    parser.add_argument("--batch-size", type=int, default=32,
+                        help="training batch size (default: 32)")
+    parser.add_argument("--infer-batch-size", type=int, default=1024,
+                        help="inference batch size (default: 1024)")
+    parser.add_argument("--steps", type=int, default=100,
+                        help="timed steps per mode (default: 100)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="torch CPU threads (default: 0, torch default)")
+
+    return parser.parse_args()
+
+def steps_per_sec(fn, steps):
+    for _ in range(5):
+        fn()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    return steps / (time.perf_counter() - start)
+
+# the main function
+def main(args):
+    print(args)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    sub_params = torch.rand(args.batch_size, args.dsp) * 2 - 1
+    sub_data = torch.rand(args.batch_size, 1, 400) * 2 - 1
+    infer_params = torch.rand(args.infer_batch_size, args.dsp) * 2 - 1
+
+    print("{:>8} {:>12} {:>16} {:>18}".format("mode", "compile (s)", "train steps/s", "infer samples/s"))
+    for mode in args.modes:
+        torch.manual_seed(0)
+        g_model = Generator(args.dsp, 512, 4, 4)
+        g_model.train()
+        g_optimizer = optim.Adam(g_model.parameters(), lr=1e-4)
+
+        start = time.perf_counter()
+        g_forward = accel.compile_model(g_model, mode, sub_params)
+        compile_time = time.perf_counter() - start
+
+        def train_step():
+            g_optimizer.zero_grad()
+            loss = loss_helper.EvidentialRegression(sub_data, g_forward(sub_params), coeff=1e-2)
+            loss.backward()
+            g_optimizer.step()
+
+        def infer_step():
+            with torch.no_grad():
+                g_forward(infer_params)
+
+        train_rate = steps_per_sec(train_step, args.steps)
+        infer_rate = steps_per_sec(infer_step, max(args.steps // 10, 1)) * args.infer_batch_size
+        print("{:>8} {:>12.1f} {:>16.1f} {:>18.0f}".format(mode, compile_time, train_rate, infer_rate))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,96 @@
+# scaling of multi-process data-parallel Generator training on CPU
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import torch
+import torch.optim as optim
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generator import Generator
+import loss_helper
+import distributed
+import launch
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Data Parallel Scaling Benchmark")
+
+    parser.add_argument("--nprocs", type=int, nargs='+', default=[1, 2, 4, 8],
+                        help="process counts to compare (default: 1 2 4 8)")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="global batch size (default: 256)")
+    parser.add_argument("--steps", type=int, default=50,
+                        help="timed steps per process count (default: 50)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="torch threads per process (default: 0, cores / processes)")
+    parser.add_argument("--worker", type=str, default="",
+                        help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+def worker(args):
+    # one rank of the timed run, rank 0 writes the result to args.worker
+    rank, world_size = distributed.init_distributed()
+    torch.manual_seed(rank)
+    g_model = Generator(28, 512, 4, 4)
+    g_forward = distributed.wrap_model(g_model)
+    g_optimizer = optim.Adam(g_model.parameters(), lr=5e-4)
+    local_batch = args.batch_size // world_size
+    sub_params = torch.rand(local_batch, 28) * 2 - 1
+    sub_data = torch.rand(local_batch, 1, 400) * 2 - 1
+
+    def step():
+        g_optimizer.zero_grad()
+        loss = loss_helper.EvidentialRegression(sub_data, g_forward(sub_params), coeff=1e-2)
+        loss.backward()
+        g_optimizer.step()
+
+    for _ in range(5):
+        step()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    elapsed = distributed.all_mean(time.perf_counter() - start)
+    if rank == 0:
+        with open(args.worker, 'w') as file:
+            json.dump({"world_size": world_size, "steps_per_sec": args.steps / elapsed}, file)
+    distributed.cleanup()
+
+# the main function
+def main(args):
+    if args.worker:
+        return worker(args)
+    print(args)
+    print("=> {} cores".format(os.cpu_count()))
+
+    print("{:>6} {:>10} {:>14} {:>9} {:>11}".format("procs", "steps/s", "samples/s", "speedup", "efficiency"))
+    base = None
+    for nproc in args.nprocs:
+        if args.batch_size % nproc != 0:
+            print("{:>6} skipped, batch size not divisible".format(nproc))
+            continue
+        with tempfile.TemporaryDirectory() as tmp:
+            result_path = os.path.join(tmp, "result.json")
+            worker_args = ["--batch-size", str(args.batch_size), "--steps", str(args.steps), "--worker", result_path]
+            code = launch.launch(os.path.abspath(__file__), worker_args, nproc_per_node=nproc, threads=args.threads)
+            if code != 0:
+                print("{:>6} failed with {}".format(nproc, code))
+                continue
+            with open(result_path) as file:
+                rate = json.load(file)["steps_per_sec"]
+        base = base or rate
+        print("{:>6} {:>10.2f} {:>14.0f} {:>8.2f}x {:>10.0%}".format(
+            nproc, rate, rate * args.batch_size, rate / base, rate / base / nproc))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,98 @@
+# wall-clock time to a target test MSE for small-batch and large-batch training on synthetic data
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import math
+import time
+import argparse
+
+import torch
+import torch.optim as optim
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generator import Generator
+from bench_amp import synthetic_data
+import loss_helper
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Large Batch Training Benchmark")
+
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[32, 256, 1024],
+                        help="batch sizes to compare (default: 32 256 1024)")
+    parser.add_argument("--lr", type=float, default=5e-4,
+                        help="learning rate at batch size 32 (default: 5e-4)")
+    parser.add_argument("--warmup-epochs", type=int, default=5,
+                        help="warmup epochs for batch sizes above 32 (default: 5)")
+    parser.add_argument("--epochs", type=int, default=60,
+                        help="epochs per run, cosine schedule over them (default: 60)")
+    parser.add_argument("--eval-every", type=int, default=5,
+                        help="evaluate every given number of epochs (default: 5)")
+    parser.add_argument("--target-mse", type=float, default=0.005,
+                        help="test MSE whose wall-clock time is reported (default: 0.005)")
+    parser.add_argument("--n-train", type=int, default=4096,
+                        help="synthetic training rows (default: 4096)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="torch CPU threads (default: 0, torch default)")
+
+    return parser.parse_args()
+
+def run(batch_size, params, data, test_params, test_data, args):
+    torch.manual_seed(0)
+    g_model = Generator(28, 512, 4, 4)
+    lr = args.lr * batch_size / 32
+    warmup = args.warmup_epochs if batch_size > 32 else 0
+    g_optimizer = optim.Adam(g_model.parameters(), lr=lr)
+    num_batches = (params.shape[0] - 1) // batch_size + 1
+    weight = torch.ones(params.shape[0])
+
+    elapsed, reached, curve = 0., None, []
+    for epoch in range(args.epochs):
+        start = time.perf_counter()
+        for i in range(num_batches):
+            step = epoch * num_batches + i
+            if step < warmup * num_batches:
+                group_lr = lr * (step + 1) / (warmup * num_batches)
+            else:
+                group_lr = lr * 0.5 * (1. + math.cos(math.pi * (epoch - warmup) / (args.epochs - warmup)))
+            for group in g_optimizer.param_groups:
+                group["lr"] = group_lr
+            idx = torch.multinomial(weight, batch_size, replacement=True)
+            g_optimizer.zero_grad()
+            loss = loss_helper.EvidentialRegression(data[idx].unsqueeze(1), g_model(params[idx]), coeff=1e-2)
+            loss.backward()
+            g_optimizer.step()
+        elapsed += time.perf_counter() - start
+
+        if (epoch + 1) % args.eval_every == 0:
+            with torch.no_grad():
+                gamma = g_model(test_params)[:, 0]
+            mse = torch.mean((gamma - test_data) ** 2).item()
+            curve.append(mse)
+            if reached is None and mse <= args.target_mse:
+                reached = elapsed
+    return elapsed, reached, curve
+
+# the main function
+def main(args):
+    print(args)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    params, data = synthetic_data(args.n_train)
+    test_params, test_data = synthetic_data(256, seed=1)
+
+    print("=> test MSE every {} epochs".format(args.eval_every))
+    print("{:>6} {:>10} {:>12} {:>10}  {}".format("batch", "total (s)", "to target", "final", "curve"))
+    for batch_size in args.batch_sizes:
+        elapsed, reached, curve = run(batch_size, params, data, test_params, test_data, args)
+        print("{:>6} {:>10.1f} {:>12} {:>10.5f}  {}".format(
+            batch_size, elapsed, "-" if reached is None else "{:.1f}".format(reached), curve[-1],
+            " ".join("{:.4f}".format(x) for x in curve)))
+
+if __name__ == "__main__":
+    main(parse_args())
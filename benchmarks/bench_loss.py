@@ -0,0 +1,86 @@
+# benchmark of the fused evidential loss against loss_helper.EvidentialRegression
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.optim as optim
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generator import Generator
+import loss_helper
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evidential Loss Benchmark")
+
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=[32, 256, 2048],
+                        help="batch sizes to benchmark")
+    parser.add_argument("--dsp", type=int, default=28,
+                        help="dimensions of the simulation parameters (default: 28)")
+    parser.add_argument("--iters", type=int, default=50,
+                        help="timed iterations per configuration (default: 50)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="torch CPU threads (default: 0, torch default)")
+
+    return parser.parse_args()
+
+def timeit(fn, iters):
+    for _ in range(3):
+        fn()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    return (time.perf_counter() - start) / iters
+
+# the main function
+def main(args):
+    print(args)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    losses = (("reference", loss_helper.EvidentialRegression),
+              ("fused", loss_helper.FusedEvidentialRegression))
+
+    g_model = Generator(args.dsp, 512, 4, 4)
+    g_optimizer = optim.Adam(g_model.parameters(), lr=1e-4)
+
+    print("{:>6} {:>10} {:>14} {:>14} {:>12}".format("batch", "loss", "loss fwd+bwd", "train step", "max |dgrad|"))
+    for batch_size in args.batch_sizes:
+        sub_params = torch.rand(batch_size, args.dsp) * 2 - 1
+        sub_data = torch.rand(batch_size, 1, 400) * 2 - 1
+        with torch.no_grad():
+            output = g_model(sub_params)
+
+        grads = []
+        for name, loss_fn in losses:
+            leaf = output.clone().requires_grad_(True)
+            loss_fn(sub_data, leaf, coeff=1e-2).backward()
+            grads.append(leaf.grad)
+
+            def loss_step():
+                leaf.grad = None
+                loss_fn(sub_data, leaf, coeff=1e-2).backward()
+
+            # one train.py step: forward, loss, backward and Adam update
+            def train_step():
+                g_optimizer.zero_grad()
+                loss_fn(sub_data, g_model(sub_params), coeff=1e-2).backward()
+                g_optimizer.step()
+
+            loss_time = timeit(loss_step, args.iters)
+            step_time = timeit(train_step, args.iters)
+            diff = (grads[-1] - grads[0]).abs().max().item()
+            print("{:>6d} {:>10} {:>12.3f}ms {:>12.3f}ms {:>12.2e}".format(
+                batch_size, name, loss_time * 1e3, step_time * 1e3, diff))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,419 @@
+# benchmark suite of the hot paths on synthetic inputs, with a regression check against a baseline
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import math
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generator import Generator
+from NF.FlowNet_surrogate import ParamFlowNetCond
+from NF.Permutations import InvertibleConv1x1
+import loss_helper
+import acquisition
+import utils
+import yeast
+import select_param
+import render
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark Suite")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="run the benchmarks and save the results")
+    run.add_argument("--output", type=str, default="bench_results.json",
+                     help="JSON file of the results (default: bench_results.json)")
+    run.add_argument("--filter", type=str, nargs='+', default=[],
+                     help="only run the benchmarks whose name contains one of the given strings")
+    run.add_argument("--quick", action="store_true", default=False,
+                     help="skip the largest sizes of every benchmark")
+    run.add_argument("--repeats", type=int, default=5,
+                     help="timed repeats per benchmark and size (default: 5)")
+    run.add_argument("--min-time", type=float, default=0.2,
+                     help="shortest time of a repeat in seconds, fast calls are looped (default: 0.2)")
+    run.add_argument("--max-time", type=float, default=30.,
+                     help="time budget in seconds per benchmark and size, slow calls are repeated less (default: 30)")
+    run.add_argument("--threads", type=int, default=0,
+                     help="torch CPU threads (default: 0, torch default)")
+    run.add_argument("--baseline", type=str, default="",
+                     help="compare against the given results afterwards (default: none)")
+    run.add_argument("--threshold", type=float, default=0.1,
+                     help="relative slowdown flagged as a regression (default: 0.1)")
+    run.add_argument("--list", action="store_true", default=False,
+                     help="list the benchmarks and their sizes without running them")
+
+    compare = subparsers.add_parser("compare", help="flag regressions of results against a baseline")
+    compare.add_argument("baseline", type=str,
+                         help="JSON results of the reference run")
+    compare.add_argument("current", type=str,
+                         help="JSON results to check")
+    compare.add_argument("--threshold", type=float, default=0.1,
+                         help="relative slowdown flagged as a regression (default: 0.1)")
+
+    return parser.parse_args()
+
+CASES = []
+
+def case(name, sizes, quick=None, items=None):
+    """
+    Register a benchmark.
+
+    The decorated function receives the keyword arguments of one size, sets
+    up its synthetic inputs and returns the callable to time.
+
+    Args:
+    name (str): benchmark name.
+    sizes (list): keyword arguments of each size, in increasing cost.
+    quick (int): number of sizes run with --quick, default all but the largest.
+    items (str): size argument counting the items a call processes, to report items/s.
+    """
+    def register(fn):
+        CASES.append({"name": name, "sizes": sizes, "quick": quick or max(1, len(sizes) - 1), "items": items, "setup": fn})
+        return fn
+    return register
+
+def size_label(size):
+    return ",".join("{}={}".format(k, v) for k, v in size.items())
+
+def measure(fn, repeats, min_time, max_time):
+    """
+    Seconds per call of fn, over repeats of enough calls to last min_time.
+
+    The first call is a warmup and sets the number of calls per repeat;
+    repeats are dropped so that the total stays within max_time.
+    """
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+    number = max(1, int(math.ceil(min_time / max(first, 1e-9))))
+    repeats = max(1, min(repeats, int(max_time / max(first * number, 1e-9))))
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return {"median_s": float(np.median(times)), "min_s": float(np.min(times)),
+            "std_s": float(np.std(times)), "repeats": repeats, "number": number}
+
+def synthetic_data(n, dsp=28, seed=0):
+    # parameters and curves in [-1, 1] shaped like the scaled dataset
+    gen = torch.Generator().manual_seed(seed)
+    params = torch.rand(n, dsp, generator=gen) * 2 - 1
+    data = torch.tanh(params[:, :1] + torch.sin(torch.linspace(0, 6, 400)).unsqueeze(0) * params[:, 1:2])
+    return params, data
+
+@case("generator_forward", [{"batch": 32}, {"batch": 256}, {"batch": 2048}])
+def bench_generator_forward(batch):
+    g_model = Generator(28, 512, 4, 4)
+    params, _ = synthetic_data(batch)
+
+    def run():
+        with torch.no_grad():
+            g_model(params)
+    return run
+
+@case("generator_fwd_bwd", [{"batch": 32}, {"batch": 256}, {"batch": 2048}])
+def bench_generator_fwd_bwd(batch):
+    g_model = Generator(28, 512, 4, 4)
+    params, data = synthetic_data(batch)
+
+    def run():
+        g_model.zero_grad()
+        loss_helper.EvidentialRegression(data.unsqueeze(1), g_model(params), coeff=1e-2).backward()
+    return run
+
+@case("evidential_loss", [{"batch": 32}, {"batch": 256}, {"batch": 2048}])
+def bench_evidential_loss(batch):
+    _, data = synthetic_data(batch)
+    with torch.no_grad():
+        output = Generator(28, 512, 4, 4)(synthetic_data(batch, seed=1)[0])
+    leaf = output.clone().requires_grad_(True)
+
+    def run():
+        leaf.grad = None
+        loss_helper.EvidentialRegression(data.unsqueeze(1), leaf, coeff=1e-2).backward()
+    return run
+
+FLOW_SIZES = [{"K": 1, "K_cond": 1, "batch": 256}, {"K": 3, "K_cond": 3, "batch": 256}, {"K": 8, "K_cond": 5, "batch": 256}]
+
+def flow_model(K, K_cond, params, data):
+    np.random.seed(0)
+    torch.manual_seed(0)
+    g_model = ParamFlowNetCond(C=1, K=K, K_cond=K_cond)
+    with torch.no_grad():
+        # ActNorm initializes from the first batch
+        g_model(data.unsqueeze(1), params)
+    return g_model
+
+@case("flow_nll", FLOW_SIZES)
+def bench_flow_nll(K, K_cond, batch):
+    params, data = synthetic_data(batch)
+    g_model = flow_model(K, K_cond, params, data)
+
+    def run():
+        with torch.no_grad():
+            _, _, logdet, _, _ = g_model(data.unsqueeze(1), params)
+            (-logdet / (math.log(2) * data.shape[1])).mean().item()
+    return run
+
+@case("flow_sample", FLOW_SIZES)
+def bench_flow_sample(K, K_cond, batch):
+    params, data = synthetic_data(batch)
+    g_model = flow_model(K, K_cond, params, data)
+
+    def run():
+        with torch.no_grad():
+            g_model.sample(dummy_z=None, d_param=params, eps_std=0.8)
+    return run
+
+INVCONV_SIZES = [{"channels": 2, "batch": 256}, {"channels": 16, "batch": 256}, {"channels": 64, "batch": 256}]
+
+@case("invconv_forward", INVCONV_SIZES)
+def bench_invconv_forward(channels, batch):
+    np.random.seed(0)
+    layer = InvertibleConv1x1(channels)
+    z = torch.randn(batch, channels, 200)
+
+    def run():
+        with torch.no_grad():
+            layer(z, logdet=0., reverse=False)
+    return run
+
+@case("invconv_inverse", INVCONV_SIZES)
+def bench_invconv_inverse(channels, batch):
+    np.random.seed(0)
+    layer = InvertibleConv1x1(channels)
+    z = torch.randn(batch, channels, 200)
+
+    def run():
+        with torch.no_grad():
+            layer(z, logdet=0., reverse=True)
+    return run
+
+SELECT_SIZES = [{"candidates": 10000}, {"candidates": 100000}, {"candidates": 1000000}]
+
+@case("select_score", SELECT_SIZES)
+def bench_select_score(candidates):
+    g_model = Generator(28, 512, 4, 4)
+    g_model.train()
+    inputs, _ = synthetic_data(candidates)
+
+    def run():
+        select_param.score_candidates(g_model, inputs, 4096)
+    return run
+
+@case("select_distances", SELECT_SIZES)
+def bench_select_distances(candidates):
+    inputs, _ = synthetic_data(candidates)
+    train_params, _ = synthetic_data(9600, seed=1)
+
+    def run():
+        acquisition.min_distances(inputs, train_params)
+    return run
+
+@case("select_greedy", SELECT_SIZES)
+def bench_select_greedy(candidates):
+    inputs, _ = synthetic_data(candidates)
+    gen = torch.Generator().manual_seed(2)
+    uncertainty, distances = torch.rand(candidates, generator=gen), torch.rand(candidates, generator=gen)
+
+    def run():
+        select_param.greedy_select(uncertainty, distances, inputs, [1e-2], 240)
+    return run
+
+METRIC_SIZES = [{"rows": 1000}, {"rows": 10000}]
+
+def synthetic_prediction(rows):
+    gen = torch.Generator().manual_seed(3)
+    gt = torch.rand(rows, 400, generator=gen) * 2 - 1
+    mu = gt + 0.1 * torch.randn(rows, 400, generator=gen)
+    var = 0.05 + 0.1 * torch.rand(rows, 400, generator=gen)
+    return gt, mu, var
+
+@case("calibration", METRIC_SIZES)
+def bench_calibration(rows):
+    gt, mu, var = synthetic_prediction(rows)
+
+    def run():
+        utils.gen_calibration(mu, var, gt)
+    return run
+
+@case("retention", METRIC_SIZES)
+def bench_retention(rows):
+    # the curves are saved to figs/ of the suite's scratch directory
+    gt, mu, var = synthetic_prediction(rows)
+    all_mse = (mu - gt) ** 2
+    os.makedirs("figs", exist_ok=True)
+
+    def run():
+        utils.gen_cutoff_uncertainty(all_mse, var, "bench")
+        utils.gen_ret_value(all_mse, gt, "bench")
+        utils.gen_ret_uncertainty(all_mse, var, "bench")
+    return run
+
+def synthetic_profiles(n):
+    # de-normalized ground truth, mean and uncertainty profiles of n instances
+    gen = torch.Generator().manual_seed(5)
+    angles = torch.linspace(0, 2 * math.pi, 400)
+    test = 2 + torch.rand(n, 1, generator=gen) * torch.sin(angles) + 0.1 * torch.randn(n, 400, generator=gen)
+    mu = test + 0.05 * torch.randn(n, 400, generator=gen)
+    std = 0.1 + 0.1 * torch.rand(n, 400, generator=gen)
+    return test.numpy(), mu.numpy(), std.numpy()
+
+@case("polar_single", [{"ids": 8}], items="ids")
+def bench_render_polar_single(ids):
+    # one utils.render_one_circle figure per id, as eval.py --id
+    test, mu, std = synthetic_profiles(ids)
+    os.makedirs("figs", exist_ok=True)
+
+    def run():
+        for i in range(ids):
+            utils.render_one_circle("Bench", "Epistemic", i, test[i], mu[i], std[i])
+    return run
+
+@case("polar_batch", [{"ids": 32, "workers": 0}, {"ids": 128, "workers": 4}], items="ids")
+def bench_render_polar_batch(ids, workers):
+    # the pool is started by the warmup call, the timed calls reuse it and its templates
+    test, mu, std = synthetic_profiles(ids)
+    renderer = render.BatchRenderer(workers)
+
+    def run():
+        renderer.render(range(ids), test, mu, std, "Bench", "Epistemic", output_dir="figs", sheet="sheet.png")
+    return run
+
+def write_tree(root, rows_per_set):
+    # the rerun and rerun_imp_sample folders read by ReadYeastDataset
+    rng = np.random.RandomState(4)
+    for folder, n_sets, pf_name in (("rerun", 40, "PF_C42a_set_of_50"), ("rerun_imp_sample", 10, "PF_C42a_set_of_100")):
+        for i in range(1, n_sets + 1):
+            set_dir = os.path.join(root, folder, "set{}".format(i))
+            os.makedirs(set_dir, exist_ok=True)
+            for name, cols in (("list_of_parameters", 35), ("C42a_dat", 400), (pf_name, 1)):
+                np.savetxt(os.path.join(set_dir, name), rng.rand(rows_per_set, cols), fmt="%.6f", delimiter="\t")
+
+@case("read_dataset", [{"rows_per_set": 20}, {"rows_per_set": 200}])
+def bench_read_dataset(rows_per_set):
+    root = os.path.abspath("tree_{}".format(rows_per_set))
+    if not os.path.isdir(root):
+        write_tree(root, rows_per_set)
+
+    def run():
+        yeast.ReadYeastDataset(False, data_root=root)
+    return run
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ""
+    return {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "commit": commit, "python": platform.python_version(),
+            "torch": torch.__version__, "numpy": np.__version__, "machine": platform.machine(),
+            "processor": platform.processor(), "cpus": os.cpu_count(), "threads": torch.get_num_threads()}
+
+def compare(baseline, current, threshold):
+    """
+    Print the slowdown of every benchmark of current against baseline.
+
+    A benchmark regresses when both its median and its fastest repeat are
+    more than threshold slower than the baseline's, so a single noisy
+    repeat does not flag it.
+
+    Returns:
+    list: names and sizes of the regressed benchmarks.
+    """
+    for key in ("torch", "threads", "cpus", "machine"):
+        if baseline["environment"].get(key) != current["environment"].get(key):
+            print("=> warning: {} differs, {} in the baseline and {} now".format(
+                key, baseline["environment"].get(key), current["environment"].get(key)))
+    reference = {(r["name"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    print("{:>18} {:>32} {:>12} {:>12} {:>8}  {}".format("benchmark", "size", "base (ms)", "now (ms)", "ratio", "status"))
+    for r in current["results"]:
+        base = reference.pop((r["name"], r["size"]), None)
+        if base is None:
+            print("{:>18} {:>32} {:>12} {:>12.3f} {:>8}  new".format(r["name"], r["size"], "-", r["median_s"] * 1e3, "-"))
+            continue
+        ratio = r["median_s"] / base["median_s"]
+        if ratio > 1 + threshold and r["min_s"] / base["min_s"] > 1 + threshold:
+            status = "REGRESSION"
+            regressions.append((r["name"], r["size"]))
+        elif ratio < 1 / (1 + threshold):
+            status = "faster"
+        else:
+            status = "ok"
+        print("{:>18} {:>32} {:>12.3f} {:>12.3f} {:>7.2f}x  {}".format(
+            r["name"], r["size"], base["median_s"] * 1e3, r["median_s"] * 1e3, ratio, status))
+    for name, size in reference:
+        print("{:>18} {:>32} {:>12.3f} {:>12} {:>8}  missing".format(name, size, reference[(name, size)]["median_s"] * 1e3, "-", "-"))
+    print("=> {} regression(s) beyond {:.0%}".format(len(regressions), threshold))
+    return regressions
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)
+
+def run(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    cases = [c for c in CASES if not args.filter or any(f in c["name"] for f in args.filter)]
+    if args.list:
+        for c in cases:
+            print("{:>18}  {}".format(c["name"], "  ".join(size_label(s) for s in c["sizes"])))
+        return 0
+
+    output = os.path.abspath(args.output)
+    results = {"environment": environment(), "results": []}
+    print("{:>18} {:>32} {:>12} {:>12} {:>8} {:>12}".format("benchmark", "size", "median (ms)", "min (ms)", "repeats", "items/s"))
+    cwd = os.getcwd()
+    # scratch files of the benchmarks, e.g. the synthetic dataset tree
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for c in cases:
+                for size in c["sizes"][:c["quick"]] if args.quick else c["sizes"]:
+                    torch.manual_seed(0)
+                    fn = c["setup"](**size)
+                    r = dict(name=c["name"], size=size_label(size), **measure(fn, args.repeats, args.min_time, args.max_time))
+                    if c["items"]:
+                        r["items_per_s"] = size[c["items"]] / r["median_s"]
+                    results["results"].append(r)
+                    print("{:>18} {:>32} {:>12.3f} {:>12.3f} {:>8d} {:>12}".format(
+                        r["name"], r["size"], r["median_s"] * 1e3, r["min_s"] * 1e3, r["repeats"],
+                        "{:.1f}".format(r["items_per_s"]) if c["items"] else ""))
+                    del fn
+        finally:
+            os.chdir(cwd)
+
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=1)
+    print("=> results written to {}".format(output))
+    if args.baseline:
+        return 1 if compare(load_results(args.baseline), results, args.threshold) else 0
+    return 0
+
+# the main function
+def main(args):
+    print(args)
+    if args.command == "compare":
+        return 1 if compare(load_results(args.baseline), load_results(args.current), args.threshold) else 0
+    return run(args)
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -0,0 +1,368 @@
+# early stopping, checkpoint writing and pruning shared by the trainers, and the checkpoint registry
+
+import os
+import re
+import json
+import queue
+import pickle
+import threading
+
+import numpy as np
+
+import torch
+
+import pdb
+
+class EarlyStopping:
+    """
+    Tracks a validation metric where lower is better.
+
+    Args:
+    patience (int): epochs without improvement before stopping, 0 disables stopping.
+    min_delta (float): smallest decrease counted as an improvement.
+    """
+    def __init__(self, patience=0, min_delta=1e-4):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = float('inf')
+        self.best_epoch = None
+        self.bad_epochs = 0
+
+    def step(self, value, epoch, epochs=1):
+        """
+        Record the metric of an evaluated epoch.
+
+        Args:
+        value (float): validation metric.
+        epoch (int): 1-based epoch the metric was evaluated at.
+        epochs (int): epochs elapsed since the previous evaluation.
+
+        Returns:
+        bool: whether value is a new best.
+        """
+        if value < self.best - self.min_delta:
+            self.best, self.best_epoch, self.bad_epochs = value, epoch, 0
+            return True
+        self.bad_epochs += epochs
+        return False
+
+    @property
+    def should_stop(self):
+        return self.patience > 0 and self.bad_epochs >= self.patience
+
+    def state_dict(self):
+        return {"best": self.best, "best_epoch": self.best_epoch, "bad_epochs": self.bad_epochs}
+
+    def load_state_dict(self, state):
+        self.best = state["best"]
+        self.best_epoch = state["best_epoch"]
+        self.bad_epochs = state["bad_epochs"]
+
+def best_path(directory, network_str):
+    return os.path.join(directory, network_str + "_best.pth.tar")
+
+def epoch_path(directory, network_str, epoch, ext=".pth.tar"):
+    return os.path.join(directory, network_str + "_" + str(epoch) + ext)
+
+def atomic_save(obj, path):
+    """
+    torch.save to a temporary file renamed over path, so an interrupted save
+    leaves any previous file at path intact.
+    """
+    torch.save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return path
+
+def save_best(state, directory, network_str):
+    """
+    Overwrite the single rolling best checkpoint of a run.
+    """
+    return atomic_save(state, best_path(directory, network_str))
+
+# RNG states and loss histories are kept as tensors and builtins, so that
+# checkpoints still load with torch.load(weights_only=True)
+def rng_state():
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {"torch": torch.get_rng_state(),
+             "numpy": [name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian]}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def compact_losses(losses):
+    """
+    Loss history as a float64 tensor instead of a list of floats and 0-d tensors.
+    """
+    return torch.tensor([float(x) for x in losses], dtype=torch.float64)
+
+def snapshot(obj):
+    """
+    Copy of a checkpoint state whose tensors are detached CPU clones, so it
+    can be serialized while training keeps updating the originals.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+class CheckpointWriter:
+    """
+    Writes checkpoints of a run on a background thread.
+
+    save() snapshots the state on the calling thread and returns; pickling
+    and writing the files, and pruning old checkpoints, happen on the writer
+    thread. Only the checkpoints this writer wrote are pruned, never files of
+    other runs sharing the name. Every file is written atomically. At most max_pending snapshots
+    wait to be written, after that save() blocks. Errors of the writer
+    thread are raised by the next save() or close().
+
+    Args:
+    directory (str): checkpoint directory.
+    network_str (str): run prefix of the checkpoint names.
+    keep (int): number of latest periodic checkpoints written by this writer to keep, 0 keeps all.
+    max_pending (int): snapshots queued before save() blocks.
+    """
+    def __init__(self, directory, network_str, keep=0, max_pending=2):
+        self.directory = directory
+        self.network_str = network_str
+        self.keep = keep
+        # (epoch, paths) of the periodic checkpoints written, oldest first
+        self.written = []
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, epoch, best = item
+            try:
+                if epoch is not None:
+                    paths = [epoch_path(self.directory, self.network_str, epoch),
+                             epoch_path(self.directory, self.network_str, epoch, ".pth")]
+                    atomic_save(state, paths[0])
+                    atomic_save(state["g_model_state_dict"], paths[1])
+                    self.written.append((epoch, paths))
+                    self.written = prune_checkpoints(self.written, self.keep)
+                if best:
+                    save_best(state, self.directory, self.network_str)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("checkpoint writer failed: {}".format(error))
+
+    def save(self, state, epoch=None, best=False):
+        """
+        Queue a checkpoint.
+
+        Args:
+        state (dict): checkpoint state holding g_model_state_dict.
+        epoch (int): write network_str_EPOCH.pth.tar and .pth, None skips them.
+        best (bool): overwrite the rolling best checkpoint.
+        """
+        self._raise()
+        self.queue.put((snapshot(state), epoch, best))
+
+    def wait(self):
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+def periodic_checkpoints(directory, network_str):
+    """
+    The periodic checkpoints of a run, the network_str_EPOCH.pth.tar files and
+    their network_str_EPOCH.pth weight files, by epoch.
+    """
+    pattern = re.compile(re.escape(network_str) + r"_(\d+)\.pth(\.tar)?$")
+    epochs = {}
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            epochs.setdefault(int(match.group(1)), []).append(os.path.join(directory, name))
+    return epochs
+
+def prune_checkpoints(written, keep):
+    """
+    Remove all but the latest keep of the given periodic checkpoints.
+
+    The rolling best checkpoint is never removed.
+
+    Args:
+    written (list): (epoch, paths) of the checkpoints a run wrote.
+    keep (int): number of latest epochs to keep, 0 keeps all.
+
+    Returns:
+    list: the (epoch, paths) kept.
+    """
+    if keep <= 0:
+        return written
+    written = sorted(written, key=lambda item: item[0])
+    for _, paths in written[:-keep]:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    return written[-keep:]
+
+# model_<loss>[_seed<seed>][_dp][_active[<lam>|base]][_ft]_<epoch>.pth.tar, and model_NF_<epoch>.pth.tar
+CHECKPOINT_NAME = re.compile(r"^(?P<run>model_(?P<loss>[A-Za-z]+)(?:_seed(?P<seed>\d+))?(?P<dp>_dp)?"
+                             r"(?:_active(?P<lam>\d*|base))?(?P<ft>_ft)?)_(?P<epoch>\d+|best)\.pth\.tar$")
+
+def run_meta(name):
+    """
+    Metadata of a checkpoint parsed from its file name, for checkpoints
+    written without a "meta" entry. None if the name does not match.
+    """
+    match = CHECKPOINT_NAME.match(os.path.basename(name))
+    if match is None:
+        return None
+    lam = match.group("lam")
+    meta = {"run": match.group("run"),
+            "model": "NF" if match.group("loss") == "NF" else "Generator",
+            "loss": match.group("loss"),
+            "seed": int(match.group("seed")) if match.group("seed") else None,
+            "dropout": match.group("dp") is not None,
+            "active": lam is not None,
+            # "_active" alone is the default lambda of 100, "_activebase" the run without added data
+            "lam": None if lam is None else 0. if lam == "base" else float(lam or 100),
+            "finetune": match.group("ft") is not None}
+    return meta, None if match.group("epoch") == "best" else int(match.group("epoch"))
+
+def load_lazy(path):
+    """
+    torch.load of a checkpoint on the CPU with its tensors memory-mapped, so
+    only the tensors that are used are read from disk.
+    """
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (pickle.UnpicklingError, RuntimeError):
+        # checkpoints of the original scripts hold numpy scalars, or predate the zip format
+        return torch.load(path, map_location="cpu", weights_only=False)
+
+def load_weights(path, map_location="cpu"):
+    """
+    The model state dict of a checkpoint, without its optimizer state.
+
+    The .pth weight file CheckpointWriter writes next to a .pth.tar is read
+    when present, otherwise the .pth.tar is memory-mapped and only the model
+    tensors are copied to map_location.
+    """
+    if path.endswith(".pth.tar") and os.path.exists(path[:-len(".tar")]):
+        return torch.load(path[:-len(".tar")], map_location=map_location)
+    checkpoint = load_lazy(path)
+    return {k: v.to(map_location) for k, v in checkpoint["g_model_state_dict"].items()}
+
+class CheckpointRegistry:
+    """
+    Index of the checkpoints in a directory by model type, loss, seed,
+    lambda and epoch.
+
+    The metadata is read from the "meta" entry and the epoch of every
+    .pth.tar, falling back to the file name for older checkpoints. Files are
+    memory-mapped, so indexing reads the small entries and not the weights
+    or optimizer state; the index is cached in index_name and only new or
+    modified files are read again.
+
+    Args:
+    directory (str): checkpoint directory.
+    index_name (str): cache file of the index in directory, empty disables it.
+    """
+    def __init__(self, directory="models", index_name="registry.json"):
+        self.directory = directory
+        self.index_path = os.path.join(directory, index_name) if index_name else ""
+        self.entries = []
+        self.refresh()
+
+    def _read(self, path):
+        try:
+            checkpoint = load_lazy(path)
+        except Exception:
+            return None
+        parsed = run_meta(path)
+        if "meta" in checkpoint:
+            meta = dict(checkpoint["meta"])
+        elif parsed is not None:
+            meta = parsed[0]
+        else:
+            return None
+        epoch = checkpoint.get("epoch")
+        epoch = int(epoch) if epoch is not None else parsed[1] if parsed is not None else None
+        meta.update({"epoch": epoch, "best": path.endswith("_best.pth.tar"),
+                     "n_rows": int(checkpoint["n_rows"]) if "n_rows" in checkpoint else None})
+        return meta
+
+    def refresh(self):
+        """
+        Index the checkpoints added or modified since the last refresh.
+        """
+        cached = {}
+        if self.index_path and os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                cached = {entry["file"]: entry for entry in json.load(file)}
+        entries = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".pth.tar"):
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            entry = cached.get(name)
+            if entry is None or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+                meta = self._read(path)
+                if meta is None:
+                    continue
+                entry = dict(meta, file=name, mtime=stat.st_mtime, size=stat.st_size)
+            entries.append(entry)
+        self.entries = entries
+        if self.index_path:
+            with open(self.index_path + ".tmp", 'w') as file:
+                json.dump(entries, file, indent=1)
+            os.replace(self.index_path + ".tmp", self.index_path)
+        return entries
+
+    def path(self, entry):
+        return os.path.join(self.directory, entry["file"])
+
+    def find(self, best=False, min_epoch=None, max_epoch=None, **filters):
+        """
+        Entries matching all filters, e.g. find(loss="Evidential", seed=1), by run and epoch.
+
+        Args:
+        best (bool): the rolling best checkpoints instead of the periodic ones.
+        min_epoch (int): smallest epoch, None for no bound.
+        max_epoch (int): largest epoch, None for no bound.
+        filters: metadata values to match, None matches anything.
+        """
+        entries = [entry for entry in self.entries
+                   if entry["best"] == best
+                   and (min_epoch is None or entry["epoch"] >= min_epoch)
+                   and (max_epoch is None or entry["epoch"] <= max_epoch)
+                   and all(value is None or entry.get(key) == value for key, value in filters.items())]
+        return sorted(entries, key=lambda entry: (entry["run"], entry["epoch"]))
+
+    def runs(self, **filters):
+        # the periodic checkpoints grouped by run, in epoch order
+        runs = {}
+        for entry in self.find(**filters):
+            runs.setdefault(entry["run"], []).append(entry)
+        return runs
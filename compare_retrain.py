@@ -0,0 +1,84 @@
+# compare warm-start fine-tuning against from-scratch retraining
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+
+import numpy as np
+
+import torch
+
+from yeast import *
+from generator import Generator
+import utils
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Retraining Report")
+
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disables CUDA evaluation")
+    parser.add_argument("--finetuned", type=str, required=True,
+                        help="checkpoint trained with --finetune")
+    parser.add_argument("--scratch", type=str, required=True,
+                        help="checkpoint trained from random initialization on the same data")
+
+    parser.add_argument("--dsp", type=int, default=28,
+                        help="dimensions of the simulation parameters (default: 28)")
+    parser.add_argument("--dspe", type=int, default=512,
+                        help="dimensions of the simulation parameters' encode (default: 512)")
+    parser.add_argument("--ch", type=int, default=4,
+                        help="channel multiplier (default: 4)")
+
+    parser.add_argument("--lam", type=float, default=100.0,
+                        help="active learning lambda parameter")
+    parser.add_argument("--run-root", type=str, default=ACTIVE_ROOT,
+                        help="directory holding the run_lambda* folders")
+    parser.add_argument("--output", type=str, default="",
+                        help="also write the report as csv to the given path")
+
+    return parser.parse_args()
+
+# the main function
+def main(args):
+    # log hyperparameters
+    print(args)
+
+    # select device
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda:0" if args.cuda else "cpu")
+
+    params, C42a_data, _, dmin, dmax = ReadYeastDataset(True, args.lam, args.run_root)
+    params, C42a_data = torch.from_numpy(params).float().to(device), torch.from_numpy(C42a_data).float().to(device)
+    train_split = torch.from_numpy(np.load('train_split.npy'))
+    train_split = torch.cat((train_split, torch.ones(params.shape[0] - train_split.shape[0], dtype=torch.bool)), dim=0)
+    test_params, test_C42a_data = params[~train_split], C42a_data[~train_split]
+
+    rows = []
+    for name, path in (("finetuned", args.finetuned), ("scratch", args.scratch)):
+        checkpoint = torch.load(path, map_location=device)
+        g_model = Generator(args.dsp, args.dspe, args.ch, 4, dropout=False)
+        g_model.load_state_dict(checkpoint["g_model_state_dict"])
+        g_model.to(device)
+        g_model.train()
+        with torch.no_grad():
+            metrics = utils.evidential_metrics(g_model(test_params), test_C42a_data, dmax)
+        rows.append((name, checkpoint["epoch"], checkpoint.get("train_time", float('nan')),
+                     metrics["psnr"], metrics["nll"], metrics["calibration_err"]))
+
+    header = ("model", "epochs", "train_time_s", "psnr_db", "median_nll", "calibration_err")
+    print("{:>10} {:>7} {:>13} {:>8} {:>11} {:>16}".format(*header))
+    for row in rows:
+        print("{:>10} {:>7d} {:>13.1f} {:>8.2f} {:>11.2f} {:>16.4f}".format(*row))
+    print("wall-clock speedup of fine-tuning: {:.2f}x".format(rows[1][2] / rows[0][2]))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(",".join(header) + "\n")
+            for row in rows:
+                file.write(",".join(str(x) for x in row) + "\n")
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,323 @@
+# evaluate every UQ method from its checkpoints on one copy of the test split
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import torch
+
+from yeast import *
+from generator import Generator
+from NF.FlowNet_surrogate import ParamFlowNetCond
+from shared_data import SharedDataset, SHM_ROOT
+import checkpoint as ckpt
+import loss_helper
+import utils
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="UQ Method Comparison")
+
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disables CUDA evaluation")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed of the sampling methods (default: 1)")
+    parser.add_argument("--method", type=str, action="append", default=[],
+                        help="method to evaluate, repeatable: KIND:PATH[,PATH...][:key=value,...] with KIND evidential, gaussian, "
+                             "dropout, ensemble or nf and the keys name, lam (active learning run of the training data), n_samples, K, K_cond, eps_std")
+
+    parser.add_argument("--dsp", type=int, default=28,
+                        help="dimensions of the simulation parameters (default: 28)")
+    parser.add_argument("--dspe", type=int, default=512,
+                        help="dimensions of the simulation parameters' encode (default: 512)")
+    parser.add_argument("--ch", type=int, default=4,
+                        help="channel multiplier (default: 4)")
+    parser.add_argument("--run-root", type=str, default=ACTIVE_ROOT,
+                        help="directory holding the run_lambda* folders")
+    parser.add_argument("--data-cache", type=str, default="",
+                        help="attach to the dataset shared by shared_data.SharedDataset at the given path (default: a temporary one)")
+
+    parser.add_argument("--workers", type=int, default=4,
+                        help="methods evaluated concurrently, 0 evaluates them in this process (default: 4)")
+    parser.add_argument("--latency-repeats", type=int, default=20,
+                        help="timed single-instance predictions per method (default: 20)")
+    parser.add_argument("--throughput-batch", type=int, default=1024,
+                        help="instances per timed batch prediction (default: 1024)")
+    parser.add_argument("--throughput-repeats", type=int, default=3,
+                        help="timed batch predictions per method (default: 3)")
+    parser.add_argument("--output", type=str, default="uq_comparison.json",
+                        help="consolidated results file (default: uq_comparison.json)")
+
+    return parser.parse_args()
+
+class UQMethod:
+    """
+    A UQ method evaluated from its checkpoints.
+
+    predict() returns the prediction of a batch in the scaled data space: the
+    mean "mu", the uncertainty "std" used for calibration and the retention
+    curves, and whatever nll() needs.
+
+    Args:
+    name (str): name in the results.
+    paths (list): checkpoints of the method.
+    options (dict): method options given in its --method spec.
+    args (Namespace): model dimensions and the seed.
+    device (torch.device): evaluation device.
+    """
+    # forward passes per prediction
+    passes = 1
+
+    def __init__(self, name, paths, options, args, device):
+        self.name = name
+        self.paths = paths
+        self.options = options
+        self.args = args
+        self.device = device
+
+    def load_generator(self, path, out_features, dropout=False):
+        g_model = Generator(self.args.dsp, self.args.dspe, self.args.ch, out_features, dropout=dropout)
+        g_model.load_state_dict(ckpt.load_weights(path, self.device))
+        g_model.to(self.device)
+        # the evaluation scripts run the Generators in training mode
+        g_model.train()
+        return g_model
+
+    def nll(self, pred, gt):
+        return loss_helper.Gaussian_NLL(gt, pred["mu"], pred["std"], reduce=False)
+
+class Evidential(UQMethod):
+    def load(self):
+        self.g_model = self.load_generator(self.paths[0], 4)
+
+    def predict(self, params):
+        gamma, v, alpha, beta = torch.chunk(self.g_model(params), 4, dim=1)
+        return {"mu": gamma[:, 0], "std": torch.sqrt(beta / (v * (alpha - 1 + 1e-6)))[:, 0],
+                "nig": (gamma, v, alpha, beta)}
+
+    def nll(self, pred, gt):
+        return loss_helper.NIG_NLL(gt.unsqueeze(1), *pred["nig"], reduce=False)
+
+class Gaussian(UQMethod):
+    def load(self):
+        self.g_model = self.load_generator(self.paths[0], 2)
+
+    def predict(self, params):
+        mu, sigma = self.g_model(params).chunk(2, dim=1)
+        return {"mu": mu[:, 0], "std": sigma[:, 0]}
+
+class Dropout(UQMethod):
+    def load(self):
+        self.passes = int(self.options.get("n_samples", 10))
+        self.g_model = self.load_generator(self.paths[0], 1, dropout=True)
+
+    def predict(self, params):
+        fake_data = torch.stack([self.g_model(params) for _ in range(self.passes)], dim=0)
+        return {"mu": torch.mean(fake_data, dim=0)[:, 0], "std": torch.std(fake_data, dim=0)[:, 0]}
+
+class Ensemble(UQMethod):
+    def load(self):
+        self.models = [self.load_generator(path, 1) for path in self.paths]
+        self.passes = len(self.models)
+
+    def predict(self, params):
+        fake_data = torch.stack([model(params) for model in self.models], dim=0)
+        return {"mu": torch.mean(fake_data, dim=0)[:, 0], "std": torch.std(fake_data, dim=0)[:, 0]}
+
+class NF(UQMethod):
+    def load(self):
+        self.passes = int(self.options.get("n_samples", 8))
+        self.eps_std = float(self.options.get("eps_std", 0.8))
+        self.g_model = ParamFlowNetCond(C=1, K=int(self.options.get("K", 7)), K_cond=int(self.options.get("K_cond", 5)))
+        self.g_model.load_state_dict(ckpt.load_weights(self.paths[0], self.device))
+        self.g_model.to(self.device)
+        self.g_model.train()
+
+    def predict(self, params):
+        fake_data = torch.stack([self.g_model.sample(dummy_z=None, d_param=params, eps_std=self.eps_std)[0]
+                                 for _ in range(self.passes)], dim=0)
+        return {"mu": torch.mean(fake_data, dim=0)[:, 0], "std": torch.std(fake_data, dim=0)[:, 0]}
+
+METHODS = {"evidential": Evidential, "gaussian": Gaussian, "dropout": Dropout, "ensemble": Ensemble, "nf": NF}
+
+def parse_method(spec):
+    """
+    Parse a KIND:PATH[,PATH...][:key=value,...] method spec.
+
+    Returns:
+    tuple: kind, name, checkpoint paths and options.
+    """
+    parts = spec.split(":")
+    if len(parts) < 2 or parts[0] not in METHODS:
+        raise ValueError("invalid method {}, expected KIND:PATH[,PATH...][:key=value,...] with KIND in {}".format(spec, sorted(METHODS)))
+    options = dict(kv.split("=", 1) for kv in parts[2].split(",")) if len(parts) > 2 and parts[2] else {}
+    name = options.pop("name", parts[0] + ("_active" + str(int(float(options["lam"]))) if "lam" in options else ""))
+    return parts[0], name, parts[1].split(","), options
+
+def test_split(cache_dir, lam=None, run_root=ACTIVE_ROOT, device=None):
+    """
+    The test split of the shared dataset, scaled like the training data of a model.
+
+    Models trained with active learning data saw the data scaled by the range
+    including the rows the run added, the shared copy is scaled by the range
+    of the base dataset.
+
+    Returns:
+    tuple: test parameters, scaled test data and the data maximum of the scaling.
+    """
+    shared_data = SharedDataset.attach(cache_dir)
+    params, C42a_data, _, dmin, dmax, train_split = shared_data.tensors()
+    test_params, test_C42a_data = params[~train_split].to(device), C42a_data[~train_split].to(device)
+    shared_data.close()
+    if lam is not None:
+        added = active_data_range(lam, run_root)
+        if added is not None:
+            raw = (test_C42a_data + 1) * (dmax - dmin) / 2 + dmin
+            dmin, dmax = min(dmin, added[0]), max(dmax, added[1])
+            test_C42a_data = 2 * (raw - dmin) / (dmax - dmin) - 1
+    return test_params, test_C42a_data, dmax
+
+def build_method(spec, args, device):
+    kind, name, paths, options = parse_method(spec)
+    method = METHODS[kind](name, paths, options, args, device)
+    method.load()
+    return method
+
+def evaluate_method(spec, cache_dir, args, threads=0):
+    """
+    Accuracy and uncertainty quality of one method over the test split.
+
+    Runs in a worker process of its own, attached to the shared dataset.
+
+    Returns:
+    dict: PSNR, median NLL, calibration error, the calibration and retention
+        curves, and the time of the prediction over the test split.
+    """
+    if threads > 0:
+        torch.set_num_threads(threads)
+    device = torch.device("cuda:0" if args.cuda else "cpu")
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    method = build_method(spec, args, device)
+    lam = float(method.options["lam"]) if "lam" in method.options else None
+    test_params, test_C42a_data, dmax = test_split(cache_dir, lam, args.run_root, device)
+
+    with torch.no_grad():
+        start_time = time.time()
+        pred = method.predict(test_params)
+        if args.cuda:
+            torch.cuda.synchronize()
+        eval_time = time.time() - start_time
+
+        mu, std = pred["mu"], pred["std"]
+        all_mse = (test_C42a_data - mu) ** 2 / (696.052 / dmax) ** 2
+        mse = all_mse.mean().item()
+        calibration_err, observed_p = utils.gen_calibration(mu, std, test_C42a_data)
+        return {"kind": parse_method(spec)[0], "checkpoints": method.paths, "options": method.options,
+                "test_rows": test_params.shape[0], "forward_passes": method.passes,
+                "psnr": 20. * np.log10(2.) - 10. * np.log10(mse),
+                "median_nll": method.nll(pred, test_C42a_data).median().item(),
+                "calibration_err": float(calibration_err),
+                "observed_conf": observed_p.tolist(),
+                "cutoff_uncertainty_psnrs": utils.cutoff_uncertainty_psnrs(all_mse, std).tolist(),
+                "ret_value_psnrs": utils.ret_value_psnrs(all_mse, test_C42a_data).tolist(),
+                "eval_time_s": eval_time}
+
+def method_result(name, spec, fn, *args):
+    # a failing method is reported in the results instead of ending the comparison
+    try:
+        return fn(*args)
+    except Exception as e:
+        print("=> {} failed: {}".format(name, str(e).splitlines()[0]))
+        return {"kind": parse_method(spec)[0], "error": str(e).splitlines()[0]}
+
+def time_method(method, params, repeats, cuda=False):
+    # median seconds per prediction, after a warmup
+    times = []
+    with torch.no_grad():
+        method.predict(params)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            method.predict(params)
+            if cuda:
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+# the main function
+def main(args):
+    # log hyperparameters
+    print(args)
+    if not args.method:
+        raise ValueError("no method to compare, add --method KIND:PATH")
+    specs = args.method
+    names = [parse_method(spec)[1] for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError("duplicate method names {}, set name= in the specs".format(names))
+
+    # select device
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda:0" if args.cuda else "cpu")
+
+    # the dataset and split are loaded once, the workers attach to the shared copy
+    if args.data_cache:
+        shared_data = SharedDataset.attach(args.data_cache)
+        cache_dir = args.data_cache
+    else:
+        cache_dir = os.path.join(SHM_ROOT, "yeast_uq_{}".format(os.getpid()))
+        shared_data = SharedDataset.create(cache_dir, *ReadYeastDataset(False), train_split=np.load("train_split.npy"))
+
+    # accuracy and uncertainty of the methods, concurrently
+    results = {}
+    if args.workers > 0:
+        workers = min(args.workers, len(specs))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        print("=> evaluating {} methods in {} processes with {} threads".format(len(specs), workers, threads))
+        # spawned, forking a process that already ran OpenMP kernels can hang
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(evaluate_method, spec, cache_dir, args, threads) for spec in specs]
+            for name, spec, future in zip(names, specs, futures):
+                results[name] = method_result(name, spec, future.result)
+    else:
+        for name, spec in zip(names, specs):
+            results[name] = method_result(name, spec, evaluate_method, spec, cache_dir, args)
+
+    # latency and throughput are measured one method at a time on the same inputs
+    test_params, _, _ = test_split(cache_dir, device=device)
+    batch = test_params[:args.throughput_batch]
+    for name, spec in zip(names, specs):
+        if "error" in results[name]:
+            continue
+        torch.manual_seed(args.seed)
+        method = build_method(spec, args, device)
+        latency = time_method(method, test_params[:1], args.latency_repeats, args.cuda)
+        batch_time = time_method(method, batch, args.throughput_repeats, args.cuda)
+        results[name].update({"latency_ms": latency * 1e3, "throughput_batch": batch.shape[0],
+                              "throughput": batch.shape[0] / batch_time})
+    shared_data.close()
+
+    print("{:>22} {:>10} {:>8} {:>11} {:>12} {:>9} {:>13} {:>18}".format(
+        "method", "kind", "PSNR", "median NLL", "calibration", "eval (s)", "latency (ms)", "throughput (1/s)"))
+    for name, r in results.items():
+        if "error" in r:
+            print("{:>22} {:>10}  failed: {}".format(name, r["kind"], r["error"]))
+            continue
+        print("{:>22} {:>10} {:>8.2f} {:>11.2f} {:>12.4f} {:>9.3f} {:>13.2f} {:>18.1f}".format(
+            name, r["kind"], r["psnr"], r["median_nll"], r["calibration_err"], r["eval_time_s"], r["latency_ms"], r["throughput"]))
+
+    with open(args.output, 'w') as file:
+        json.dump({"time": time.strftime("%Y-%m-%d %H:%M:%S"), "device": str(device), "threads": torch.get_num_threads(),
+                   "methods": results}, file, indent=1)
+    print("=> results written to {}".format(args.output))
+
+if __name__ == "__main__":
+    main(parse_args())
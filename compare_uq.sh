@@ -0,0 +1,10 @@
+python -u compare_uq.py --dsp 28 \
+    --method evidential:models/model_Evidential_600.pth.tar \
+    --method dropout:models/model_MSE_dp_1400.pth.tar:n_samples=75 \
+    --method gaussian:models/model_Gaussian_seed0_2000.pth.tar \
+    --method evidential:models/model_Evidential_seed0_active_750.pth.tar:lam=100 \
+    --method evidential:models/model_Evidential_seed0_active25_150.pth.tar:lam=25 \
+    --method evidential:models/model_Evidential_seed0_active50_750.pth.tar:lam=50 \
+    --method evidential:models/model_Evidential_seed0_activebase_150.pth.tar:lam=0 \
+    --method ensemble:models/model_MSE_seed0_600.pth.tar,models/model_MSE_seed1_600.pth.tar,models/model_MSE_seed42_600.pth.tar,models/model_MSE_seed65_600.pth.tar,models/model_MSE_seed411_600.pth.tar,models/model_MSE_seed1342_600.pth.tar,models/model_MSE_seed2345_600.pth.tar,models/model_MSE_seed3407_600.pth.tar \
+    --method nf:models/model_NF_250.pth.tar:K=7,K_cond=5,n_samples=8
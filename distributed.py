@@ -0,0 +1,75 @@
+# multi-process data-parallel training on CPU (gloo) shared by the trainers
+
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+import pdb
+
+def init_distributed(backend="gloo"):
+    """
+    Join the process group described by the launcher's environment.
+
+    launch.py and torchrun both set RANK, WORLD_SIZE, MASTER_ADDR and
+    MASTER_PORT. Without WORLD_SIZE, or with WORLD_SIZE=1, nothing is
+    initialized and the caller runs as a single process.
+
+    Returns:
+    tuple: rank and world size.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1
+    rank = int(os.environ["RANK"])
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    print("=> rank {} of {} joined the {} process group".format(rank, world_size, backend))
+    return rank, world_size
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def wrap_model(model, find_unused_parameters=False):
+    """
+    Wrap a module for gradient all-reduce.
+
+    The parameters and buffers of rank 0 are broadcast to all ranks when
+    the wrapper is built, so data-dependent initialization (ActNorm) must
+    have run before.
+    """
+    if not is_distributed():
+        return model
+    return nn.parallel.DistributedDataParallel(model, find_unused_parameters=find_unused_parameters)
+
+def shard(indices, rank, world_size):
+    """
+    The slice of a global batch trained on by this rank.
+
+    Every rank draws the same global batch from an identically seeded
+    generator and keeps every world_size-th index, so the union of the
+    shards is exactly the weighted sample a single process would draw.
+    """
+    return indices[rank::world_size]
+
+def all_mean(value, count=1):
+    """
+    Mean of per-rank means weighted by the number of samples behind each.
+
+    Args:
+    value (float or Tensor): the local mean.
+    count (int): the number of samples the local mean was taken over.
+
+    Returns:
+    float: the global mean, identical on all ranks.
+    """
+    value = float(value)
+    if not is_distributed():
+        return value
+    totals = torch.tensor([value * count, float(count)], dtype=torch.float64)
+    dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+    return (totals[0] / totals[1]).item()
@@ -18,7 +18,12 @@ import torch.optim as optim
 from yeast import *
 from generator import Generator
 import loss_helper
+import accel
+from shared_data import SharedDataset
 import utils
+import render
+import prediction_store
+import profiler
 
 import pdb
 
@@ -47,6 +52,11 @@ def parse_args():
                         help="active learning version")
     parser.add_argument("--lam", type=float, default=100.0,
                         help="active learning lambda parameter")
+    parser.add_argument("--data-cache", type=str, default="",
+                        help="attach to the dataset shared by shared_data.SharedDataset at the given path (default: none)")
+
+    parser.add_argument("--compile", type=str, default="none",
+                        help="execution mode of the model: none, compile (torch.compile) or trace (TorchScript) (default: none)")
 
     parser.add_argument("--lr", type=float, default=1e-3,
                         help="learning rate (default: 1e-3)")
@@ -70,6 +80,20 @@ def parse_args():
     
     parser.add_argument("--id", type=int, default=-1,
                         help="instance id in the testing set")
+    parser.add_argument("--render-all", action="store_true", default=False,
+                        help="render the uncertainty plot of every instance in the testing set")
+    parser.add_argument("--render-workers", type=int, default=4,
+                        help="processes rendering the plots of --render-all (default: 4)")
+    parser.add_argument("--contact-sheet", type=str, default="",
+                        help="tile the plots of --render-all into the given image (default: none)")
+    parser.add_argument("--store", type=str, default="",
+                        help="write the test predictions to a prediction_store under the given directory (default: none)")
+    parser.add_argument("--store-dtype", type=str, default="float32",
+                        help="precision of the stored predictions, float32 or float16 (default: float32)")
+    parser.add_argument("--memory", action="store_true", default=False,
+                        help="report the peak memory and the largest live tensors per phase")
+    parser.add_argument("--memory-top", type=int, default=5,
+                        help="largest live tensors reported per phase (default: 5)")
 
     return parser.parse_args()
 
@@ -82,6 +106,9 @@ def main(args):
     args.cuda = not args.no_cuda and torch.cuda.is_available()
     device = torch.device("cuda:0" if args.cuda else "cpu")
 
+    # opt-in, a no-op unless --memory
+    memory = profiler.MemoryTracker(args.memory, device, args.memory_top)
+
     if args.loss == 'Evidential':
         out_features = 4
     elif args.loss == 'Gaussian':
@@ -108,11 +135,12 @@ def main(args):
         else:
             return m
 
-    g_model = Generator(args.dsp, args.dspe, args.ch, out_features, dropout=args.dropout)
-    # if args.sn:
-    #     g_model = add_sn(g_model)
+    with memory.phase("model_build"):
+        g_model = Generator(args.dsp, args.dspe, args.ch, out_features, dropout=args.dropout)
+        # if args.sn:
+        #     g_model = add_sn(g_model)
 
-    g_model.to(device)
+        g_model.to(device)
 
     mse_criterion = nn.MSELoss(reduction='none')
 
@@ -131,25 +159,34 @@ def main(args):
             print("=> loaded checkpoint {} (epoch {})"
                     .format(args.resume, checkpoint["epoch"]))
             
-    params, C42a_data, sample_weight, dmin, dmax = ReadYeastDataset(args.active, args.lam)
-    params, C42a_data, sample_weight = torch.from_numpy(params).float().to(device), torch.from_numpy(C42a_data).float().to(device), torch.from_numpy(sample_weight).float().to(device)
-    train_split = torch.from_numpy(np.load('train_split.npy'))
-    if args.active:
-        train_split = torch.cat((train_split, torch.ones(2400, dtype=torch.bool)), dim=0)
-    test_params, test_C42a_data = params[~train_split], C42a_data[~train_split]
+    with memory.phase("data_load"):
+        if args.data_cache:
+            shared_data = SharedDataset.attach(args.data_cache)
+            params, C42a_data, sample_weight, dmin, dmax, train_split = shared_data.tensors()
+        else:
+            params, C42a_data, sample_weight, dmin, dmax = ReadYeastDataset(args.active, args.lam)
+            params, C42a_data, sample_weight = torch.from_numpy(params).float(), torch.from_numpy(C42a_data).float(), torch.from_numpy(sample_weight).float()
+            train_split = torch.from_numpy(np.load('train_split.npy'))
+        params, C42a_data, sample_weight = params.to(device), C42a_data.to(device), sample_weight.to(device)
+        if args.active:
+            train_split = torch.cat((train_split, torch.ones(2400, dtype=torch.bool)), dim=0)
+        test_params, test_C42a_data = params[~train_split], C42a_data[~train_split]
 
     # testing...
     g_model.train()
-    with torch.no_grad():
+    g_forward = accel.compile_model(g_model, args.compile, test_params)
+    with memory.phase("evaluate"), torch.no_grad():
         start_time = time.time()  # Start timing
         if args.dropout:
             assert args.loss == 'MSE'
             fake_data = []
             table_size = 1009  
-            for i in range(args.n_samples):
-                torch.cuda.manual_seed(np.mod(np.power(7, i), table_size))
-                fake_data.append(g_model(test_params))
-            fake_data = torch.stack(fake_data, dim=0)
+            with memory.phase("mc_loop"):
+                for i in range(args.n_samples):
+                    torch.cuda.manual_seed(np.mod(np.power(7, i), table_size))
+                    fake_data.append(g_forward(test_params))
+                    memory.sample()
+                fake_data = torch.stack(fake_data, dim=0)
             mu = torch.mean(fake_data, dim=0)[:, 0]
             var = torch.std(fake_data, dim=0)[:, 0]
             end_time = time.time()  # End timing
@@ -159,15 +196,16 @@ def main(args):
             nll = loss_helper.Gaussian_NLL(test_C42a_data, mu, var, reduce=False)
             print(f"NLL: {nll.median().item():.2f}")
 
-            utils.gen_cutoff_uncertainty(all_mse, var, "dropout")
-            calibration_err, observed_p = utils.gen_calibration(mu, var, test_C42a_data)
+            with memory.phase("metrics"):
+                utils.gen_cutoff_uncertainty(all_mse, var, "dropout")
+                calibration_err, observed_p = utils.gen_calibration(mu, var, test_C42a_data)
             np.save(os.path.join("figs", "dropout_observed_conf"), observed_p)
             print(f"Calibration Error: {calibration_err:.4f}")
 
             mu = ((mu + 1) * (dmax - dmin) / 2) + dmin
             var = var * (dmax - dmin) / 2
         elif args.loss == 'Gaussian':
-            fake_data = g_model(test_params)
+            fake_data = g_forward(test_params)
             mu, sigma = fake_data.chunk(2, dim=1)
             end_time = time.time()  # End timing
             nll = loss_helper.Gaussian_NLL(test_C42a_data.unsqueeze(1), mu, sigma, reduce=False)
@@ -182,7 +220,7 @@ def main(args):
             sigma = sigma * (dmax - dmin) / 2
             mu = ((mu + 1) * (dmax - dmin) / 2) + dmin
         elif args.loss == 'Evidential':
-            fake_data = g_model(test_params)
+            fake_data = g_forward(test_params)
             gamma, v, alpha, beta = torch.chunk(fake_data, 4, dim=1) 
             end_time = time.time()  # End timing
             nll = loss_helper.NIG_NLL(test_C42a_data.unsqueeze(1), gamma, v, alpha, beta, reduce=False)
@@ -200,16 +238,23 @@ def main(args):
                 title = "active" + str(int(args.lam))
             else:
                 title = "singleloop"
-            utils.gen_ret_value(all_mse, test_C42a_data, title)
+            with memory.phase("metrics"):
+                utils.gen_ret_value(all_mse, test_C42a_data, title)
+            # the retention curves of all runs are ordered by the uncertainty of the single loop model
+            if not os.path.exists(os.path.join("figs", "singleloop_epistemic_uncertainty.npy")):
+                raise FileNotFoundError("figs/singleloop_epistemic_uncertainty.npy is written by the non-active Evidential run, "
+                                        "evaluate it first or use pipeline.py")
             singleloop_epistemic_uncertainty = np.load(os.path.join("figs", "singleloop_epistemic_uncertainty.npy"))
             singleloop_epistemic_uncertainty = torch.from_numpy(singleloop_epistemic_uncertainty).to(device)
-            utils.gen_ret_uncertainty(all_mse, singleloop_epistemic_uncertainty, title)
+            with memory.phase("metrics"):
+                utils.gen_ret_uncertainty(all_mse, singleloop_epistemic_uncertainty, title)
 
             title = "evidential"
             if args.active:
                 title += "_active" + str(int(args.lam))
-            utils.gen_cutoff_uncertainty(all_mse, var, title)
-            calibration_err, observed_p = utils.gen_calibration(mu, var, test_C42a_data)
+            with memory.phase("metrics"):
+                utils.gen_cutoff_uncertainty(all_mse, var, title)
+                calibration_err, observed_p = utils.gen_calibration(mu, var, test_C42a_data)
             title = "evidential_observed_conf"
             if args.active:
                 title = "evidential_active"  + str(int(args.lam)) + "_observed_conf"
@@ -220,7 +265,7 @@ def main(args):
             mu = ((mu + 1) * (dmax - dmin) / 2) + dmin
             var = var * (dmax - dmin) / 2
         else:
-            fake_data = g_model(test_params)
+            fake_data = g_forward(test_params)
             fake_data = fake_data[:, 0]
             end_time = time.time()  # End timing
             mse = mse_criterion(test_C42a_data, fake_data).item()
@@ -234,6 +279,31 @@ def main(args):
         test_C42a_data = ((test_C42a_data + 1) * (dmax - dmin) / 2) + dmin
 
 
+    # de-normalized test predictions, for metrics, selection and rendering without the network
+    if args.store:
+        if args.dropout:
+            values = {"mu": mu, "epistemic": var}
+        elif args.loss == 'Gaussian':
+            values = {"mu": mu, "aleatoric": sigma}
+        elif args.loss == 'Evidential':
+            values = {"mu": mu, "aleatoric": sigma, "epistemic": var}
+        else:
+            values = {"mu": fake_data}
+        model_key = prediction_store.model_hash(g_model.state_dict(), dmin=float(dmin), dmax=float(dmax),
+                                                n_samples=args.n_samples if args.dropout else None)
+        params_key = prediction_store.params_hash(test_params)
+        store = prediction_store.PredictionStore.open(args.store, model_key, params_key, args.store_dtype)
+        if store is not None:
+            print("=> test predictions already stored in {}".format(store.path))
+        else:
+            store = prediction_store.PredictionStore.create(args.store, model_key, params_key,
+                                                            test_params.shape[0], [f for f in prediction_store.FIELDS if f in values],
+                                                            dtype=args.store_dtype, dmin=float(dmin), dmax=float(dmax),
+                                                            info={"checkpoint": args.resume, "split": "test"})
+            store.append(**values)
+            print("=> test predictions stored in {}".format(store.path))
+        store.close()
+
     if args.id >= 0:
 
         if args.dropout:
@@ -245,7 +315,8 @@ def main(args):
             # example_var = np.minimum(example_var, np.percentile(example_var, 90))
             print("max var: ",  np.max(example_var))
 
-            utils.render_one_circle("Dropout", "Epistemic", args.id, example_test, example_mu, example_var)
+            with memory.phase("render"):
+                utils.render_one_circle("Dropout", "Epistemic", args.id, example_test, example_mu, example_var)
 
         elif args.loss == 'Gaussian':
             example_test = test_C42a_data[args.id].cpu().numpy()
@@ -254,7 +325,8 @@ def main(args):
             # example_var = np.minimum(example_var, np.percentile(example_var, 90))
             print("max sigma: ",  np.max(example_sigma))
 
-            utils.render_one_circle("Gaussian", "Aleatoric", args.id, example_test, example_mu, example_sigma)
+            with memory.phase("render"):
+                utils.render_one_circle("Gaussian", "Aleatoric", args.id, example_test, example_mu, example_sigma)
 
         elif args.loss == "Evidential":
             example_test = test_C42a_data[args.id].cpu().numpy()
@@ -266,10 +338,33 @@ def main(args):
             print("max sigma: ", np.max(example_sigma), "max var: ",  np.max(example_var))
 
             if args.active:
-                utils.render_one_circle("Evidential", "Epistemic", args.id, example_test, example_mu, example_var, "_active" + str(int(args.lam)))
+                with memory.phase("render"):
+                    utils.render_one_circle("Evidential", "Epistemic", args.id, example_test, example_mu, example_var, "_active" + str(int(args.lam)))
             else:
-                utils.render_one_circle("Evidential", "Epistemic", args.id, example_test, example_mu, example_var)
+                with memory.phase("render"):
+                    utils.render_one_circle("Evidential", "Epistemic", args.id, example_test, example_mu, example_var)
                 # utils.render_two_circles("Evisdential", args.id, example_test, example_mu, example_sigma, example_var)
+
+    if args.render_all:
+        if args.dropout:
+            approach, uncertainty_type, uncertainty, suffix = "Dropout", "Epistemic", var, ""
+        elif args.loss == 'Gaussian':
+            approach, uncertainty_type, uncertainty, suffix = "Gaussian", "Aleatoric", sigma, ""
+        elif args.loss == 'Evidential':
+            approach, uncertainty_type, uncertainty = "Evidential", "Epistemic", var
+            suffix = "_active" + str(int(args.lam)) if args.active else ""
+        else:
+            raise ValueError("--render-all needs a model with uncertainty")
+        with memory.phase("render"):
+            start_time = time.time()
+            paths = render.render_batch(range(test_params.shape[0]), test_C42a_data.cpu().numpy(), mu.cpu().numpy(),
+                                        uncertainty.cpu().numpy(), approach, uncertainty_type, workers=args.render_workers,
+                                        suffix=suffix, sheet=args.contact_sheet)
+            render_time = time.time() - start_time
+        print("=> rendered {} plots in {:.1f}s ({:.1f} ids/s)".format(len(paths), render_time, len(paths) / render_time))
+
+    if args.memory:
+        print(memory.summary())
                 
 
 if __name__ == "__main__":
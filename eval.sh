@@ -6,3 +6,4 @@ python -u eval.py --dsp 28 --loss Evidential --resume models/model_Evidential_se
 python -u eval.py --dsp 28 --loss Evidential --resume models/model_Evidential_seed0_active25_150.pth.tar --active --lam 25
 python -u eval.py --dsp 28 --loss Evidential --resume models/model_Evidential_seed0_active50_750.pth.tar --active --lam 50 --id 51
 python -u eval.py --dsp 28 --loss Evidential --resume models/model_Evidential_seed0_activebase_150.pth.tar --active --lam 0 --id 51
+# python -u eval.py --dsp 28 --loss Evidential --resume models/model_Evidential_seed0_best.pth.tar --id 51
@@ -19,6 +19,7 @@ from yeast import *
 from NF.FlowNet_surrogate import ParamFlowNetCond
 import loss_helper
 import utils
+import profiler
 
 import pdb
 
@@ -55,6 +56,10 @@ def parse_args():
     
     parser.add_argument("--id", type=int, default=0,
                         help="instance id in the testing set")
+    parser.add_argument("--memory", action="store_true", default=False,
+                        help="report the peak memory and the largest live tensors per phase")
+    parser.add_argument("--memory-top", type=int, default=5,
+                        help="largest live tensors reported per phase (default: 5)")
 
     return parser.parse_args()
 
@@ -67,6 +72,9 @@ def main(args):
     args.cuda = not args.no_cuda and torch.cuda.is_available()
     device = torch.device("cuda:0" if args.cuda else "cpu")
 
+    # opt-in, a no-op unless --memory
+    memory = profiler.MemoryTracker(args.memory, device, args.memory_top)
+
     # model
     def weights_init(m):
         if isinstance(m, nn.Linear):
@@ -86,11 +94,12 @@ def main(args):
         else:
             return m
 
-    g_model = ParamFlowNetCond(C=1, K=args.K, K_cond=args.K_cond)
-    # if args.sn:
-    #     g_model = add_sn(g_model)
+    with memory.phase("model_build"):
+        g_model = ParamFlowNetCond(C=1, K=args.K, K_cond=args.K_cond)
+        # if args.sn:
+        #     g_model = add_sn(g_model)
 
-    g_model.to(device)
+        g_model.to(device)
 
     mse_criterion = nn.MSELoss(reduction='none')
 
@@ -109,27 +118,31 @@ def main(args):
             print("=> loaded checkpoint {} (epoch {})"
                     .format(args.resume, checkpoint["epoch"]))
             
-    params, C42a_data, sample_weight, dmin, dmax  = ReadYeastDataset(active=False)
-    params, C42a_data, sample_weight = torch.from_numpy(params).float().to(device), torch.from_numpy(C42a_data).float().to(device), torch.from_numpy(sample_weight).float().to(device)
-    train_split = torch.from_numpy(np.load('train_split.npy'))
-    test_params, test_C42a_data = params[~train_split], C42a_data[~train_split]
+    with memory.phase("data_load"):
+        params, C42a_data, sample_weight, dmin, dmax  = ReadYeastDataset(active=False)
+        params, C42a_data, sample_weight = torch.from_numpy(params).float().to(device), torch.from_numpy(C42a_data).float().to(device), torch.from_numpy(sample_weight).float().to(device)
+        train_split = torch.from_numpy(np.load('train_split.npy'))
+        test_params, test_C42a_data = params[~train_split], C42a_data[~train_split]
 
     # testing...
     g_model.train()
     with torch.no_grad():
         start_time = time.time()  # Start timing
         fake_data = [] 
-        for _ in range(args.n_samples):
-            tmp, _, _ = g_model.sample(dummy_z=None, d_param=test_params, eps_std=0.8)
-            fake_data.append(tmp)
-        fake_data = torch.stack(fake_data, dim=0)
-        mu = torch.mean(fake_data, dim=0)[:, 0]
-        var = torch.std(fake_data, dim=0)[:, 0]
+        with memory.phase("mc_loop"):
+            for _ in range(args.n_samples):
+                tmp, _, _ = g_model.sample(dummy_z=None, d_param=test_params, eps_std=0.8)
+                fake_data.append(tmp)
+                memory.sample()
+            fake_data = torch.stack(fake_data, dim=0)
+            mu = torch.mean(fake_data, dim=0)[:, 0]
+            var = torch.std(fake_data, dim=0)[:, 0]
         end_time = time.time()  # End timing
-        all_mse = mse_criterion(test_C42a_data, mu)
-        all_mse /= (696.052 / dmax) ** 2
-        mse = all_mse.mean().item()
-        nll = loss_helper.Gaussian_NLL(test_C42a_data, mu, var, reduce=False)
+        with memory.phase("metrics"):
+            all_mse = mse_criterion(test_C42a_data, mu)
+            all_mse /= (696.052 / dmax) ** 2
+            mse = all_mse.mean().item()
+            nll = loss_helper.Gaussian_NLL(test_C42a_data, mu, var, reduce=False)
         print(f"NLL: {nll.median().item():.2f}")
 
         mu = ((mu + 1) * (dmax - dmin) / 2) + dmin
@@ -150,7 +163,11 @@ def main(args):
         example_var = var[args.id].cpu().numpy()
         # example_var = np.minimum(example_var, np.percentile(example_var, 90))
 
-        utils.render_one_circle("Ensemble", "Aleatoric", args.id, example_test, example_mu, example_var)
+        with memory.phase("render"):
+            utils.render_one_circle("Ensemble", "Aleatoric", args.id, example_test, example_mu, example_var)
+
+    if args.memory:
+        print(memory.summary())
 
 if __name__ == "__main__":
     main(parse_args())
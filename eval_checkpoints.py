@@ -0,0 +1,188 @@
+# evaluate every checkpoint along the training runs to find the best stopping epoch
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import csv
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import torch
+
+from yeast import *
+from shared_data import SharedDataset, SHM_ROOT
+from compare_uq import evaluate_method, method_result
+import checkpoint as ckpt
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Checkpoint Evaluation")
+
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disables CUDA evaluation")
+    parser.add_argument("--models-dir", type=str, default="models",
+                        help="checkpoint directory (default: models)")
+    parser.add_argument("--list", action="store_true", default=False,
+                        help="list the indexed runs and their epochs, and exit")
+
+    parser.add_argument("--run", type=str, action="append", default=[],
+                        help="run to evaluate, e.g. model_Evidential_seed1, repeatable (default: all runs matching the filters)")
+    parser.add_argument("--loss", type=str, default=None,
+                        help="only runs of this loss, Evidential, Gaussian, MSE or NF")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="only runs of this seed")
+    parser.add_argument("--lam", type=float, default=None,
+                        help="only active learning runs of this lambda")
+    parser.add_argument("--min-epoch", type=int, default=None,
+                        help="first epoch evaluated")
+    parser.add_argument("--max-epoch", type=int, default=None,
+                        help="last epoch evaluated")
+
+    parser.add_argument("--dsp", type=int, default=28,
+                        help="dimensions of the simulation parameters, of checkpoints without metadata (default: 28)")
+    parser.add_argument("--dspe", type=int, default=512,
+                        help="dimensions of the simulation parameters' encode, of checkpoints without metadata (default: 512)")
+    parser.add_argument("--ch", type=int, default=4,
+                        help="channel multiplier, of checkpoints without metadata (default: 4)")
+    parser.add_argument("--K", type=int, default=7,
+                        help="flow steps of NF checkpoints without metadata (default: 7)")
+    parser.add_argument("--K_cond", type=int, default=5,
+                        help="conditional flow steps of NF checkpoints without metadata (default: 5)")
+    parser.add_argument("--n-samples", type=int, default=10,
+                        help="forward passes of the dropout and NF checkpoints (default: 10)")
+    parser.add_argument("--sample-seed", type=int, default=1,
+                        help="random seed of the sampling methods (default: 1)")
+    parser.add_argument("--run-root", type=str, default=ACTIVE_ROOT,
+                        help="directory holding the run_lambda* folders")
+    parser.add_argument("--data-cache", type=str, default="",
+                        help="attach to the dataset shared by shared_data.SharedDataset at the given path (default: a temporary one)")
+
+    parser.add_argument("--workers", type=int, default=4,
+                        help="checkpoints evaluated concurrently, 0 evaluates them in this process (default: 4)")
+    parser.add_argument("--output", type=str, default="checkpoint_metrics.csv",
+                        help="metrics-vs-epoch table (default: checkpoint_metrics.csv)")
+
+    return parser.parse_args()
+
+def method_spec(entry, path, args):
+    """
+    compare_uq method spec and model dimensions of a registry entry, or None
+    for the deterministic MSE runs, which have no uncertainty of their own.
+    """
+    options = {"name": "{}_{}".format(entry["run"], entry["epoch"])}
+    if entry.get("lam") is not None:
+        options["lam"] = entry["lam"]
+    if entry["model"] == "NF":
+        kind = "nf"
+        options.update({"K": entry.get("K", args.K), "K_cond": entry.get("K_cond", args.K_cond), "n_samples": args.n_samples})
+    elif entry["loss"] == "Evidential":
+        kind = "evidential"
+    elif entry["loss"] == "Gaussian":
+        kind = "gaussian"
+    elif entry["dropout"]:
+        kind = "dropout"
+        options["n_samples"] = args.n_samples
+    else:
+        return None, None
+    dims = argparse.Namespace(**dict(vars(args), dsp=entry.get("dsp", args.dsp), dspe=entry.get("dspe", args.dspe),
+                                     ch=entry.get("ch", args.ch), seed=args.sample_seed))
+    return "{}:{}:{}".format(kind, path, ",".join("{}={}".format(k, v) for k, v in options.items())), dims
+
+def best_epochs(rows):
+    # epochs with the lowest median NLL, the highest PSNR and the lowest calibration error
+    rows = [row for row in rows if "error" not in row]
+    if not rows:
+        return {}
+    return {"median_nll": min(rows, key=lambda row: row["median_nll"])["epoch"],
+            "psnr": max(rows, key=lambda row: row["psnr"])["epoch"],
+            "calibration_err": min(rows, key=lambda row: row["calibration_err"])["epoch"]}
+
+# the main function
+def main(args):
+    # log hyperparameters
+    print(args)
+
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    registry = ckpt.CheckpointRegistry(args.models_dir)
+    runs = registry.runs(loss=args.loss, seed=args.seed, lam=args.lam, min_epoch=args.min_epoch, max_epoch=args.max_epoch)
+    if args.run:
+        runs = {run: entries for run, entries in runs.items() if run in args.run}
+    if args.list:
+        for run, entries in runs.items():
+            print("{:>40}  epochs {}".format(run, " ".join(str(entry["epoch"]) for entry in entries)))
+        return
+    jobs = []
+    for run, entries in runs.items():
+        for entry in entries:
+            spec, dims = method_spec(entry, registry.path(entry), args)
+            if spec is None:
+                print("=> skipping {}, a single MSE model has no uncertainty".format(entry["file"]))
+                continue
+            jobs.append((entry, spec, dims))
+    if not jobs:
+        raise ValueError("no checkpoint to evaluate in {}".format(args.models_dir))
+
+    # the dataset and split are loaded once, the workers attach to the shared copy
+    if args.data_cache:
+        shared_data = SharedDataset.attach(args.data_cache)
+        cache_dir = args.data_cache
+    else:
+        cache_dir = os.path.join(SHM_ROOT, "yeast_ckpt_{}".format(os.getpid()))
+        shared_data = SharedDataset.create(cache_dir, *ReadYeastDataset(False), train_split=np.load("train_split.npy"))
+
+    # every checkpoint loads its model weights only, concurrently
+    results = []
+    if args.workers > 0:
+        workers = min(args.workers, len(jobs))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        print("=> evaluating {} checkpoints of {} runs in {} processes with {} threads".format(len(jobs), len(runs), workers, threads))
+        # spawned, forking a process that already ran OpenMP kernels can hang
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(evaluate_method, spec, cache_dir, dims, threads) for _, spec, dims in jobs]
+            for (entry, spec, _), future in zip(jobs, futures):
+                results.append(method_result(entry["file"], spec, future.result))
+    else:
+        for entry, spec, dims in jobs:
+            results.append(method_result(entry["file"], spec, evaluate_method, spec, cache_dir, dims))
+    shared_data.close()
+
+    # metrics-vs-epoch table of every run
+    tables = {}
+    for (entry, _, _), result in zip(jobs, results):
+        row = {"run": entry["run"], "epoch": entry["epoch"], "file": entry["file"], "n_rows": entry.get("n_rows")}
+        if "error" in result:
+            row["error"] = result["error"]
+        else:
+            row.update({key: result[key] for key in ("psnr", "median_nll", "calibration_err", "eval_time_s")})
+        tables.setdefault(entry["run"], []).append(row)
+
+    for run, rows in tables.items():
+        print("=> {}".format(run))
+        print("{:>8} {:>8} {:>11} {:>12} {:>9}".format("epoch", "PSNR", "median NLL", "calibration", "eval (s)"))
+        for row in rows:
+            if "error" in row:
+                print("{:>8}  failed: {}".format(row["epoch"], row["error"]))
+                continue
+            print("{:>8} {:>8.2f} {:>11.2f} {:>12.4f} {:>9.3f}".format(
+                row["epoch"], row["psnr"], row["median_nll"], row["calibration_err"], row["eval_time_s"]))
+        best = best_epochs(rows)
+        if best:
+            print("=> best epoch of {}: {} by median NLL, {} by PSNR, {} by calibration error".format(
+                run, best["median_nll"], best["psnr"], best["calibration_err"]))
+
+    keys = ["run", "epoch", "file", "n_rows", "psnr", "median_nll", "calibration_err", "eval_time_s", "error"]
+    with open(args.output, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=keys)
+        writer.writeheader()
+        for rows in tables.values():
+            writer.writerows(rows)
+    print("=> metrics of {} checkpoints written to {}".format(len(jobs), args.output))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,165 @@
+# export a trained evidential surrogate as a self-describing inference artifact
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import time
+import argparse
+import warnings
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+import pdb
+
+ARTIFACT_VERSION = 1
+PARAM_COLUMNS = list(range(0, 25)) + list(range(32, 35))
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export Evidential Surrogate")
+
+    parser.add_argument("--resume", type=str, required=True,
+                        help="checkpoint of the evidential surrogate")
+    parser.add_argument("--output", type=str, required=True,
+                        help="path of the artifact (.pt for TorchScript, .onnx for ONNX)")
+
+    parser.add_argument("--dsp", type=int, default=28,
+                        help="dimensions of the simulation parameters (default: 28)")
+    parser.add_argument("--dspe", type=int, default=512,
+                        help="dimensions of the simulation parameters' encode (default: 512)")
+    parser.add_argument("--ch", type=int, default=4,
+                        help="channel multiplier (default: 4)")
+    parser.add_argument("--dmin", type=float, default=None,
+                        help="minimum of C42a_dat (default: from the dataset)")
+    parser.add_argument("--dmax", type=float, default=None,
+                        help="maximum of C42a_dat (default: from the dataset)")
+
+    return parser.parse_args()
+
+class EvidentialPredictor(nn.Module):
+    """
+    Generator followed by the de-normalized evidential summaries.
+
+    Returns mu, aleatoric std sqrt(beta / (alpha - 1)) and epistemic std
+    sqrt(beta / (v * (alpha - 1))) in the units of C42a_dat.
+    """
+    def __init__(self, g_model, dmin, dmax):
+        super(EvidentialPredictor, self).__init__()
+        self.g_model = g_model
+        self.dmin = float(dmin)
+        self.scale = float(dmax - dmin) / 2
+
+    def forward(self, sp):
+        gamma, v, alpha, beta = torch.chunk(self.g_model(sp), 4, dim=1)
+        mu = (gamma[:, 0] + 1) * self.scale + self.dmin
+        aleatoric = torch.sqrt(beta / (alpha - 1 + 1e-6))[:, 0] * self.scale
+        epistemic = torch.sqrt(beta / (v * (alpha - 1 + 1e-6)))[:, 0] * self.scale
+        return mu, aleatoric, epistemic
+
+def export_artifact(g_model, path, config):
+    """
+    Trace the predictor and write it with its config next to the weights.
+
+    A .pt artifact stores the config inside the TorchScript archive, an .onnx
+    artifact stores it in a sidecar .json file.
+    """
+    predictor = EvidentialPredictor(g_model, config["dmin"], config["dmax"]).eval()
+    example = torch.zeros(2, config["dsp"])
+
+    if path.endswith(".onnx"):
+        try:
+            torch.onnx.export(predictor, example, path, input_names=["params"],
+                              output_names=["mu", "aleatoric", "epistemic"],
+                              dynamic_axes={name: {0: "batch"} for name in ("params", "mu", "aleatoric", "epistemic")})
+        except ImportError as e:
+            raise RuntimeError("ONNX export needs the onnx and onnxscript packages ({}), "
+                               "export a .pt artifact instead".format(e))
+        with open(os.path.splitext(path)[0] + ".json", 'w') as file:
+            json.dump(config, file, indent=2)
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            traced = torch.jit.trace(predictor, example, check_trace=False)
+        torch.jit.save(traced, path, _extra_files={"config.json": json.dumps(config)})
+
+class Predictor:
+    """
+    Inference-only surrogate reconstructed from an exported artifact.
+
+    It needs neither the training code nor the training checkpoint: calling it
+    with parameters of shape (N, dsp), or raw list_of_parameters rows of shape
+    (N, 35), returns de-normalized mu, aleatoric std and epistemic std as numpy
+    arrays of shape (N, 400).
+    """
+    def __init__(self, path):
+        self.path = path
+        if path.endswith(".onnx"):
+            import onnxruntime
+            with open(os.path.splitext(path)[0] + ".json") as file:
+                self.config = json.load(file)
+            self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+            self.module = None
+        else:
+            extra_files = {"config.json": ""}
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                self.module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+            self.config = json.loads(extra_files["config.json"])
+
+    def __call__(self, params):
+        params = np.asarray(params, dtype=np.float32)
+        if params.shape[1] == 35 and self.config["dsp"] != 35:
+            params = params[:, self.config["param_columns"]]
+        if self.module is None:
+            return tuple(self.session.run(None, {"params": params}))
+        with torch.no_grad():
+            return tuple(x.numpy() for x in self.module(torch.from_numpy(params)))
+
+def load_predictor(path):
+    return Predictor(path)
+
+# the main function
+def main(args):
+    # log hyperparameters
+    print(args)
+
+    from generator import Generator
+
+    start_time = time.time()
+    g_model = Generator(args.dsp, args.dspe, args.ch, 4, dropout=False)
+    checkpoint = torch.load(args.resume, map_location="cpu")
+    g_model.load_state_dict(checkpoint["g_model_state_dict"])
+    g_model.eval()
+    load_time = time.time() - start_time
+
+    if args.dmin is None or args.dmax is None:
+        from yeast import ReadYeastDataset
+        _, _, _, args.dmin, args.dmax = ReadYeastDataset(active=False)
+
+    config = {"version": ARTIFACT_VERSION, "architecture": "Generator", "dsp": args.dsp,
+              "dspe": args.dspe, "ch": args.ch, "out_features": 4, "ring_points": 400,
+              "param_columns": PARAM_COLUMNS, "dmin": float(args.dmin), "dmax": float(args.dmax),
+              "outputs": ["mu", "aleatoric", "epistemic"], "source": os.path.basename(args.resume),
+              "epoch": checkpoint.get("epoch")}
+    export_artifact(g_model, args.output, config)
+    print("=> exported {} to {}".format(args.resume, args.output))
+
+    # check the artifact against the eager model
+    start_time = time.time()
+    predictor = load_predictor(args.output)
+    artifact_time = time.time() - start_time
+
+    params = torch.rand(64, args.dsp) * 2 - 1
+    with torch.no_grad():
+        expected = EvidentialPredictor(g_model, args.dmin, args.dmax)(params)
+    actual = predictor(params.numpy())
+    diff = max(np.abs(e.numpy() - a).max() for e, a in zip(expected, actual))
+    print("=> max abs difference to the eager model: {:.3e}".format(diff))
+    print("=> load time: checkpoint {:.3f}s, artifact {:.3f}s".format(load_time, artifact_time))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -65,12 +65,13 @@ class Generator(nn.Module):
         # Concatenating the tensors along the last dimension
         return torch.cat([mu, v, alpha, beta], dim=1)
 
-    def forward(self, sp):
+    def features(self, sp):
         sp = self.sparams_subnet(sp)
 
         x = sp.view(sp.size(0), self.ch * 4, 100)
-        x = self.data_subnet(x)
+        return self.data_subnet(x)
 
+    def head(self, x):
         if self.out_features == 4:
             x = self.DenseNormalGamma(x)
         elif self.out_features == 2:
@@ -78,4 +79,7 @@ class Generator(nn.Module):
         else:
             x = self.tanh(x)
 
-        return x
\ No newline at end of file
+        return x
+
+    def forward(self, sp):
+        return self.head(self.features(sp))
\ No newline at end of file
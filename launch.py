@@ -0,0 +1,92 @@
+# local launcher running a training script as several data-parallel processes
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Data Parallel Launcher",
+                                     usage="python launch.py [options] SCRIPT [SCRIPT_ARGS ...]")
+
+    parser.add_argument("--nproc-per-node", type=int, default=2,
+                        help="processes started on this node (default: 2)")
+    parser.add_argument("--nnodes", type=int, default=1,
+                        help="number of nodes (default: 1)")
+    parser.add_argument("--node-rank", type=int, default=0,
+                        help="rank of this node (default: 0)")
+    parser.add_argument("--master-addr", type=str, default="127.0.0.1",
+                        help="address of the node with rank 0 (default: 127.0.0.1)")
+    parser.add_argument("--master-port", type=int, default=0,
+                        help="port of the rendezvous on the master node (default: 0, a free port; set it for several nodes)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="torch threads per process (default: 0, cores / nproc-per-node)")
+    parser.add_argument("script", type=str,
+                        help="training script, e.g. train.py")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER,
+                        help="arguments of the training script")
+
+    return parser.parse_args()
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("", 0))
+        return s.getsockname()[1]
+
+def launch(script, script_args, nproc_per_node=2, nnodes=1, node_rank=0,
+           master_addr="127.0.0.1", master_port=0, threads=0, stdout=None):
+    """
+    Run script as nproc_per_node processes of a gloo process group.
+
+    Each process gets RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT
+    and OMP_NUM_THREADS in its environment. If one process fails, the others
+    are terminated.
+
+    Returns:
+    int: 0 if all processes succeeded, else the first non-zero return code.
+    """
+    if master_port == 0:
+        if nnodes > 1:
+            raise ValueError("--master-port must be set when training on several nodes")
+        master_port = free_port()
+    if threads == 0:
+        threads = max(1, (os.cpu_count() or 1) // nproc_per_node)
+    world_size = nproc_per_node * nnodes
+
+    procs = []
+    for local_rank in range(nproc_per_node):
+        env = dict(os.environ, RANK=str(node_rank * nproc_per_node + local_rank), LOCAL_RANK=str(local_rank),
+                   WORLD_SIZE=str(world_size), MASTER_ADDR=master_addr, MASTER_PORT=str(master_port),
+                   OMP_NUM_THREADS=str(threads))
+        procs.append(subprocess.Popen([sys.executable, "-u", script] + list(script_args), env=env, stdout=stdout))
+
+    returncode = 0
+    while procs:
+        for proc in list(procs):
+            code = proc.poll()
+            if code is None:
+                continue
+            procs.remove(proc)
+            if code != 0 and returncode == 0:
+                returncode = code
+                print("=> process {} exited with {}, terminating the others".format(proc.pid, code))
+                for other in procs:
+                    other.terminate()
+        time.sleep(0.1)
+    return returncode
+
+# the main function
+def main(args):
+    print(args)
+    sys.exit(launch(args.script, args.script_args, args.nproc_per_node, args.nnodes, args.node_rank,
+                    args.master_addr, args.master_port, args.threads))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,172 @@
+# structured, append-only metrics of the training runs and a reader for them
+
+import os
+import json
+import time
+import resource
+
+import numpy as np
+
+import torch
+
+import pdb
+
+class MetricsWriter:
+    """
+    Buffered writer of metric records to an append-only JSON lines file.
+
+    log() only appends the record to a buffer, values may be scalar tensors
+    which are read when the buffer is flushed, so logging every step adds
+    neither a file write nor a device synchronization per step. The buffer
+    is written with a single append when it holds flush_every records, when
+    flush_secs have passed since the last write, and by flush() and close().
+    An empty path disables the writer, e.g. on ranks other than 0.
+
+    Args:
+    path (str): metrics file, created with its directory if needed.
+    flush_every (int): records buffered before they are written.
+    flush_secs (float): longest time a record stays in the buffer.
+    """
+    def __init__(self, path, flush_every=1000, flush_secs=30.):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        self.buffer = []
+        self.last_flush = time.time()
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def log(self, step, epoch=None, **values):
+        """
+        Record the metrics of a training step or an evaluation.
+
+        Args:
+        step (int): global training step the metrics belong to.
+        epoch (int): 1-based epoch, if any.
+        values: metric values, floats, ints or scalar tensors.
+        """
+        if not self.path:
+            return
+        record = {"step": step, "time": time.time()}
+        if epoch is not None:
+            record["epoch"] = epoch
+        record.update(values)
+        self.buffer.append(record)
+        if len(self.buffer) >= self.flush_every or record["time"] - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        # tensors of all buffered records are read with one transfer
+        tensors = [(record, key) for record in self.buffer for key, value in record.items() if torch.is_tensor(value)]
+        if tensors:
+            values = torch.stack([record[key].detach().float().reshape(()) for record, key in tensors]).cpu().tolist()
+            for (record, key), value in zip(tensors, values):
+                record[key] = value
+        lines = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in self.buffer)
+        with open(self.path, 'a') as file:
+            file.write(lines)
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def memory_mb(device=None):
+    # peak resident memory of the process, and peak allocated CUDA memory
+    memory = {"max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+    if device is not None and device.type == "cuda":
+        memory["max_cuda_mb"] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return memory
+
+def psnr(mse, dmax=None):
+    # of data scaled to [-1, 1], with dmax after the (696.052 / dmax) ** 2 normalization of eval.py
+    if dmax is not None:
+        mse = mse / (696.052 / dmax) ** 2
+    return 20. * np.log10(2.) - 10. * np.log10(mse)
+
+def read(path, offset=0):
+    """
+    Read the records appended to a metrics file after offset.
+
+    A trailing line still being written is left for the next read.
+
+    Returns:
+    tuple: the list of records and the offset to continue reading from.
+    """
+    if not os.path.exists(path):
+        return [], offset
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        data = file.read()
+    end = data.rfind(b"\n") + 1
+    records = [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+    return records, offset + end
+
+class MetricsReader:
+    """
+    Incremental reader of a metrics file, e.g. for a dashboard or a scheduler.
+
+    poll() returns the records written since the previous poll, records
+    holds all records read so far.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.records = []
+
+    def poll(self):
+        records, self.offset = read(self.path, self.offset)
+        self.records += records
+        return records
+
+    def series(self, key):
+        return series(self.records, key)
+
+    def best(self, key, mode="min"):
+        return best(self.records, key, mode)
+
+def series(records, key):
+    """
+    Steps and values of a metric, in step order.
+
+    A resumed run appends the steps after its checkpoint again, the latest
+    record of a step supersedes the earlier ones.
+
+    Returns:
+    tuple: numpy arrays of the steps and of the values.
+    """
+    latest = {}
+    for record in records:
+        if key in record:
+            latest[record["step"]] = record[key]
+    steps = sorted(latest)
+    return np.array(steps, dtype=np.int64), np.array([latest[s] for s in steps], dtype=np.float64)
+
+def best(records, key, mode="min"):
+    """
+    The record with the lowest (mode="min") or highest value of a metric, or None.
+    """
+    latest = {}
+    for record in records:
+        if key in record:
+            latest[record["step"]] = record
+    if not latest:
+        return None
+    choose = min if mode == "min" else max
+    return choose(latest.values(), key=lambda record: record[key])
+
+def last(records, key):
+    # the record of the latest step holding the metric, or None
+    latest = None
+    for record in records:
+        if key in record and (latest is None or record["step"] >= latest["step"]):
+            latest = record
+    return latest
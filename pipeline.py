@@ -0,0 +1,402 @@
+# incremental pipeline of the predictions, metric arrays and figures in figs/
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import time
+import hashlib
+import inspect
+import argparse
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+import torch
+
+from yeast import *
+from shared_data import SharedDataset, SHM_ROOT
+from compare_uq import build_method, parse_method, test_split
+import utils
+
+import pdb
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Figure Pipeline")
+
+    parser.add_argument("--config", type=str, default=os.path.join("figs", "pipeline.json"),
+                        help="methods of the figures as compare_uq.py specs (default: figs/pipeline.json)")
+    parser.add_argument("--target", type=str, action="append", default=[],
+                        help="node to bring up to date with its inputs, e.g. observed_conf.png, repeatable (default: all)")
+    parser.add_argument("--force", type=str, action="append", default=[],
+                        help="node to recompute even if it is up to date, repeatable")
+    parser.add_argument("--dry-run", action="store_true", default=False,
+                        help="list the stale nodes without running them")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="nodes computed concurrently (default: 4)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed of the sampling methods (default: 1)")
+    parser.add_argument("--run-root", type=str, default=ACTIVE_ROOT,
+                        help="directory holding the run_lambda* folders")
+    parser.add_argument("--data-cache", type=str, default="",
+                        help="attach to the dataset shared by shared_data.SharedDataset at the given path (default: a temporary one)")
+
+    return parser.parse_args()
+
+class HashCache:
+    """
+    Content hashes of files, recomputed only when a file's size or
+    modification time changed, so unchanged checkpoints are not re-read.
+
+    Args:
+    path (str): JSON file the hashes are kept in between runs.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                self.hashes = json.load(file)
+
+    def __call__(self, path):
+        # None for a missing file
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        cached = self.hashes.get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        self.hashes[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def save(self):
+        with open(self.path + ".tmp", 'w') as file:
+            json.dump(self.hashes, file)
+        os.replace(self.path + ".tmp", self.path)
+
+class Node:
+    """
+    A step of the pipeline, computing its outputs with fn(*args, env=env).
+
+    A node is up to date when its key, the hash of its function's code, its
+    args, the content of its files, its declared inputs and the outputs of
+    its dependencies, matches the key it was last computed with and its
+    outputs are unchanged.
+
+    Args:
+    name (str): unique name, by convention that of its main output.
+    fn (callable): module-level function, it runs in a worker process.
+    args (tuple): JSON-serializable arguments of fn.
+    deps (list): names of the nodes whose outputs fn reads.
+    files (list): other files fn reads, e.g. checkpoints or scripts.
+    inputs (dict): other values the outputs depend on, e.g. the dataset version.
+    outputs (list): files fn writes.
+    """
+    def __init__(self, name, fn, args=(), deps=(), files=(), inputs=None, outputs=()):
+        self.name = name
+        self.fn = fn
+        self.args = list(args)
+        self.deps = list(deps)
+        self.files = list(files)
+        self.inputs = inputs or {}
+        self.outputs = list(outputs)
+
+class Pipeline:
+    """
+    DAG of nodes whose state is kept in state_dir.
+
+    run() computes the stale nodes needed by the targets, a node as soon as
+    its dependencies are up to date, on a pool of worker processes. A node
+    whose recomputed outputs are identical leaves its dependents up to date.
+    """
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        self.nodes = {}
+        self.hashes = HashCache(os.path.join(state_dir, "hashes.json"))
+        self.state_path = os.path.join(state_dir, "state.json")
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as file:
+                self.state = json.load(file)
+
+    def add(self, node):
+        if node.name in self.nodes:
+            raise ValueError("duplicate node {}".format(node.name))
+        self.nodes[node.name] = node
+        return node
+
+    def closure(self, targets):
+        # the targets and every node they depend on
+        needed, stack = set(), list(targets or self.nodes)
+        while stack:
+            name = stack.pop()
+            if name not in self.nodes:
+                raise ValueError("unknown node {}, the nodes are {}".format(name, sorted(self.nodes)))
+            if name not in needed:
+                needed.add(name)
+                stack += self.nodes[name].deps
+        return needed
+
+    def key(self, node):
+        record = {"fn": node.fn.__name__,
+                  "code": hashlib.sha256(inspect.getsource(node.fn).encode()).hexdigest(),
+                  "args": node.args,
+                  "files": {path: self.hashes(path) for path in node.files},
+                  "inputs": node.inputs,
+                  "deps": {dep: self.state[dep]["outputs"] for dep in node.deps}}
+        return hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+    def fresh(self, node, key):
+        entry = self.state.get(node.name)
+        return (entry is not None and entry["key"] == key
+                and all(self.hashes(path) == digest for path, digest in entry["outputs"].items()))
+
+    def _save(self):
+        with open(self.state_path + ".tmp", 'w') as file:
+            json.dump(self.state, file, indent=1)
+        os.replace(self.state_path + ".tmp", self.state_path)
+        self.hashes.save()
+
+    def stale(self, targets=None, force=()):
+        """
+        Nodes that a run would compute: stale ones, and those downstream of them.
+        """
+        stale = set()
+        for name in self.order(self.closure(targets)):
+            node = self.nodes[name]
+            if (name in force or any(dep in stale for dep in node.deps)
+                    or any(dep not in self.state for dep in node.deps) or not self.fresh(node, self.key(node))):
+                stale.add(name)
+        return stale
+
+    def order(self, names):
+        # topological order of names
+        ordered, visited = [], set()
+        def visit(name):
+            if name in visited:
+                return
+            visited.add(name)
+            for dep in self.nodes[name].deps:
+                visit(dep)
+            if name in names:
+                ordered.append(name)
+        for name in sorted(names):
+            visit(name)
+        return ordered
+
+    def run(self, env, targets=None, force=(), workers=4):
+        """
+        Bring the targets up to date.
+
+        Returns:
+        dict: status of every needed node, "fresh", "built", "failed" or "skipped".
+        """
+        pending = self.order(self.closure(targets))
+        status, running = {}, {}
+        # spawned, forking a process that already ran OpenMP kernels can hang
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            while pending or running:
+                for name in list(pending):
+                    node = self.nodes[name]
+                    if any(dep not in status for dep in node.deps):
+                        continue
+                    pending.remove(name)
+                    if any(status[dep] in ("failed", "skipped") for dep in node.deps):
+                        status[name] = "skipped"
+                        continue
+                    key = self.key(node)
+                    if name not in force and self.fresh(node, key):
+                        status[name] = "fresh"
+                        continue
+                    print("=> computing {}".format(name))
+                    for path in node.outputs:
+                        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                    running[executor.submit(node.fn, *node.args, env=env)] = (name, key, time.time())
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, key, start = running.pop(future)
+                    try:
+                        future.result()
+                        missing = [path for path in self.nodes[name].outputs if not os.path.exists(path)]
+                        if missing:
+                            raise RuntimeError("outputs {} were not written".format(missing))
+                    except Exception as e:
+                        print("=> {} failed: {}".format(name, str(e).splitlines()[0] if str(e) else repr(e)))
+                        status[name] = "failed"
+                        continue
+                    self.state[name] = {"key": key, "outputs": {path: self.hashes(path) for path in self.nodes[name].outputs}}
+                    self._save()
+                    status[name] = "built"
+                    print("=> computed {} in {:.1f}s".format(name, time.time() - start))
+        self._save()
+        return status
+
+# node functions, run in the worker processes
+
+def predict(spec, dims, lam, output, env):
+    """
+    Prediction of a method over the test split: mu, std and the ground
+    truth in the scaled data space, and the per-point MSE in the unit of
+    eval.py.
+    """
+    torch.set_num_threads(env["threads"])
+    np.random.seed(env["seed"])
+    torch.manual_seed(env["seed"])
+    device = torch.device("cpu")
+    method = build_method(spec, argparse.Namespace(seed=env["seed"], **dims), device)
+    test_params, test_C42a_data, dmax = test_split(env["cache_dir"], lam, env["run_root"], device)
+    with torch.no_grad():
+        pred = method.predict(test_params)
+    mu, std = pred["mu"], pred["std"]
+    all_mse = (test_C42a_data - mu) ** 2 / (696.052 / dmax) ** 2
+    with open(output, 'wb') as file:
+        np.savez(file, mu=mu.numpy(), std=std.numpy(), gt=test_C42a_data.numpy(), all_mse=all_mse.numpy())
+
+def load_prediction(path):
+    with np.load(path) as pred:
+        return {key: torch.from_numpy(pred[key]) for key in ("mu", "std", "gt", "all_mse")}
+
+def observed_conf(pred_path, output, env):
+    pred = load_prediction(pred_path)
+    _, observed_p = utils.gen_calibration(pred["mu"], pred["std"], pred["gt"])
+    np.save(output, observed_p)
+
+def cutoff_uncertainty(pred_path, output, env):
+    pred = load_prediction(pred_path)
+    np.save(output, utils.cutoff_uncertainty_psnrs(pred["all_mse"], pred["std"]))
+
+def ret_value(pred_path, output, env):
+    pred = load_prediction(pred_path)
+    np.save(output, utils.ret_value_psnrs(pred["all_mse"], pred["gt"]))
+
+def ret_uncertainty(pred_path, uncertainty_path, output, env):
+    # the predictions of a run ordered by the uncertainty of the reference model
+    pred, reference = load_prediction(pred_path), load_prediction(uncertainty_path)
+    np.save(output, utils.ret_uncertainty_psnrs(pred["all_mse"], reference["std"]))
+
+def epistemic_uncertainty(pred_path, output, env):
+    np.save(output, load_prediction(pred_path)["std"].numpy())
+
+def render(script, output, env):
+    # the figure scripts read their arrays from, and write to, their own directory
+    subprocess.run([sys.executable, os.path.basename(script)], cwd=os.path.dirname(script) or ".", check=True,
+                   stdout=subprocess.DEVNULL, env=dict(os.environ, MPLBACKEND="Agg"))
+
+# figure script -> (figure, arrays it loads)
+FIGURES = {
+    "render_calibration.py": ("observed_conf.png", ["ensemble_observed_conf.npy", "evidential_observed_conf.npy", "dropout_observed_conf.npy"]),
+    "render_calibration_active.py": ("observed_conf_active.png", ["evidential_active{}_observed_conf.npy".format(lam) for lam in (0, 25, 50, 100)]
+                                     + ["evidential_observed_conf.npy"]),
+    "render_cutoff.py": ("cutoff_uncertainty_psnrs.png", ["dropout_cutoff_uncertainty_psnrs.npy", "ensemble_cutoff_uncertainty_psnrs.npy",
+                                                          "evidential_cutoff_uncertainty_psnrs.npy"]),
+    "render_retention_data.py": ("retention_datavalue_psnrs.png", ["active{}_ret_value_psnrs.npy".format(lam) for lam in (0, 25, 50, 100)]
+                                 + ["singleloop_ret_value_psnrs.npy"]),
+    "render_retention_uncertainty.py": ("retention_uncertainty_psnrs.png", ["active{}_ret_uncertainty_psnrs.npy".format(lam) for lam in (0, 25, 50, 100)]
+                                        + ["singleloop_ret_uncertainty_psnrs.npy"]),
+}
+
+def figure_pipeline(config, figs_dir="figs", run_root=ACTIVE_ROOT):
+    """
+    The nodes of the figures in figs_dir from a config of the form
+    {"methods": {NAME: compare_uq spec}, "singleloop": NAME, "dims": {"dsp": 28, ...}}.
+
+    Every method's prediction is computed once and cached, the arrays the
+    eval scripts used to write are computed from the cached predictions,
+    and a figure is rendered when all arrays its script loads have a node.
+    Predictions depend on the checkpoints, the dataset version, the split
+    and the model code; arrays on the predictions and utils.py; figures on
+    the arrays and their script.
+    """
+    pipeline = Pipeline(os.path.join(figs_dir, ".pipeline"))
+    dims = dict({"dsp": 28, "dspe": 512, "ch": 4}, **config.get("dims", {}))
+    code = [os.path.join(ROOT, name) for name in ("compare_uq.py", "generator.py", "loss_helper.py", os.path.join("NF", "FlowNet_surrogate.py"))]
+    singleloop = config.get("singleloop", "evidential")
+
+    def array(name, fn, preds):
+        pipeline.add(Node(name, fn, args=[pipeline.nodes[p].outputs[0] for p in preds] + [os.path.join(figs_dir, name)],
+                          deps=preds, files=[os.path.join(ROOT, "utils.py")], outputs=[os.path.join(figs_dir, name)]))
+
+    for name, spec in sorted(config["methods"].items()):
+        kind, _, paths, options = parse_method(spec)
+        lam = float(options["lam"]) if "lam" in options else None
+        pred = "pred_" + name
+        pipeline.add(Node(pred, predict, args=[spec, dims, lam, os.path.join(pipeline.state_dir, pred + ".npz")],
+                          files=paths + ["train_split.npy"] + code,
+                          inputs={"dataset": dataset_version(lam is not None, lam, run_root)},
+                          outputs=[os.path.join(pipeline.state_dir, pred + ".npz")]))
+        array(name + "_observed_conf.npy", observed_conf, [pred])
+        array(name + "_cutoff_uncertainty_psnrs.npy", cutoff_uncertainty, [pred])
+
+    # the retention curves of the evidential runs, all ordered by the uncertainty of the single loop model
+    if singleloop in config["methods"]:
+        array("singleloop_epistemic_uncertainty.npy", epistemic_uncertainty, ["pred_" + singleloop])
+        for name, spec in sorted(config["methods"].items()):
+            kind, _, _, options = parse_method(spec)
+            if kind != "evidential" or ("lam" not in options and name != singleloop):
+                continue
+            title = "active" + str(int(float(options["lam"]))) if "lam" in options else "singleloop"
+            array(title + "_ret_value_psnrs.npy", ret_value, ["pred_" + name])
+            array(title + "_ret_uncertainty_psnrs.npy", ret_uncertainty, ["pred_" + name, "pred_" + singleloop])
+
+    for script, (figure, arrays) in sorted(FIGURES.items()):
+        missing = [name for name in arrays if name not in pipeline.nodes]
+        if missing:
+            print("=> no node for {}, missing methods of {}".format(figure, missing))
+            continue
+        pipeline.add(Node(figure, render, args=[os.path.join(figs_dir, script), os.path.join(figs_dir, figure)],
+                          deps=arrays, files=[os.path.join(figs_dir, script)], outputs=[os.path.join(figs_dir, figure)]))
+    return pipeline
+
+# the main function
+def main(args):
+    # log hyperparameters
+    print(args)
+
+    with open(args.config) as file:
+        config = json.load(file)
+    pipeline = figure_pipeline(config, os.path.dirname(args.config) or ".", args.run_root)
+    stale = pipeline.stale(args.target, args.force)
+    print("=> {} of {} nodes stale".format(len(stale), len(pipeline.closure(args.target))))
+    if args.dry_run:
+        for name in pipeline.order(stale):
+            print("   {}".format(name))
+        return
+    if not stale:
+        return
+
+    # the dataset and split are loaded once if a prediction is stale, the workers attach to the shared copy
+    shared_data = None
+    if any(pipeline.nodes[name].fn is predict for name in stale):
+        if args.data_cache:
+            shared_data, cache_dir = SharedDataset.attach(args.data_cache), args.data_cache
+        else:
+            cache_dir = os.path.join(SHM_ROOT, "yeast_figs_{}".format(os.getpid()))
+            shared_data = SharedDataset.create(cache_dir, *ReadYeastDataset(False), train_split=np.load("train_split.npy"))
+    else:
+        cache_dir = ""
+    env = {"cache_dir": cache_dir, "run_root": args.run_root, "seed": args.seed,
+           "threads": max(1, (os.cpu_count() or 1) // args.workers)}
+
+    status = pipeline.run(env, args.target, set(args.force), args.workers)
+    if shared_data is not None:
+        shared_data.close()
+    counts = {s: sum(1 for v in status.values() if v == s) for s in ("built", "fresh", "failed", "skipped")}
+    print("=> {built} computed, {fresh} up to date, {failed} failed, {skipped} skipped".format(**counts))
+    if counts["failed"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,100 @@
+# accuracy guard for the reduced-precision inference modes of the evidential surrogate
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import argparse
+
+import numpy as np
+
+import torch
+
+from yeast import *
+from generator import Generator
+import accel
+import utils
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Precision Accuracy Guard")
+
+    parser.add_argument("--resume", type=str, required=True,
+                        help="checkpoint of the evidential surrogate")
+    parser.add_argument("--precisions", type=str, nargs='+', default=list(accel.PRECISIONS),
+                        help="inference precisions to compare against fp32")
+
+    parser.add_argument("--dsp", type=int, default=28,
+                        help="dimensions of the simulation parameters (default: 28)")
+    parser.add_argument("--dspe", type=int, default=512,
+                        help="dimensions of the simulation parameters' encode (default: 512)")
+    parser.add_argument("--ch", type=int, default=4,
+                        help="channel multiplier (default: 4)")
+    parser.add_argument("--active", action="store_true", default=False,
+                        help="active learning version")
+    parser.add_argument("--lam", type=float, default=100.0,
+                        help="active learning lambda parameter")
+
+    parser.add_argument("--tol-psnr", type=float, default=0.1,
+                        help="largest tolerated PSNR drop in dB (default: 0.1)")
+    parser.add_argument("--tol-nll", type=float, default=0.01,
+                        help="largest tolerated median NLL increase (default: 0.01)")
+    parser.add_argument("--tol-calibration", type=float, default=0.002,
+                        help="largest tolerated calibration error increase (default: 0.002)")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="timed passes over the test split (default: 5)")
+
+    return parser.parse_args()
+
+# the main function
+def main(args):
+    # log hyperparameters
+    print(args)
+
+    # reduced-precision inference is benchmarked on CPU
+    device = torch.device("cpu")
+
+    g_model = Generator(args.dsp, args.dspe, args.ch, 4, dropout=False)
+    print("=> loading checkpoint {}".format(args.resume))
+    checkpoint = torch.load(args.resume, map_location=device)
+    g_model.load_state_dict(checkpoint["g_model_state_dict"])
+    g_model.train()
+
+    params, C42a_data, _, dmin, dmax = ReadYeastDataset(args.active, args.lam)
+    params, C42a_data = torch.from_numpy(params).float(), torch.from_numpy(C42a_data).float()
+    train_split = torch.from_numpy(np.load('train_split.npy'))
+    if args.active:
+        train_split = torch.cat((train_split, torch.ones(params.shape[0] - train_split.shape[0], dtype=torch.bool)), dim=0)
+    test_params, test_C42a_data = params[~train_split], C42a_data[~train_split]
+
+    results = {}
+    for precision in ["fp32"] + [p for p in args.precisions if p != "fp32"]:
+        model = accel.reduce_precision(g_model, precision)
+        with torch.no_grad():
+            fake_data = model(test_params)
+            start_time = time.time()
+            for _ in range(args.repeats):
+                model(test_params)
+            elapsed = (time.time() - start_time) / args.repeats
+        metrics = utils.evidential_metrics(fake_data, test_C42a_data, dmax)
+        metrics["time"] = elapsed
+        results[precision] = metrics
+
+    base = results["fp32"]
+    print("{:>10} {:>9} {:>8} {:>9} {:>12} {:>10} {:>8}".format(
+        "precision", "time (s)", "PSNR", "d PSNR", "d NLL", "d calib", "within"))
+    passing = []
+    for precision, metrics in results.items():
+        d_psnr = metrics["psnr"] - base["psnr"]
+        d_nll = metrics["nll"] - base["nll"]
+        d_cal = metrics["calibration_err"] - base["calibration_err"]
+        within = d_psnr >= -args.tol_psnr and d_nll <= args.tol_nll and d_cal <= args.tol_calibration
+        if within:
+            passing.append((metrics["time"], precision))
+        print("{:>10} {:>9.4f} {:>8.2f} {:>+9.3f} {:>+12.4f} {:>+10.4f} {:>8}".format(
+            precision, metrics["time"], metrics["psnr"], d_psnr, d_nll, d_cal, "yes" if within else "no"))
+    print("=> fastest precision within tolerance: {}".format(min(passing)[1]))
+
+if __name__ == "__main__":
+    main(parse_args())
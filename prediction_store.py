@@ -0,0 +1,237 @@
+# persistent, memory-mapped store of surrogate predictions over parameter sets
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+
+import torch
+
+import pdb
+
+FIELDS = ("mu", "aleatoric", "epistemic")
+DTYPES = ("float32", "float16")
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prediction Store")
+
+    parser.add_argument("--root", type=str, default="predictions",
+                        help="directory of the stores (default: predictions)")
+
+    return parser.parse_args()
+
+def model_hash(state_dict, **config):
+    """
+    Hash of a model's weights and of the settings its predictions depend on,
+    e.g. dmin, dmax and the inference precision.
+    """
+    digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode())
+    for name in sorted(state_dict):
+        tensor = state_dict[name].detach().cpu().contiguous()
+        digest.update("{} {} {}".format(name, tensor.dtype, tuple(tensor.shape)).encode())
+        # through uint8, numpy has no bfloat16
+        digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+def params_hash(params):
+    # hash of a parameter set as float32 rows
+    params = params.detach().cpu().numpy() if torch.is_tensor(params) else np.asarray(params)
+    params = np.ascontiguousarray(params, dtype=np.float32)
+    digest = hashlib.sha256(str(params.shape).encode())
+    digest.update(params.tobytes())
+    return digest.hexdigest()
+
+def store_path(root, model_key, params_key, dtype="float32"):
+    # stores of both precisions can exist side by side
+    return os.path.join(root, model_key[:16] + "_" + params_key[:16] + "_" + dtype)
+
+class PredictionStore:
+    """
+    The predictions of one model over one parameter set, keyed by their hashes.
+
+    Every field (mu, aleatoric std, epistemic std) is an .npy file of shape
+    (rows, points) allocated when the store is created and memory-mapped, so
+    readers slice rows without loading the rest. Values are de-normalized,
+    in the units of C42a_dat, like export.Predictor's; dmin and dmax are in
+    the metadata for the scaled [-1, 1] units. A writer appends chunks of
+    rows in order and records the rows written after each chunk, so an
+    interrupted writer resumes after its last chunk and readers never see
+    unwritten rows. Use create() to write and open() to read.
+
+    Args:
+    path (str): directory of the store.
+    mode (str): "r" to read, "r+" to append.
+    """
+    def __init__(self, path, mode="r"):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as file:
+            self.meta = json.load(file)
+        self.arrays = {field: np.load(os.path.join(path, field + ".npy"), mmap_mode=mode) for field in self.meta["fields"]}
+
+    @classmethod
+    def create(cls, root, model_key, params_key, rows, fields=FIELDS, points=400, dtype="float32", dmin=None, dmax=None, info=None):
+        """
+        Allocate a store, or reopen an incomplete one of the same shape to resume writing it.
+
+        Args:
+        root (str): directory of the stores.
+        model_key (str): model_hash() of the model.
+        params_key (str): params_hash() of the parameter set.
+        rows (int): size of the parameter set.
+        fields (tuple): predicted fields, a subset of FIELDS.
+        points (int): ring points per prediction.
+        dtype (str): "float32", or "float16" for half the size.
+        dmin, dmax (float): data range of the de-normalization.
+        info (dict): free-form description, e.g. the checkpoint path.
+        """
+        if dtype not in DTYPES:
+            raise ValueError("dtype {} is not one of {}".format(dtype, DTYPES))
+        path = store_path(root, model_key, params_key, dtype)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            store = cls(path, mode="r+")
+            if not store.complete and (store.meta["rows"], store.meta["fields"], store.meta["points"], store.meta["dtype"]) == (rows, list(fields), points, dtype):
+                return store
+            # a complete store is rewritten from its first row
+            store.close()
+        os.makedirs(path, exist_ok=True)
+        for field in fields:
+            np.lib.format.open_memmap(os.path.join(path, field + ".npy"), mode="w+", dtype=dtype, shape=(rows, points)).flush()
+        meta = {"model": model_key, "params": params_key, "rows": rows, "points": points, "fields": list(fields),
+                "dtype": dtype, "dmin": dmin, "dmax": dmax, "rows_written": 0, "complete": False,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"), "info": info or {}}
+        _write_meta(path, meta)
+        return cls(path, mode="r+")
+
+    @classmethod
+    def open(cls, root, model_key, params_key, dtype="float32", complete=True):
+        """
+        The store of a model and parameter set in dtype, None if there is none
+        or, with complete, if it is still being written.
+        """
+        path = store_path(root, model_key, params_key, dtype)
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            return None
+        store = cls(path)
+        if (store.meta["model"], store.meta["params"], store.meta["dtype"]) != (model_key, params_key, dtype) or (complete and not store.complete):
+            return None
+        return store
+
+    @property
+    def rows(self):
+        return self.meta["rows"]
+
+    @property
+    def rows_written(self):
+        return self.meta["rows_written"]
+
+    @property
+    def complete(self):
+        return self.meta["complete"]
+
+    def append(self, **values):
+        """
+        Write the next rows of every field, as arrays or tensors of shape (n, points).
+        """
+        if set(values) != set(self.meta["fields"]):
+            raise ValueError("expected the fields {}, got {}".format(self.meta["fields"], sorted(values)))
+        start = self.meta["rows_written"]
+        n = len(next(iter(values.values())))
+        if start + n > self.rows:
+            raise ValueError("{} rows do not fit after row {} of {}".format(n, start, self.rows))
+        for field, value in values.items():
+            if torch.is_tensor(value):
+                value = value.detach().cpu().numpy()
+            self.arrays[field][start:start + n] = value
+            self.arrays[field].flush()
+        # the rows are recorded once their data is on disk
+        self.meta["rows_written"] = start + n
+        self.meta["complete"] = self.meta["rows_written"] == self.rows
+        _write_meta(self.path, self.meta)
+
+    def __getitem__(self, field):
+        # the written rows of a field, memory-mapped
+        return self.arrays[field][:self.meta["rows_written"]]
+
+    def scaled(self, field, rows=slice(None)):
+        """
+        Rows of a field in the scaled [-1, 1] units of the training data, as float32.
+        """
+        values = np.asarray(self[field][rows], dtype=np.float32)
+        scale = (self.meta["dmax"] - self.meta["dmin"]) / 2
+        if field == "mu":
+            return (values - self.meta["dmin"]) / scale - 1
+        return values / scale
+
+    def chunks(self, chunk_rows=4096):
+        # (start, {field: rows}) over the written rows
+        for start in range(0, self.meta["rows_written"], chunk_rows):
+            yield start, {field: self[field][start:start + chunk_rows] for field in self.meta["fields"]}
+
+    def close(self):
+        for array in self.arrays.values():
+            if array.mode != "r":
+                array.flush()
+        self.arrays = {}
+
+def _write_meta(path, meta):
+    with open(os.path.join(path, "meta.json.tmp"), 'w') as file:
+        json.dump(meta, file, indent=1)
+    os.replace(os.path.join(path, "meta.json.tmp"), os.path.join(path, "meta.json"))
+
+def cached_predictions(root, model_key, params, predict, chunk_rows=4096, fields=FIELDS, dtype="float32", dmin=None, dmax=None, info=None):
+    """
+    The store of a model's predictions over params, computed chunk by chunk
+    with predict only if no complete store exists, and resumed after the last
+    written chunk of an incomplete one.
+
+    Args:
+    root (str): directory of the stores.
+    model_key (str): model_hash() of the model.
+    params (Tensor): parameter set of shape (N, dsp).
+    predict (callable): maps a chunk of params to a dict of de-normalized fields.
+    chunk_rows (int): rows predicted and written at once.
+
+    Returns:
+    PredictionStore: the complete store, open for reading.
+    """
+    params_key = params_hash(params)
+    store = PredictionStore.open(root, model_key, params_key, dtype)
+    if store is not None:
+        print("=> reusing {} predictions from {}".format(store.rows, store.path))
+        return store
+    store = PredictionStore.create(root, model_key, params_key, params.shape[0], fields, dtype=dtype,
+                                   dmin=dmin, dmax=dmax, info=info)
+    if store.rows_written:
+        print("=> resuming {} after row {}".format(store.path, store.rows_written))
+    for start in range(store.rows_written, params.shape[0], chunk_rows):
+        store.append(**predict(params[start:start + chunk_rows]))
+    store.close()
+    print("=> {} predictions stored in {}".format(params.shape[0], store.path))
+    return PredictionStore(store.path)
+
+# the main function
+def main(args):
+    # list the stores
+    if not os.path.isdir(args.root):
+        print("=> no stores in {}".format(args.root))
+        return
+    print("{:>42} {:>9} {:>7} {:>8} {:>26} {:>9}  {}".format("store", "rows", "points", "dtype", "fields", "size (MB)", "info"))
+    for name in sorted(os.listdir(args.root)):
+        path = os.path.join(args.root, name)
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            continue
+        store = PredictionStore(path)
+        size = sum(os.path.getsize(os.path.join(path, field + ".npy")) for field in store.meta["fields"]) / 2 ** 20
+        rows = str(store.rows) if store.complete else "{}/{}".format(store.rows_written, store.rows)
+        print("{:>42} {:>9} {:>7} {:>8} {:>26} {:>9.1f}  {}".format(
+            name, rows, store.meta["points"], store.meta["dtype"], ",".join(store.meta["fields"]), size, json.dumps(store.meta["info"])))
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,292 @@
+# opt-in per-phase timers, memory tracking and torch.profiler windows
+
+import os
+import gc
+import time
+import resource
+import contextlib
+
+import torch
+
+import pdb
+
+_NULL = contextlib.nullcontext()
+
+class _Phase:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        self.timer.totals[self.name] = self.timer.totals.get(self.name, 0.) + time.perf_counter() - self.start
+        self.timer.counts[self.name] = self.timer.counts.get(self.name, 0) + 1
+
+class PhaseTimer:
+    """
+    Cumulative wall-clock time per training phase.
+
+    Used as `with timer.phase("forward"): ...`. When disabled, phase()
+    returns a shared no-op context, so the instrumented loop pays one
+    attribute check per phase.
+
+    Args:
+    enabled (bool): whether to time the phases.
+    device (torch.device): CUDA devices are synchronized at the end of each
+        phase so that asynchronous kernels are attributed to their phase.
+    """
+    def __init__(self, enabled=False, device=None):
+        self.enabled = enabled
+        self.sync = enabled and device is not None and device.type == "cuda"
+        self.totals, self.counts = {}, {}
+        self.samples = 0
+        self.start = time.perf_counter()
+        self._phases = {}
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL
+        if name not in self._phases:
+            self._phases[name] = _Phase(self, name)
+        return self._phases[name]
+
+    def add_samples(self, n):
+        if self.enabled:
+            self.samples += n
+
+    def reset(self):
+        self.totals, self.counts = {}, {}
+        self.samples = 0
+        self.start = time.perf_counter()
+
+    def summary(self):
+        """
+        Table of the time per phase since the last reset, with samples/sec.
+        """
+        elapsed = time.perf_counter() - self.start
+        lines = ["{:>12} {:>10} {:>7} {:>8} {:>12}".format("phase", "total (s)", "%", "calls", "per call (ms)")]
+        for name, total in sorted(self.totals.items(), key=lambda item: -item[1]):
+            lines.append("{:>12} {:>10.3f} {:>6.1f}% {:>8d} {:>12.3f}".format(
+                name, total, 100 * total / max(elapsed, 1e-12), self.counts[name], 1e3 * total / self.counts[name]))
+        other = elapsed - sum(self.totals.values())
+        lines.append("{:>12} {:>10.3f} {:>6.1f}%".format("other", other, 100 * other / max(elapsed, 1e-12)))
+        lines.append("=> {:.1f} samples/s over {:.1f}s".format(self.samples / max(elapsed, 1e-12), elapsed))
+        return "\n".join(lines)
+
+def parse_steps(steps):
+    # "START:END" -> (START, END), "" -> None
+    if not steps:
+        return None
+    start, end = (int(x) for x in steps.split(":"))
+    if end <= start:
+        raise ValueError("profile window {} is empty".format(steps))
+    return start, end
+
+class ProfileWindow:
+    """
+    torch.profiler capture over the training steps [start, end).
+
+    The trace is exported for chrome://tracing / Perfetto and the op-level
+    table, sorted by self CPU (or CUDA) time, is written next to it. step()
+    must be called at the beginning of every training step, and close()
+    after the loop; outside the window step() only increments a counter.
+
+    Args:
+    steps (tuple): start and end step, None disables the window.
+    output_dir (str): directory of the trace and the table.
+    prefix (str): file name prefix.
+    """
+    def __init__(self, steps, output_dir="profile", prefix="train"):
+        self.steps = steps
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.profiler = None
+        self.step_num = 0
+
+    def _export(self, prof):
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = "{}_steps{}-{}".format(self.prefix, *self.steps)
+        trace_path = os.path.join(self.output_dir, name + ".json")
+        prof.export_chrome_trace(trace_path)
+        sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        with open(os.path.join(self.output_dir, name + ".txt"), 'w') as file:
+            file.write(prof.key_averages().table(sort_by=sort_by, row_limit=50))
+        print("=> profile of steps {}-{} written to {}".format(self.steps[0], self.steps[1], trace_path))
+
+    def step(self):
+        if self.steps is None:
+            return
+        if self.step_num == self.steps[1]:
+            self.close()
+        if self.step_num == self.steps[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.__enter__()
+        self.step_num += 1
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self._export(self.profiler)
+            self.profiler = None
+
+def _read_peak_rss():
+    # peak resident set size in MB since the last reset, Linux only
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def _reset_peak_rss():
+    # clear_refs resets VmHWM, elsewhere the peak is that of the whole process
+    try:
+        with open("/proc/self/clear_refs", 'w') as file:
+            file.write("5")
+    except OSError:
+        pass
+
+def live_tensors(top=5):
+    """
+    Total size of the tensors reachable from Python and the largest of them.
+
+    Tensors sharing a storage, e.g. views, are counted once.
+
+    Returns:
+    tuple: total MB and a list of (MB, description) of the top largest storages.
+    """
+    storages = {}
+    for obj in gc.get_objects():
+        try:
+            # type() rather than isinstance(), which would read __class__ of lazy modules
+            if not issubclass(type(obj), torch.Tensor) or obj.device.type == "meta":
+                continue
+            storage = obj.untyped_storage()
+            key = (obj.device, storage.data_ptr())
+            nbytes = storage.nbytes()
+        except Exception:
+            continue
+        if key not in storages or nbytes > storages[key][0]:
+            kind = "parameter" if isinstance(obj, torch.nn.Parameter) else "tensor"
+            storages[key] = (nbytes, "{} {} {} on {}".format(kind, tuple(obj.shape), str(obj.dtype).replace("torch.", ""), obj.device))
+    largest = sorted(storages.values(), key=lambda item: -item[0])[:top]
+    return sum(n for n, _ in storages.values()) / 2 ** 20, [(n / 2 ** 20, desc) for n, desc in largest]
+
+class _MemoryPhase:
+    __slots__ = ("tracker", "name")
+
+    def __init__(self, tracker, name):
+        self.tracker = tracker
+        self.name = name
+
+    def __enter__(self):
+        self.tracker._enter(self.name)
+
+    def __exit__(self, *exc):
+        self.tracker._exit(self.name)
+
+class MemoryTracker:
+    """
+    Peak memory per named phase, e.g. data load, model build, scoring.
+
+    Used as `with tracker.phase("score"): ...`, phases may nest and repeat.
+    For every phase it records the peak RSS of the process while the phase
+    ran (reset at each phase boundary through /proc/self/clear_refs), the
+    peak of the CUDA caching allocator, and the live tensors: their total
+    and the largest ones at the sample with the most tensor memory. The
+    tensors are sampled when a call of the phase ends above the phase's
+    previous peak, and whenever sample() is called inside it. Sampling walks
+    the garbage collector's objects, so sample() belongs to the outer loop
+    of a memory-heavy computation, not to every step. When disabled, phase()
+    returns a shared no-op context and sample() returns immediately.
+
+    Args:
+    enabled (bool): whether to track memory.
+    device (torch.device): device of the allocator peaks, CUDA only.
+    top (int): number of largest tensors reported per phase.
+    """
+    def __init__(self, enabled=False, device=None, top=5):
+        self.enabled = enabled
+        self.cuda = enabled and device is not None and device.type == "cuda"
+        self.device = device
+        self.top = top
+        self.stats = {}
+        self.stack = []
+        self._phases = {}
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL
+        if name not in self._phases:
+            self._phases[name] = _MemoryPhase(self, name)
+        return self._phases[name]
+
+    def _update_peaks(self):
+        # the peaks since the last phase boundary belong to every open phase
+        rss = _read_peak_rss()
+        cuda = torch.cuda.max_memory_allocated(self.device) / 2 ** 20 if self.cuda else 0.
+        for name in self.stack:
+            stat = self.stats[name]
+            stat["rss"] = max(stat["rss"], rss)
+            stat["cuda"] = max(stat["cuda"], cuda)
+        return rss, cuda
+
+    def _reset_peaks(self):
+        _reset_peak_rss()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _enter(self, name):
+        self._update_peaks()
+        if name not in self.stats:
+            self.stats[name] = {"calls": 0, "rss": 0., "cuda": 0., "tensors": 0., "largest": []}
+        self.stats[name]["calls"] += 1
+        self.stack.append(name)
+        self._reset_peaks()
+
+    def _exit(self, name):
+        stat = self.stats[name]
+        previous = stat["rss"], stat["cuda"]
+        rss, cuda = self._update_peaks()
+        # 1 MB of slack, the allocators grow the RSS by small amounts
+        if stat["calls"] == 1 or rss > previous[0] + 1. or cuda > previous[1] + 1.:
+            self.sample()
+        self.stack.remove(name)
+        self._reset_peaks()
+
+    def sample(self):
+        """
+        Record the live tensors of the open phases now.
+        """
+        if not self.enabled or not self.stack:
+            return
+        total, largest = live_tensors(self.top)
+        for name in self.stack:
+            stat = self.stats[name]
+            if total > stat["tensors"]:
+                stat["tensors"], stat["largest"] = total, largest
+
+    def summary(self):
+        """
+        Table of the peaks per phase, followed by the largest tensors of each.
+        """
+        lines = ["{:>12} {:>6} {:>14} {:>14} {:>14}".format("phase", "calls", "peak RSS (MB)", "CUDA peak (MB)", "tensors (MB)")]
+        for name, stat in self.stats.items():
+            lines.append("{:>12} {:>6d} {:>14.1f} {:>14} {:>14.1f}".format(
+                name, stat["calls"], stat["rss"], "{:.1f}".format(stat["cuda"]) if self.cuda else "-", stat["tensors"]))
+        for name, stat in self.stats.items():
+            if stat["largest"]:
+                lines.append("=> largest live tensors in {}:".format(name))
+                lines += ["   {:>10.1f} MB  {}".format(mb, desc) for mb, desc in stat["largest"]]
+        return "\n".join(lines)
@@ -0,0 +1,206 @@
+# batch rendering of the per-instance polar uncertainty plots
+
+import os
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import matplotlib.image as mpimg
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import pdb
+
+ANGLES = np.linspace(0, 2 * np.pi, 400, endpoint=False)
+
+class PolarTemplate:
+    """
+    The figure of utils.render_one_circle, built once and redrawn per instance.
+
+    The figure is drawn on an Agg canvas without pyplot, and draw() only
+    updates the data of the ground truth and mean lines and of the two
+    fill_between bands of the reference, then sets the radial limit like
+    autoscaling would. Given the same arrays, the images are identical to
+    utils.render_one_circle's.
+
+    Args:
+    uncertainty_type (str): "Aleatoric" or "Epistemic", the title.
+    figsize (tuple): figure size in inches.
+    dpi (int): resolution.
+    """
+    def __init__(self, uncertainty_type, figsize=(6, 5), dpi=100):
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(projection='polar')
+        self.ax.set_theta_zero_location('S')  # 'S' is for South
+        zeros = np.zeros_like(ANGLES)
+        self.test_line, = self.ax.plot(ANGLES, zeros, color='#000000', linewidth=1, zorder=0)
+        self.mu_line, = self.ax.plot(ANGLES, zeros, color='#0000ff', linewidth=1, zorder=0)
+        # the bands of k = 0 and 1 standard deviations, the first is empty but antialiased
+        self.bands = [self.band(zeros, zeros) for k in range(2)]
+        self.title = uncertainty_type + " Uncertainty"
+        self.ax.set_title(self.title, fontsize=20)
+        self.ax.tick_params(labelsize=14)  # Adjust tick label size
+        self.title_placed = False
+
+    def band(self, lower, upper):
+        return self.ax.fill_between(ANGLES, lower, upper, alpha=0.3, edgecolor=None, facecolor='#00aeef',
+                                    linewidth=0, zorder=1)
+
+    def draw(self, test, mu, std):
+        """
+        Render one instance.
+
+        Returns:
+        ndarray: the RGBA image, valid until the next draw.
+        """
+        lower, upper = mu - std, mu + std
+        self.test_line.set_ydata(test)
+        self.mu_line.set_ydata(mu)
+        for k in range(2):
+            if hasattr(self.bands[k], "set_data"):
+                self.bands[k].set_data(ANGLES, mu - k * std, mu + k * std)
+            else:
+                # matplotlib < 3.10 has no FillBetweenPolyCollection to update
+                self.bands[k].remove()
+                self.bands[k] = self.band(mu - k * std, mu + k * std)
+        # the 5% margin of autoscaling over the data, from 0 as in set_ylim(0, None)
+        low, high = min(test.min(), lower.min()), max(test.max(), upper.max())
+        self.ax.set_ylim(0, high + 0.05 * (high - low))
+        self.canvas.draw()
+        if not self.title_placed:
+            # the angular labels the title is placed above are the same in every plot, so
+            # the position found by the first draw is kept instead of recomputed per draw
+            self.ax.set_title(self.title, fontsize=20, y=self.ax.title.get_position()[1])
+            self.title_placed = True
+        return np.asarray(self.canvas.buffer_rgba())
+
+def thumbnail(image, scale):
+    # image downsampled by averaging scale x scale blocks
+    if scale <= 1:
+        return image.copy()
+    h, w = image.shape[0] // scale * scale, image.shape[1] // scale * scale
+    blocks = image[:h, :w].reshape(h // scale, scale, w // scale, scale, image.shape[2])
+    return blocks.mean(axis=(1, 3)).astype(np.uint8)
+
+def plot_path(output_dir, approach, input_id, suffix=""):
+    # the file name of utils.render_one_circle
+    return os.path.join(output_dir, "uncertainty_" + approach + "_id" + str(input_id) + suffix + ".png")
+
+# templates of a process, reused by all of its chunks
+_TEMPLATES = {}
+
+def render_chunk(uncertainty_type, test, mu, std, paths, scale=0):
+    """
+    Render the instances of a chunk with the process's template.
+
+    Args:
+    uncertainty_type (str): title of the plots.
+    test, mu, std (ndarray): profiles of the chunk, one row per instance.
+    paths (list): output file per instance, None to skip writing it.
+    scale (int): return thumbnails downsampled by scale, 0 returns none.
+
+    Returns:
+    list: the thumbnails, if scale.
+    """
+    if uncertainty_type not in _TEMPLATES:
+        _TEMPLATES[uncertainty_type] = PolarTemplate(uncertainty_type)
+    template = _TEMPLATES[uncertainty_type]
+    thumbnails = []
+    for i in range(len(test)):
+        image = template.draw(test[i], mu[i], std[i])
+        if paths[i] is not None:
+            # zlib level 3 writes about as small a file as the default 6, in 60% of the time
+            mpimg.imsave(paths[i], image, pil_kwargs={"compress_level": 3})
+        if scale:
+            thumbnails.append(thumbnail(image, scale))
+    return thumbnails
+
+def contact_sheet(thumbnails, path, columns=0):
+    """
+    Tile thumbnails of equal size into one image, row by row.
+
+    Args:
+    thumbnails (list): RGBA images.
+    path (str): output image.
+    columns (int): tiles per row, 0 for a square sheet.
+    """
+    columns = columns or int(math.ceil(math.sqrt(len(thumbnails))))
+    rows = int(math.ceil(len(thumbnails) / columns))
+    h, w, c = thumbnails[0].shape
+    sheet = np.full((rows * h, columns * w, c), 255, dtype=np.uint8)
+    for i, image in enumerate(thumbnails):
+        r, col = divmod(i, columns)
+        sheet[r * h:(r + 1) * h, col * w:(col + 1) * w] = image
+    mpimg.imsave(path, sheet)
+    return path
+
+class BatchRenderer:
+    """
+    Renders the polar uncertainty plots of many instances on a process pool.
+
+    Instances are split into one contiguous chunk per worker, each worker
+    renders its chunk with a template it keeps across calls, so the cost of
+    building the figure and of starting the pool is paid once per worker
+    and not per instance. Used as a context manager, or closed with close().
+
+    Args:
+    workers (int): rendering processes, 0 renders in this process.
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        # spawned, forking a process that already ran OpenMP kernels can hang
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) if workers > 0 else None
+
+    def render(self, ids, test, mu, std, approach, uncertainty_type, output_dir="figs", suffix="", sheet="", columns=0, scale=4):
+        """
+        Render the plots of ids, named like utils.render_one_circle's.
+
+        Args:
+        ids (list): instance ids, used in the file names.
+        test, mu, std (ndarray): ground truth, mean and uncertainty profiles of the ids, one row each.
+        approach (str): method in the file names, e.g. "Evidential".
+        uncertainty_type (str): "Aleatoric" or "Epistemic".
+        output_dir (str): directory of the plots, empty to only write the contact sheet.
+        suffix (str): file name suffix, e.g. "_active50".
+        sheet (str): path of a contact sheet of all plots, empty for none.
+        columns (int): tiles per row of the contact sheet, 0 for a square sheet.
+        scale (int): downsampling of the plots in the contact sheet.
+
+        Returns:
+        list: the paths of the plots.
+        """
+        # kept in the caller's dtype, like utils.render_one_circle plots them
+        test, mu, std = (np.asarray(x) for x in (test, mu, std))
+        paths = [plot_path(output_dir, approach, i, suffix) if output_dir else None for i in ids]
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        scale = scale if sheet else 0
+        if self.executor is None:
+            thumbnails = render_chunk(uncertainty_type, test, mu, std, paths, scale)
+        else:
+            bounds = np.linspace(0, len(ids), min(self.workers, len(ids)) + 1).astype(int)
+            futures = [self.executor.submit(render_chunk, uncertainty_type, test[a:b], mu[a:b], std[a:b], paths[a:b], scale)
+                       for a, b in zip(bounds[:-1], bounds[1:])]
+            thumbnails = [image for future in futures for image in future.result()]
+        if sheet:
+            contact_sheet(thumbnails, sheet, columns)
+        return [path for path in paths if path is not None]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def render_batch(ids, test, mu, std, approach, uncertainty_type, workers=4, **kwargs):
+    """
+    BatchRenderer.render on a pool of its own.
+    """
+    with BatchRenderer(workers) as renderer:
+        return renderer.render(ids, test, mu, std, approach, uncertainty_type, **kwargs)
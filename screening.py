@@ -0,0 +1,160 @@
+# Surrogate pre-screening of requested parameter sets before simulation
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+import torch
+
+from yeast import *
+from generator import Generator
+import acquisition
+import accel
+
+import pdb
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Surrogate Screening")
+
+    parser.add_argument("--no-cuda", action="store_true", default=False,
+                        help="disables CUDA inference")
+    parser.add_argument("--resume", type=str, required=True,
+                        help="checkpoint of the evidential surrogate")
+
+    parser.add_argument("--dsp", type=int, default=28,
+                        help="dimensions of the simulation parameters (default: 28)")
+    parser.add_argument("--dspe", type=int, default=512,
+                        help="dimensions of the simulation parameters' encode (default: 512)")
+    parser.add_argument("--ch", type=int, default=4,
+                        help="channel multiplier (default: 4)")
+
+    parser.add_argument("--requests", type=str, required=True,
+                        help="list_of_parameters file with the requested parameter sets")
+    parser.add_argument("--output-dir", type=str, required=True,
+                        help="folder receiving list_of_parameters, surrogate_answers_round*.npz and screening_stats.json")
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help="mean epistemic std (scaled units) below which the surrogate answers (default: 0.05)")
+    parser.add_argument("--precision", type=str, default="fp32",
+                        help="inference precision: fp32, int8, bf16 or int8+bf16 (default: fp32)")
+    parser.add_argument("--dmin", type=float, default=None,
+                        help="minimum of C42a_dat (default: from the dataset)")
+    parser.add_argument("--dmax", type=float, default=None,
+                        help="maximum of C42a_dat (default: from the dataset)")
+    parser.add_argument("--active", action="store_true", default=False,
+                        help="the model was trained with the active learning data of --lam, read the data range including it")
+    parser.add_argument("--lam", type=float, default=1e-2,
+                        help="lambda of the active learning run the model was trained with")
+    parser.add_argument("--run-root", type=str, default=ACTIVE_ROOT,
+                        help="directory holding the run_lambda* folders")
+
+    return parser.parse_args()
+
+class SurrogateScreen:
+    """
+    Splits requested parameter sets into surrogate answers and simulations.
+
+    A parameter set is answered by the surrogate when the mean over the ring
+    of its epistemic std sqrt(beta / (v * (alpha - 1))), in the scaled [-1, 1]
+    units of the training data, is below the threshold.
+    """
+    def __init__(self, g_model, threshold, dmin, dmax, chunk_size=4096):
+        self.g_model = g_model
+        self.threshold = threshold
+        self.dmin, self.dmax = dmin, dmax
+        self.chunk_size = chunk_size
+
+    def predict(self, params_slice):
+        # de-normalized mu, aleatoric std and epistemic std
+        gamma, sigma, var = [], [], []
+        with torch.no_grad():
+            for start in range(0, params_slice.shape[0], self.chunk_size):
+                fake_data = self.g_model(params_slice[start:start + self.chunk_size])
+                g, v, alpha, beta = torch.chunk(fake_data, 4, dim=1)
+                gamma.append(g[:, 0])
+                sigma.append(torch.sqrt(beta / (alpha - 1 + 1e-6))[:, 0])
+                var.append(acquisition.epistemic_std(fake_data))
+        gamma, sigma, var = torch.cat(gamma), torch.cat(sigma), torch.cat(var)
+        scale = (self.dmax - self.dmin) / 2
+        return ((gamma + 1) * scale) + self.dmin, sigma * scale, var * scale, var.mean(1)
+
+    def screen(self, params_slice, predictions=None):
+        """
+        Args:
+        params_slice (Tensor): requested parameters of shape (N, dsp).
+        predictions (tuple): their predict() output if already known, e.g. from a prediction_store.
+
+        Returns:
+        dict: indices needing simulation, indices answered by the surrogate and
+        the mu, aleatoric std and epistemic std of the answered ones.
+        """
+        mu, sigma, var, uncertainty = predictions if predictions is not None else self.predict(params_slice)
+        answered = (uncertainty < self.threshold).nonzero(as_tuple=True)[0]
+        simulate = (uncertainty >= self.threshold).nonzero(as_tuple=True)[0]
+        return {"simulate": simulate.cpu().numpy(),
+                "answered": answered.cpu().numpy(),
+                "mu": mu[answered].cpu().numpy(),
+                "aleatoric": sigma[answered].cpu().numpy(),
+                "epistemic": var[answered].cpu().numpy()}
+
+def save_answers(path, params, result):
+    # params are the requested rows of the 35 simulator parameters
+    np.savez(path, params=params[result["answered"]], mu=result["mu"],
+             aleatoric=result["aleatoric"], epistemic=result["epistemic"])
+
+def record_round(output_dir, requested, answered, threshold):
+    """
+    Append the simulations avoided in this round to screening_stats.json.
+    """
+    path = os.path.join(output_dir, "screening_stats.json")
+    stats = []
+    if os.path.isfile(path):
+        with open(path) as file:
+            stats = json.load(file)
+    stats.append({"round": len(stats), "requested": int(requested), "answered": int(answered),
+                  "simulated": int(requested - answered), "threshold": threshold})
+    with open(path, 'w') as file:
+        json.dump(stats, file, indent=2)
+    print("=> round {}: {} of {} simulations avoided".format(stats[-1]["round"], answered, requested))
+    return stats[-1]
+
+# the main function
+def main(args):
+    # log hyperparameters
+    print(args)
+
+    # select device
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda:0" if args.cuda else "cpu")
+
+    g_model = Generator(args.dsp, args.dspe, args.ch, 4, dropout=False)
+    print("=> loading checkpoint {}".format(args.resume))
+    checkpoint = torch.load(args.resume, map_location=device)
+    g_model.load_state_dict(checkpoint["g_model_state_dict"])
+    g_model.to(device)
+    g_model.train()
+
+    if args.dmin is None or args.dmax is None:
+        # the range the model's training data was scaled by
+        _, _, _, args.dmin, args.dmax = ReadYeastDataset(args.active, args.lam, args.run_root)
+
+    params = read_data_from_file(args.requests)
+    params_slice = torch.from_numpy(params[:, np.r_[0:25, 32:35]]).float().to(device)
+
+    screen = SurrogateScreen(accel.reduce_precision(g_model, args.precision), args.threshold, args.dmin, args.dmax)
+    result = screen.screen(params_slice)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "list_of_parameters"), 'w') as file:
+        for input in params[result["simulate"]]:
+            input_str = '\t'.join(f"{coord:.6f}" for coord in input)
+            file.write(input_str + '\n')
+    stats = record_round(args.output_dir, params.shape[0], len(result["answered"]), args.threshold)
+    save_answers(os.path.join(args.output_dir, "surrogate_answers_round{}.npz".format(stats["round"])), params, result)
+
+if __name__ == "__main__":
+    main(parse_args())
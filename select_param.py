@@ -16,6 +16,12 @@ import torch.optim as optim
 
 from yeast import *
 from generator import Generator
+import acquisition
+import screening
+import prediction_store
+import accel
+from shared_data import SharedDataset
+import profiler
 
 import pdb
 
@@ -38,6 +44,11 @@ def parse_args():
     parser.add_argument("--ch", type=int, default=4,
                         help="channel multiplier (default: 4)")
     
+    parser.add_argument("--compile", type=str, default="none",
+                        help="execution mode of the model: none, compile (torch.compile) or trace (TorchScript) (default: none)")
+    parser.add_argument("--precision", type=str, default="fp32",
+                        help="inference precision: fp32, int8, bf16 or int8+bf16 (default: fp32)")
+    
     parser.add_argument("--n-candidates", type=int, default=10000,
                         help="number of candidates run for selection")
     parser.add_argument("--k", type=int, default=2400,
@@ -45,9 +56,112 @@ def parse_args():
     
     parser.add_argument("--lam", type=float, default=1e-2,
                         help="l2-norm regularizer to constrain the input search space within a known confinement")
+    parser.add_argument("--lams", type=float, nargs='+', default=[],
+                        help="select for several lambdas in one pass, sharing forward passes and distances (overrides --lam)")
+    parser.add_argument("--active", action="store_true", default=False,
+                        help="measure proximity against the active learning data of --lam as well")
+    parser.add_argument("--run-root", type=str, default=ACTIVE_ROOT,
+                        help="directory holding the run_lambda* folders")
+    parser.add_argument("--data-cache", type=str, default="",
+                        help="attach to the dataset shared by shared_data.SharedDataset at the given path (default: none)")
+    parser.add_argument("--screen-threshold", type=float, default=0.0,
+                        help="answer selected candidates with mean epistemic std below it from the surrogate instead of simulating them (default: 0, disabled)")
+    parser.add_argument("--score-chunk", type=int, default=0,
+                        help="candidates scored at once (default: 0, all)")
+
+    parser.add_argument("--optimize-steps", type=int, default=0,
+                        help="gradient ascent steps refining the candidates before selection (default: 0, disabled)")
+    parser.add_argument("--optimize-lr", type=float, default=1e-2,
+                        help="step size of the acquisition optimizer (default: 1e-2)")
+    parser.add_argument("--repulsion", type=float, default=1.0,
+                        help="weight of the term keeping optimized candidates apart (default: 1.0)")
+    parser.add_argument("--optimize-chunk", type=int, default=0,
+                        help="candidates forwarded at once by the optimizer (default: 0, all)")
+    parser.add_argument("--store", type=str, default="",
+                        help="keep the candidates' predictions in a prediction_store under the given directory and reuse them (default: none)")
+    parser.add_argument("--store-dtype", type=str, default="float32",
+                        help="precision of the stored predictions, float32 or float16 (default: float32)")
+    parser.add_argument("--memory", action="store_true", default=False,
+                        help="report the peak memory and the largest live tensors per phase")
+    parser.add_argument("--memory-top", type=int, default=5,
+                        help="largest live tensors reported per phase (default: 5)")
 
     return parser.parse_args()
 
+def score_candidates(g_model, inputs, chunk_size=0, memory=None):
+    """
+    Epistemic standard deviation of every candidate, forwarded chunk by chunk.
+
+    Each chunk is a "score_chunk" phase of the profiler.MemoryTracker memory.
+    """
+    chunk_size = chunk_size or inputs.shape[0]
+    memory = memory or profiler.MemoryTracker()
+    var = []
+    with torch.no_grad():
+        for start in range(0, inputs.shape[0], chunk_size):
+            with memory.phase("score_chunk"):
+                var.append(acquisition.epistemic_std(g_model(inputs[start:start + chunk_size])))
+    return torch.cat(var, dim=0)
+
+def greedy_select(uncertainty, distances, inputs, lams, k):
+    """
+    Greedy max-score selection run for several lambdas at once.
+
+    Each lambda keeps its own row of nearest-selected distances, so the loops
+    advance together over the shared uncertainty and candidate arrays.
+
+    Args:
+    uncertainty (Tensor): mean epistemic std per candidate, shape (N,).
+    distances (Tensor): distance of each candidate to the training set, shape (N,).
+    inputs (Tensor): candidate parameters of shape (N, dsp).
+    lams (list): coefficients balancing uncertainty and proximity.
+    k (int): number of selected samples per lambda.
+
+    Returns:
+    Tensor: the selected candidate indices of shape (len(lams), k).
+    """
+    lams = torch.tensor(lams, dtype=uncertainty.dtype, device=uncertainty.device).unsqueeze(1)
+    rows = torch.arange(lams.shape[0], device=inputs.device)
+    weighted = lams * uncertainty.unsqueeze(0)
+    distances = distances.unsqueeze(0).repeat(lams.shape[0], 1)
+    selected = torch.zeros_like(distances, dtype=torch.bool)
+    selected_indices = torch.zeros(lams.shape[0], k, dtype=torch.long, device=inputs.device)
+
+    for i in range(k):
+        scores = (weighted + distances).masked_fill(selected, float('-inf'))
+        selected_indices[:, i] = torch.argmax(scores, dim=1)
+        selected[rows, selected_indices[:, i]] = True
+
+        new_point_distances = torch.cdist(inputs[selected_indices[:, i]], inputs)
+        distances = torch.min(distances, new_point_distances)
+
+    return selected_indices
+
+def simulator_rows(selected_inputs_slice):
+    """
+    Complete selected surrogate inputs to the 35 parameters of the simulator.
+
+    The seven parameters dropped from the surrogate input (columns 25:32) are
+    drawn uniformly in [-1, 1].
+    """
+    k = selected_inputs_slice.shape[0]
+    selected_inputs = np.zeros((k, 35))
+    selected_inputs[: ,:25] = selected_inputs_slice[:, :25]
+    selected_inputs[: ,32:] = selected_inputs_slice[:, 25:]
+    selected_inputs[:, 25:32] = np.random.rand(k, 7) * 2 - 1
+    return selected_inputs
+
+def save_parameters(selected_inputs, path):
+    """
+    Write rows of simulator parameters as a list_of_parameters file.
+    """
+     # Open file and save the points
+    with open(path, 'w') as file:
+        for input in selected_inputs:
+            # Create a string for each point, joining coordinates with a space
+            input_str = '\t'.join(f"{coord:.6f}" for coord in input)
+            file.write(input_str + '\n')
+
 # the main function
 def main(args):
     # log hyperparameters
@@ -57,15 +171,19 @@ def main(args):
     args.cuda = not args.no_cuda and torch.cuda.is_available()
     device = torch.device("cuda:0" if args.cuda else "cpu")
 
+    # opt-in, a no-op unless --memory
+    memory = profiler.MemoryTracker(args.memory, device, args.memory_top)
+
     out_features = 4
 
     # set random seed
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
-    g_model = Generator(args.dsp, args.dspe, args.ch, out_features, dropout=False)
+    with memory.phase("model_build"):
+        g_model = Generator(args.dsp, args.dspe, args.ch, out_features, dropout=False)
 
-    g_model.to(device)
+        g_model.to(device)
     criterion = nn.MSELoss()
 
     # load checkpoint
@@ -78,10 +196,18 @@ def main(args):
             print("=> loaded checkpoint {} (epoch {})"
                     .format(args.resume, checkpoint["epoch"]))
             
-    params, C42a_data, sample_weight, _, _ = ReadYeastDataset(active=False)
-    params, C42a_data, sample_weight = torch.from_numpy(params).float().cuda(), torch.from_numpy(C42a_data).float().cuda(), torch.from_numpy(sample_weight).float().cuda()
-    train_split = torch.from_numpy(np.load('train_split.npy'))
-    train_params = params[train_split]
+    with memory.phase("data_load"):
+        if args.data_cache:
+            shared_data = SharedDataset.attach(args.data_cache)
+            params, C42a_data, sample_weight, dmin, dmax, train_split = shared_data.tensors()
+        else:
+            params, C42a_data, sample_weight, dmin, dmax = ReadYeastDataset(args.active, args.lam, args.run_root)
+            params, C42a_data, sample_weight = torch.from_numpy(params).float(), torch.from_numpy(C42a_data).float(), torch.from_numpy(sample_weight).float()
+            train_split = torch.from_numpy(np.load('train_split.npy'))
+        params, C42a_data, sample_weight = params.to(device), C42a_data.to(device), sample_weight.to(device)
+        if args.active:
+            train_split = torch.cat((train_split, torch.ones(params.shape[0] - train_split.shape[0], dtype=torch.bool)), dim=0)
+        train_params = params[train_split]
 
     # Function to randomly initialize input parameters
     def initialize_inputs(num_samples=10):
@@ -90,44 +216,68 @@ def main(args):
     # Randomly initialize input parameters
     inputs = initialize_inputs(args.n_candidates).to(device)
 
-    # udpating params...
     g_model.train()
-    fake_data = g_model(inputs)
-    gamma, v, alpha, beta = torch.chunk(fake_data, 4, dim=1) 
-    sigma = torch.sqrt(beta / (alpha - 1 + 1e-6))[:, 0]    
-    var = torch.sqrt(beta / (v * (alpha - 1 + 1e-6)))[:, 0]
-
-    selected_indices = torch.zeros(args.k, dtype=torch.long)
-    distances = torch.full((args.n_candidates,), float('inf'), dtype=torch.float).to(device)
-
-    for i in range(train_params.shape[0]):
-        exist_param = train_params[i]
-        new_distances = torch.norm(inputs - exist_param, dim=1)
-        distances = torch.min(distances, new_distances)
-
-    for i in range(args.k):
-        scores = args.lam * var.mean(1) + distances 
-        scores[selected_indices[:i]] = float('-inf')
-        selected_indices[i] = torch.argmax(scores).item()
-        
-        new_point_distances = torch.norm(inputs - inputs[selected_indices[i]], dim=1)
-        distances = torch.min(distances, new_point_distances)
-    
-    selected_inputs_slice = inputs[selected_indices]
-    selected_inputs_slice = selected_inputs_slice.cpu().numpy()
+    g_forward = accel.compile_model(g_model, args.compile, inputs[:args.score_chunk or 1024])
 
-    selected_inputs = np.zeros((args.k, 35))
-    selected_inputs[: ,:25] = selected_inputs_slice[:, :25]
-    selected_inputs[: ,32:] = selected_inputs_slice[:, 25:]
-    selected_inputs[:, 25:32] = np.random.rand(args.k, 7) * 2 - 1
+    # refine the candidates by ascending the acquisition
+    if args.optimize_steps > 0:
+        with memory.phase("optimize"):
+            inputs = acquisition.optimize_acquisition(g_forward, inputs, train_params, args.lam,
+                                                      steps=args.optimize_steps, lr=args.optimize_lr,
+                                                      repulsion=args.repulsion,
+                                                      chunk_size=args.optimize_chunk or None,
+                                                      log_every=10)
 
-     # Open file and save the points
-    with open("/fs/ess/PAS0027/yeast_polarization_Neng/run_lambda" + str(int(args.lam)) + "/list_of_parameters", 'w') as file:
-        for input in selected_inputs:
-            # Create a string for each point, joining coordinates with a space
-            input_str = '\t'.join(f"{coord:.6f}" for coord in input)
-            file.write(input_str + '\n')
-    print(f"Selected inputs have been saved to 'list_of_parameters'")
+    # udpating params...
+    g_scorer = g_forward if args.precision == "fp32" else accel.reduce_precision(g_model, args.precision)
+    with memory.phase("score"):
+        if args.store:
+            # mu, aleatoric and epistemic std of every candidate, computed once per model and candidate set
+            scorer = screening.SurrogateScreen(g_scorer, args.screen_threshold, float(dmin), float(dmax))
+
+            def predict(chunk):
+                with memory.phase("score_chunk"):
+                    return dict(zip(prediction_store.FIELDS, scorer.predict(chunk)[:3]))
+            model_key = prediction_store.model_hash(g_model.state_dict(), dmin=float(dmin), dmax=float(dmax), precision=args.precision)
+            store = prediction_store.cached_predictions(args.store, model_key, inputs, predict, args.score_chunk or 4096,
+                                                        dtype=args.store_dtype, dmin=float(dmin), dmax=float(dmax),
+                                                        info={"checkpoint": args.resume, "candidates": "select_param seed {}".format(args.seed)})
+            var = torch.from_numpy(store.scaled("epistemic")).to(device)
+        else:
+            store = None
+            var = score_candidates(g_scorer, inputs, args.score_chunk, memory)
+
+    # distances to the training set are shared by every lambda
+    with memory.phase("distances"):
+        distances = acquisition.min_distances(inputs, train_params)
+
+    lams = args.lams if args.lams else [args.lam]
+    with memory.phase("select"):
+        selected_indices = greedy_select(var.mean(1), distances, inputs, lams, args.k)
+
+    for lam, indices in zip(lams, selected_indices):
+        selected_inputs_slice = inputs[indices]
+        run_dir = os.path.join(args.run_root, "run_lambda" + str(int(lam)))
+        os.makedirs(run_dir, exist_ok=True)
+        # the answers and the simulations share the completed rows
+        selected_inputs = simulator_rows(selected_inputs_slice.cpu().numpy())
+        if args.screen_threshold > 0:
+            predictions = None
+            if store is not None:
+                rows = indices.cpu().numpy()
+                predictions = [torch.from_numpy(np.asarray(store[field][rows], dtype=np.float32)).to(device) for field in prediction_store.FIELDS]
+                predictions.append(torch.from_numpy(store.scaled("epistemic", rows).mean(1)).to(device))
+            result = screening.SurrogateScreen(g_scorer, args.screen_threshold, dmin, dmax).screen(selected_inputs_slice, predictions)
+            stats = screening.record_round(run_dir, args.k, len(result["answered"]), args.screen_threshold)
+            screening.save_answers(os.path.join(run_dir, "surrogate_answers_round{}.npz".format(stats["round"])),
+                                   selected_inputs, result)
+            selected_inputs = selected_inputs[result["simulate"]]
+        path = os.path.join(run_dir, "list_of_parameters")
+        save_parameters(selected_inputs, path)
+        print(f"Selected inputs for lambda {lam} have been saved to '{path}'")
+
+    if args.memory:
+        print(memory.summary())
 
 if __name__ == "__main__":
     main(parse_args())
@@ -3,4 +3,10 @@
 #PBS -l walltime=0:10:00
 #PBS -l nodes=1:ppn=1:gpus=1
 
-python -u select_param.py --seed 1 --dsp 28 --n-candidates 480000 --resume models/model_Evidential_600.pth.tar --lam 25
\ No newline at end of file
+python -u select_param.py --seed 1 --dsp 28 --n-candidates 480000 --resume models/model_Evidential_600.pth.tar --lam 25
+# python -u select_param.py --seed 1 --dsp 28 --n-candidates 10000 --optimize-steps 100 --resume models/model_Evidential_600.pth.tar --lam 25
+# python -u select_param.py --seed 1 --dsp 28 --n-candidates 480000 --resume models/model_Evidential_600.pth.tar --lams 0 25 50 100
+# python -u select_param.py --seed 1 --dsp 28 --n-candidates 480000 --resume models/model_Evidential_600.pth.tar --lam 25 --screen-threshold 0.05
+# python -u screening.py --dsp 28 --resume models/model_Evidential_600.pth.tar --requests requested_parameters --output-dir run_requests --threshold 0.05
+# python -u precision_guard.py --dsp 28 --resume models/model_Evidential_600.pth.tar
+# python -u select_param.py --seed 1 --dsp 28 --n-candidates 480000 --resume models/model_Evidential_600.pth.tar --lam 25 --precision int8
@@ -0,0 +1,153 @@
+# dataset tensors shared zero-copy by the processes of a node
+
+import os
+import json
+import fcntl
+import atexit
+import shutil
+import argparse
+import warnings
+
+import numpy as np
+
+import torch
+
+from yeast import ReadYeastDataset, ACTIVE_ROOT
+
+import pdb
+
+SHM_ROOT = "/dev/shm"
+FIELDS = ("params", "C42a_data", "sample_weight", "train_split")
+
+class SharedDataset:
+    """
+    Handle on a dataset stored once per node as memory-mapped .npy files.
+
+    create() writes params, C42a_data, sample_weight (as float32) and the
+    train_split index into a directory, by default on the /dev/shm tmpfs,
+    i.e. POSIX shared memory. attach() maps the files read-only, so every
+    process on the node reads the same physical pages. A dataset created
+    persistent stays until remove() deletes it, e.g. one written ahead of
+    the runs attaching with --data-cache. Otherwise it belongs to the
+    process that created it: each handle holds a reference in the
+    directory's refcount file and the directory is removed when the last
+    handle is closed, by close(), the context manager or at interpreter exit.
+
+    Args:
+    path (str): directory of the shared dataset.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as file:
+            meta = json.load(file)
+        self.dmin, self.dmax = meta["dmin"], meta["dmax"]
+        self.persistent = meta.get("persistent", False)
+        self.arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in FIELDS}
+        self.closed = False
+        if not self.persistent:
+            self._update_refcount(1)
+            atexit.register(self.close)
+
+    @classmethod
+    def create(cls, path, params, C42a_data, sample_weight, dmin, dmax, train_split, persistent=False):
+        """
+        Write a dataset to path and return the creator's handle on it.
+
+        The arguments are those returned by ReadYeastDataset plus the
+        boolean train_split index. A persistent dataset is not removed when
+        its handles are closed, only by remove().
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = (params.astype(np.float32), C42a_data.astype(np.float32),
+                  sample_weight.astype(np.float32), np.asarray(train_split, dtype=bool))
+        for name, array in zip(FIELDS, arrays):
+            np.save(os.path.join(path, name + ".npy"), array)
+        with open(os.path.join(path, "refcount"), 'w') as file:
+            file.write("0")
+        with open(os.path.join(path, "meta.json"), 'w') as file:
+            json.dump({"dmin": float(dmin), "dmax": float(dmax), "rows": int(params.shape[0]), "persistent": persistent}, file)
+        return cls(path)
+
+    @staticmethod
+    def remove(path):
+        # delete a shared dataset, persistent or not; processes still mapping it keep their pages
+        shutil.rmtree(path, ignore_errors=True)
+
+    @classmethod
+    def attach(cls, path):
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            raise FileNotFoundError("no shared dataset at {}".format(path))
+        return cls(path)
+
+    def _update_refcount(self, delta):
+        # returns the count after the update, under an exclusive lock
+        with open(os.path.join(self.path, "refcount"), 'r+') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            count = int(file.read() or 0) + delta
+            file.seek(0)
+            file.truncate()
+            file.write(str(count))
+            file.flush()
+            fcntl.flock(file, fcntl.LOCK_UN)
+        return count
+
+    def tensors(self):
+        """
+        The shared arrays as read-only torch tensors, without copying.
+
+        Returns:
+        tuple: params, C42a_data, sample_weight, dmin, dmax like
+            ReadYeastDataset, with float32 tensors, and the bool train_split.
+        """
+        with warnings.catch_warnings():
+            # the tensors map read-only pages, writing to them raises
+            warnings.simplefilter("ignore")
+            params, C42a_data, sample_weight, train_split = [torch.from_numpy(self.arrays[name]) for name in FIELDS]
+        return params, C42a_data, sample_weight, self.dmin, self.dmax, train_split
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.arrays = None
+        if not self.persistent and self._update_refcount(-1) <= 0:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Shared Dataset")
+
+    parser.add_argument("command", type=str, choices=["create", "remove"],
+                        help="write a persistent shared dataset, or remove one")
+    parser.add_argument("path", type=str,
+                        help="directory of the shared dataset, e.g. /dev/shm/yeast")
+    parser.add_argument("--active", action="store_true", default=False,
+                        help="include the active learning data of --lam")
+    parser.add_argument("--lam", type=float, default=100.0,
+                        help="active learning lambda parameter")
+    parser.add_argument("--run-root", type=str, default=ACTIVE_ROOT,
+                        help="directory holding the run_lambda* folders")
+    parser.add_argument("--split", type=str, default="train_split.npy",
+                        help="train split index (default: train_split.npy)")
+
+    return parser.parse_args()
+
+# the main function
+def main(args):
+    if args.command == "remove":
+        SharedDataset.remove(args.path)
+        print("=> removed {}".format(args.path))
+        return
+    shared_data = SharedDataset.create(args.path, *ReadYeastDataset(args.active, args.lam, args.run_root),
+                                       train_split=np.load(args.split), persistent=True)
+    print("=> {} rows shared in {}, attach with --data-cache {}".format(shared_data.arrays["params"].shape[0], args.path, args.path))
+    shared_data.close()
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,240 @@
+# hyperparameter sweep of train.py with asynchronous successive halving (ASHA)
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import random
+import argparse
+import itertools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from yeast import *
+from shared_data import SharedDataset, SHM_ROOT
+import metrics
+
+import pdb
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train.py")
+
+# parse arguments
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hyperparameter Sweep")
+
+    parser.add_argument("--space", type=str, required=True,
+                        help="JSON file mapping train.py options to lists of values, e.g. {\"lr\": [1e-4, 5e-4], \"dropout\": [false, true]}")
+    parser.add_argument("--samples", type=int, default=0,
+                        help="number of configurations drawn from the grid (default: 0, the full grid)")
+    parser.add_argument("--fixed", type=str, default="--dsp 28 --log-every 1000000",
+                        help="options passed to every trial (default: --dsp 28 --log-every 1000000)")
+    parser.add_argument("--output", type=str, default="sweep",
+                        help="directory of the trials and the results table (default: sweep)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="trials trained concurrently (default: 4)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="torch threads per trial (default: 0, cores / workers)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the configuration sampling (default: 0)")
+
+    parser.add_argument("--min-epochs", type=int, default=50,
+                        help="epochs of the first rung (default: 50)")
+    parser.add_argument("--max-epochs", type=int, default=1350,
+                        help="epochs of the last rung (default: 1350)")
+    parser.add_argument("--eta", type=int, default=3,
+                        help="reduction factor, the top 1/eta of a rung is promoted (default: 3)")
+
+    parser.add_argument("--active", action="store_true", default=False,
+                        help="active learning version")
+    parser.add_argument("--lam", type=float, default=100.0,
+                        help="active learning lambda parameter")
+    parser.add_argument("--run-root", type=str, default=ACTIVE_ROOT,
+                        help="directory holding the run_lambda* folders")
+    parser.add_argument("--cache-dir", type=str, default="",
+                        help="shared dataset of the trials, removed after the sweep (default: /dev/shm/yeast_sweep_PID)")
+
+    return parser.parse_args()
+
+def configurations(space, samples=0, seed=0):
+    # the grid of a search space, or samples configurations drawn from it
+    keys = sorted(space)
+    grid = [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+    if samples and samples < len(grid):
+        grid = random.Random(seed).sample(grid, samples)
+    return grid
+
+def config_args(config):
+    # train.py options of a configuration, booleans become store_true flags
+    argv = []
+    for key, value in sorted(config.items()):
+        flag = "--" + key.replace("_", "-")
+        if isinstance(value, bool):
+            if value:
+                argv.append(flag)
+        else:
+            argv += [flag, str(value)]
+    return argv
+
+def rung_epochs(min_epochs, max_epochs, eta):
+    rungs = [min_epochs]
+    while rungs[-1] * eta <= max_epochs:
+        rungs.append(rungs[-1] * eta)
+    return rungs
+
+class ASHA:
+    """
+    Asynchronous successive halving over a fixed list of trials.
+
+    A free worker promotes a trial to the next rung if it is in the top
+    1/eta of the trials that finished its current rung, otherwise it starts
+    the next new trial. Lower metrics are better; trials are compared on the
+    test MSE, the one metric train.py reports the same way for every loss.
+    """
+    def __init__(self, n_trials, rungs, eta):
+        self.rungs = rungs
+        self.eta = eta
+        self.pending = list(range(n_trials))
+        self.results = [dict() for _ in rungs]
+        self.promoted = [set() for _ in rungs]
+
+    def next_job(self):
+        # (trial, rung) to run next, or None if nothing can run now
+        for k in reversed(range(len(self.rungs) - 1)):
+            done = sorted(self.results[k].items(), key=lambda item: item[1])
+            for trial, _ in done[:len(done) // self.eta]:
+                if trial not in self.promoted[k]:
+                    self.promoted[k].add(trial)
+                    return trial, k + 1
+        if self.pending:
+            return self.pending.pop(0), 0
+        return None
+
+    def report(self, trial, rung, metric):
+        self.results[rung][trial] = metric
+
+def run_trial(trial_dir, argv, epochs, resume, threads, log_path):
+    """
+    Train one trial up to epochs, resuming from its previous rung.
+
+    Returns:
+    str: path of the trial's checkpoint at epochs, or None if training failed.
+    """
+    cmd = [sys.executable, "-u", TRAIN_SCRIPT] + argv + ["--epochs", str(epochs), "--check-every", str(epochs),
+                                                        "--metrics", "metrics.jsonl"]
+    if resume:
+        cmd += ["--resume", resume]
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+    with open(log_path, 'a') as log:
+        code = subprocess.call(cmd, cwd=trial_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    paths = glob.glob(os.path.join(trial_dir, "models", "*_{}.pth.tar".format(epochs)))
+    if code != 0 or not paths:
+        return None
+    return paths[0]
+
+def write_results(path, trials):
+    # ranked by the best test MSE, then by training cost; the NLL of the trial's own loss
+    # (the test MSE for the MSE loss) is not comparable across losses
+    ranked = sorted(trials, key=lambda t: (t["mse"] is None, t["mse"], t["train_time"]))
+    keys = sorted({k for t in trials for k in t["config"]})
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["rank", "trial"] + keys + ["epochs", "best_mse", "last_mse", "loss_nll", "train_time", "wall_time"])
+        for i, t in enumerate(ranked):
+            writer.writerow([i + 1, t["trial"]] + [t["config"].get(k, "") for k in keys]
+                            + [t["epochs"], t["mse"], t["last_mse"], t["nll"], round(t["train_time"], 1), round(t["wall_time"], 1)])
+    return ranked
+
+# the main function
+def main(args):
+    # log hyperparameters
+    print(args)
+
+    with open(args.space) as file:
+        space = json.load(file)
+    configs = configurations(space, args.samples, args.seed)
+    rungs = rung_epochs(args.min_epochs, args.max_epochs, args.eta)
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    print("=> {} trials, rungs at epochs {}, {} workers with {} threads".format(len(configs), rungs, args.workers, threads))
+
+    # one copy of the dataset in shared memory for all trials, held until the sweep ends
+    cache_dir = os.path.abspath(args.cache_dir or os.path.join(SHM_ROOT, "yeast_sweep_{}".format(os.getpid())))
+    print("=> sharing the dataset in {}".format(cache_dir))
+    shared_data = SharedDataset.create(cache_dir, *ReadYeastDataset(args.active, args.lam, args.run_root),
+                                       train_split=np.load("train_split.npy"))
+    fixed = args.fixed.split() + ["--data-cache", cache_dir]
+    if args.active:
+        fixed += ["--active", "--lam", str(args.lam)]
+
+    os.makedirs(args.output, exist_ok=True)
+    split = os.path.abspath("train_split.npy")
+    trials = []
+    for i, config in enumerate(configs):
+        trial_dir = os.path.join(args.output, "trial{}".format(i))
+        os.makedirs(os.path.join(trial_dir, "models"), exist_ok=True)
+        if not os.path.exists(os.path.join(trial_dir, "train_split.npy")):
+            os.symlink(split, os.path.join(trial_dir, "train_split.npy"))
+        trials.append({"trial": i, "config": config, "dir": trial_dir, "checkpoint": None,
+                       "epochs": 0, "mse": None, "last_mse": None, "nll": None, "train_time": 0., "wall_time": 0.})
+    with open(os.path.join(args.output, "space.json"), 'w') as file:
+        json.dump({"space": space, "rungs": rungs, "eta": args.eta, "fixed": fixed}, file, indent=2)
+
+    scheduler = ASHA(len(trials), rungs, args.eta)
+
+    def job(trial, rung):
+        t = trials[trial]
+        start = time.time()
+        path = run_trial(t["dir"], config_args(t["config"]) + fixed, rungs[rung], t["checkpoint"],
+                         threads, os.path.join(t["dir"], "train.log"))
+        return trial, rung, path, time.time() - start
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        running = set()
+        while True:
+            while len(running) < args.workers:
+                next_job = scheduler.next_job()
+                if next_job is None:
+                    break
+                running.add(executor.submit(job, *next_job))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                trial, rung, path, elapsed = future.result()
+                t = trials[trial]
+                t["wall_time"] += elapsed
+                if path is None:
+                    print("=> trial {} failed at rung {}, see {}".format(trial, rung, os.path.join(t["dir"], "train.log")))
+                    continue
+                # the trial's metrics stream, across all of its rungs
+                records, _ = metrics.read(os.path.join(t["dir"], "metrics.jsonl"))
+                t["checkpoint"] = os.path.abspath(path)
+                t["epochs"] = rungs[rung]
+                if metrics.best(records, "test_mse") is None:
+                    # e.g. an --eval-every beyond the rung's epochs, the trial stays unscored and is not promoted
+                    print("=> trial {} wrote no evaluation by epoch {}, unscored".format(trial, t["epochs"]))
+                    continue
+                t["mse"] = metrics.best(records, "test_mse")["test_mse"]
+                t["last_mse"] = metrics.last(records, "test_mse")["test_mse"]
+                t["nll"] = (metrics.best(records, "test_nll") or {}).get("test_nll")
+                t["train_time"] = (metrics.last(records, "train_time") or {}).get("train_time", t["train_time"])
+                scheduler.report(trial, rung, t["mse"])
+                print("=> trial {} {} finished {} epochs: MSE {:.6f}".format(trial, t["config"], t["epochs"], t["mse"]))
+            write_results(os.path.join(args.output, "results.csv"), trials)
+
+    ranked = write_results(os.path.join(args.output, "results.csv"), trials)
+    print("{:>5} {:>6} {:>8} {:>10} {:>10} {:>10}  {}".format("rank", "trial", "epochs", "best MSE", "loss NLL", "time (s)", "config"))
+    for i, t in enumerate(ranked):
+        print("{:>5} {:>6} {:>8} {:>10} {:>10} {:>10.1f}  {}".format(
+            i + 1, t["trial"], t["epochs"], "-" if t["mse"] is None else "{:.6f}".format(t["mse"]),
+            "-" if t["nll"] is None else "{:.6f}".format(t["nll"]), t["train_time"], t["config"]))
+    print("=> results written to {}".format(os.path.join(args.output, "results.csv")))
+    shared_data.close()
+
+if __name__ == "__main__":
+    main(parse_args())
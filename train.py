@@ -5,6 +5,7 @@ from __future__ import absolute_import, division, print_function
 import os
 import argparse
 import math
+import time
 
 import numpy as np
 from tqdm import tqdm
@@ -17,6 +18,13 @@ import torch.optim as optim
 from yeast import *
 from generator import Generator
 import loss_helper
+import accel
+import checkpoint as ckpt
+import distributed
+from shared_data import SharedDataset
+import profiler
+import metrics
+import utils
 
 import pdb
 
@@ -27,7 +35,7 @@ def parse_args():
     parser.add_argument("--no-cuda", action="store_true", default=False,
                         help="disables CUDA training")
     parser.add_argument("--data-parallel", action="store_true", default=False,
-                        help="enable data parallelism")
+                        help="enable multi-process data parallelism on CPU, run through launch.py or torchrun")
     parser.add_argument("--seed", type=int, default=1,
                         help="random seed (default: 1)")
 
@@ -47,6 +55,10 @@ def parse_args():
                         help="active learning version")
     parser.add_argument("--lam", type=float, default=100.0,
                         help="active learning lambda parameter")
+    parser.add_argument("--run-root", type=str, default=ACTIVE_ROOT,
+                        help="directory holding the run_lambda* folders")
+    parser.add_argument("--data-cache", type=str, default="",
+                        help="attach to the dataset shared by shared_data.SharedDataset at the given path (default: none)")
 
     parser.add_argument("--lr", type=float, default=1e-3,
                         help="learning rate (default: 1e-3)")
@@ -54,21 +66,74 @@ def parse_args():
                         help="loss function for training (default: MSE)")
     parser.add_argument("--dropout", action="store_true", default=False,
                         help="using dropout layer after convolution")
+    parser.add_argument("--compile", type=str, default="none",
+                        help="execution mode of the model: none, compile (torch.compile) or trace (TorchScript) (default: none)")
+    parser.add_argument("--amp", type=str, default="none",
+                        help="mixed precision training: none, bf16 or fp16 (default: none)")
+    parser.add_argument("--coeff", type=float, default=1e-2,
+                        help="weight of the evidence regularizer in the evidential loss (default: 1e-2)")
+    parser.add_argument("--fused-loss", action="store_true", default=False,
+                        help="use the fused evidential loss with analytic backward")
     parser.add_argument("--beta1", type=float, default=0.9,
                         help="beta1 of Adam (default: 0.9)")
     parser.add_argument("--beta2", type=float, default=0.999,
                         help="beta2 of Adam (default: 0.999)")
     parser.add_argument("--batch-size", type=int, default=32,
                         help="batch size for training (default: 32)")
+    parser.add_argument("--scale-lr", action="store_true", default=False,
+                        help="scale the learning rate linearly with batch-size / base-batch-size")
+    parser.add_argument("--base-batch-size", type=int, default=32,
+                        help="batch size the learning rate is tuned for (default: 32)")
+    parser.add_argument("--warmup-epochs", type=int, default=0,
+                        help="epochs of linear learning rate warmup (default: 0)")
+    parser.add_argument("--lr-schedule", type=str, default="constant",
+                        help="learning rate schedule after warmup: constant, cosine or step (default: constant)")
+    parser.add_argument("--lr-step", type=int, default=1000,
+                        help="epochs between learning rate decays of the step schedule (default: 1000)")
+    parser.add_argument("--lr-gamma", type=float, default=0.5,
+                        help="learning rate decay factor of the step schedule (default: 0.5)")
     parser.add_argument("--start-epoch", type=int, default=0,
                         help="start epoch number (default: 0)")
     parser.add_argument("--epochs", type=int, default=50000,
                         help="number of epochs to train")
 
+    parser.add_argument("--finetune", type=str, default="",
+                        help="warm-start from the model of a previous round's checkpoint (default: none)")
+    parser.add_argument("--freeze-sparams", action="store_true", default=False,
+                        help="keep the simulation parameters subnet fixed while fine-tuning")
+    parser.add_argument("--replay-ratio", type=float, default=0.0,
+                        help="fraction of each batch drawn from the rows added since the fine-tuned checkpoint (default: 0)")
+    parser.add_argument("--replay-epochs", type=int, default=0,
+                        help="epochs over which the replay ratio decays linearly to zero (default: 0, constant)")
+    parser.add_argument("--patience", type=int, default=0,
+                        help="stop after the given number of epochs without test NLL improvement (default: 0, disabled)")
+    parser.add_argument("--min-delta", type=float, default=1e-4,
+                        help="smallest test NLL decrease counted as an improvement (default: 1e-4)")
+    parser.add_argument("--save-best", action="store_true", default=False,
+                        help="keep a rolling checkpoint of the epoch with the best test NLL")
+    parser.add_argument("--keep-checkpoints", type=int, default=0,
+                        help="number of latest periodic checkpoints to keep (default: 0, all)")
+
     parser.add_argument("--log-every", type=int, default=40,
                         help="log training status every given number of batches")
     parser.add_argument("--check-every", type=int, default=200,
                         help="save checkpoint every given number of epochs")
+    parser.add_argument("--eval-every", type=int, default=1,
+                        help="evaluate on the test set every given number of epochs (default: 1)")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="time the training phases and report them with the log")
+    parser.add_argument("--profile-steps", type=str, default="",
+                        help="capture torch.profiler over the training steps START:END (default: none)")
+    parser.add_argument("--profile-dir", type=str, default="profile",
+                        help="directory of the torch.profiler traces (default: profile)")
+    parser.add_argument("--memory", action="store_true", default=False,
+                        help="report the peak memory and the largest live tensors per phase")
+    parser.add_argument("--memory-top", type=int, default=5,
+                        help="largest live tensors reported per phase (default: 5)")
+    parser.add_argument("--metrics", type=str, default="",
+                        help="append-only metrics file of the run (default: models/NETWORK_metrics.jsonl)")
+    parser.add_argument("--metrics-every", type=int, default=0,
+                        help="also record the loss of every given number of steps as step_loss (default: 0, epoch means only)")
 
     return parser.parse_args()
 
@@ -77,10 +142,18 @@ def main(args):
     # log hyperparameters
     print(args)
 
+    # join the process group, the gloo backend trains on CPU
+    rank, world_size = distributed.init_distributed() if args.data_parallel else (0, 1)
+    if args.batch_size % world_size != 0:
+        raise ValueError("batch size {} is not divisible by {} processes".format(args.batch_size, world_size))
+
     # select device
-    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    args.cuda = not args.no_cuda and torch.cuda.is_available() and world_size == 1
     device = torch.device("cuda:0" if args.cuda else "cpu")
 
+    # opt-in, a no-op unless --memory
+    memory = profiler.MemoryTracker(args.memory, device, args.memory_top)
+
     if args.loss == 'Evidential':
         out_features = 4
     elif args.loss == 'Gaussian':
@@ -93,10 +166,15 @@ def main(args):
         network_str += "_dp" 
     if args.active: 
         network_str += "_active" + str(int(args.lam)) 
+    if args.finetune:
+        network_str += "_ft"
 
     # set random seed
+    # batches are drawn from a generator seeded alike on all ranks, dropout from per-rank seeds
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+    torch.manual_seed(args.seed + rank)
+    sample_gen = torch.Generator(device=device)
+    sample_gen.manual_seed(args.seed)
 
     # model
     def weights_init(m):
@@ -118,14 +196,31 @@ def main(args):
             return m
 
     g_model = Generator(args.dsp, args.dspe, args.ch, out_features, dropout=args.dropout)
-    print(g_model)
+    if rank == 0:
+        print(g_model)
     # g_model.apply(weights_init)
     # if args.sn:
     #     g_model = add_sn(g_model)
 
     g_model.to(device)
+
+    # warm start from the previous round
+    base_rows = None
+    if args.finetune:
+        print("=> fine-tuning from checkpoint {}".format(args.finetune))
+        checkpoint = torch.load(args.finetune, map_location=device)
+        g_model.load_state_dict(checkpoint["g_model_state_dict"])
+        base_rows = checkpoint.get("n_rows")
+        if args.freeze_sparams:
+            for p in g_model.sparams_subnet.parameters():
+                p.requires_grad_(False)
+
     if args.loss == 'Evidential':
         print('Use Evidential Loss')
+        if args.fused_loss:
+            evidential_loss = loss_helper.FusedEvidentialRegression
+        else:
+            evidential_loss = loss_helper.EvidentialRegression
     elif args.loss == 'Gaussian':
         print('Use Gaussian Loss')
     elif args.loss == 'MSE':
@@ -134,13 +229,23 @@ def main(args):
     elif args.loss == 'L1':
         print('Use L1 Loss')
         criterion = nn.L1Loss()
-    train_losses, test_losses = [], []
+    train_losses, test_losses, test_epochs, test_mses = [], [], [], []
+    train_time = 0.
+
+    # large batches take proportionally larger steps
+    if args.scale_lr:
+        args.lr = args.lr * args.batch_size / args.base_batch_size
+        print("=> learning rate scaled to {:.3e} for batch size {}".format(args.lr, args.batch_size))
 
     # optimizer
-    g_optimizer = optim.Adam(g_model.parameters(), lr=args.lr,
+    g_optimizer = optim.Adam([p for p in g_model.parameters() if p.requires_grad], lr=args.lr,
         betas=(args.beta1, args.beta2))
 
+    # stop once the test NLL (MSE for the deterministic losses) has plateaued
+    early_stopping = ckpt.EarlyStopping(args.patience, args.min_delta)
+
     # load checkpoint
+    resume_rng = None
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint {}".format(args.resume))
@@ -148,96 +253,272 @@ def main(args):
             args.start_epoch = checkpoint["epoch"]
             g_model.load_state_dict(checkpoint["g_model_state_dict"])
             g_optimizer.load_state_dict(checkpoint["g_optimizer_state_dict"])
-            train_losses = checkpoint["train_losses"]
-            test_losses = checkpoint["test_losses"]
+            train_losses = [float(x) for x in checkpoint["train_losses"]]
+            test_losses = [float(x) for x in checkpoint["test_losses"]]
+            test_epochs = [int(x) for x in checkpoint.get("test_epochs", range(1, len(test_losses) + 1))]
+            test_mses = [float(x) for x in checkpoint.get("test_mses", [])]
+            resume_rng = checkpoint.get("rng_state")
+            if checkpoint.get("sampler_state") is not None:
+                sample_gen.set_state(checkpoint["sampler_state"])
+            train_time = checkpoint.get("train_time", 0.)
+            if checkpoint.get("early_stopping"):
+                early_stopping.load_state_dict(checkpoint["early_stopping"])
             print("=> loaded checkpoint {} (epoch {})"
                 .format(args.resume, checkpoint["epoch"]))
             
-    params, C42a_data, sample_weight, _, _ = ReadYeastDataset(args.active, args.lam)
-    params, C42a_data, sample_weight = torch.from_numpy(params).float().cuda(), torch.from_numpy(C42a_data).float().cuda(), torch.from_numpy(sample_weight).float().cuda()
-    train_split = torch.from_numpy(np.load('train_split.npy'))
-    if args.active:
-        train_split = torch.cat((train_split, torch.ones(params.shape[0] - train_split.shape[0], dtype=torch.bool)), dim=0)
-    train_params, train_C42a_data, train_sample_weight = params[train_split], C42a_data[train_split], sample_weight[train_split]
-    test_params, test_C42a_data = params[~train_split], C42a_data[~train_split]
-    len_train = train_params.shape[0]
+    with memory.phase("data_load"):
+        if args.data_cache:
+            # zero-copy on CPU, the training batches are gathered from the shared rows
+            shared_data = SharedDataset.attach(args.data_cache)
+            params, C42a_data, sample_weight, _, dmax, train_split = shared_data.tensors()
+        else:
+            params, C42a_data, sample_weight, _, dmax = ReadYeastDataset(args.active, args.lam, args.run_root)
+            params, C42a_data, sample_weight = torch.from_numpy(params).float(), torch.from_numpy(C42a_data).float(), torch.from_numpy(sample_weight).float()
+            train_split = torch.from_numpy(np.load('train_split.npy'))
+        params, C42a_data, sample_weight = params.to(device), C42a_data.to(device), sample_weight.to(device)
+        base_split_rows = train_split.shape[0]
+        if args.active:
+            train_split = torch.cat((train_split, torch.ones(params.shape[0] - train_split.shape[0], dtype=torch.bool)), dim=0)
+        train_rows = torch.nonzero(train_split).flatten().to(device)
+        train_sample_weight = sample_weight[train_rows]
+        test_params, test_C42a_data = params[~train_split], C42a_data[~train_split]
+    len_train = train_rows.shape[0]
+    g_forward = g_model
+    if args.amp != "none":
+        print("=> {} mixed precision training".format(args.amp))
+        g_forward = accel.AutocastFeatures(g_model, device.type, accel.AMP_DTYPES[args.amp])
+    g_forward = accel.compile_model(g_forward, args.compile, params[train_rows[:args.batch_size]])
+    # gradients are all-reduced by the training forward, evaluation needs no communication
+    g_eval = g_forward
+    g_forward = distributed.wrap_model(g_forward)
+    # fp16 gradients underflow without loss scaling, bf16 has the range of fp32
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp == "fp16")
+    if args.resume and os.path.isfile(args.resume) and checkpoint.get("scaler_state_dict"):
+        scaler.load_state_dict(checkpoint["scaler_state_dict"])
     num_batches = (len_train - 1) // args.batch_size + 1
 
+    # rows ingested since the fine-tuned checkpoint sit at the end of the training set
+    if base_rows is None:
+        base_rows = base_split_rows
+    n_new = params.shape[0] - base_rows
+    if args.finetune:
+        print("=> {} rows added since the fine-tuned checkpoint".format(n_new))
+
+    def sample_batch(epoch):
+        ratio = args.replay_ratio if args.finetune and n_new > 0 else 0.
+        if ratio > 0 and args.replay_epochs > 0:
+            ratio *= max(0., 1. - (epoch - args.start_epoch) / args.replay_epochs)
+        n_replay = int(round(args.batch_size * ratio))
+        if n_replay == 0:
+            return torch.multinomial(train_sample_weight.flatten(), args.batch_size, replacement=True, generator=sample_gen)
+        new_rndidx = torch.multinomial(train_sample_weight.flatten()[-n_new:], n_replay, replacement=True, generator=sample_gen) + len_train - n_new
+        if n_replay == args.batch_size:
+            return new_rndidx
+        old_rndidx = torch.multinomial(train_sample_weight.flatten(), args.batch_size - n_replay, replacement=True, generator=sample_gen)
+        return torch.cat((old_rndidx, new_rndidx), dim=0)
+
+    def learning_rate(step):
+        # linear warmup, then the schedule over the remaining epochs
+        warmup_steps = args.warmup_epochs * num_batches
+        if step < warmup_steps:
+            return args.lr * (step + 1) / warmup_steps
+        epoch = step // num_batches
+        if args.lr_schedule == "cosine":
+            progress = (epoch - args.warmup_epochs) / max(1, args.epochs - args.warmup_epochs)
+            return args.lr * 0.5 * (1. + math.cos(math.pi * min(1., progress)))
+        elif args.lr_schedule == "step":
+            return args.lr * args.lr_gamma ** ((epoch - args.warmup_epochs) // args.lr_step)
+        return args.lr
+
+    # indexed by ckpt.CheckpointRegistry
+    meta = {"run": network_str, "model": "Generator", "loss": args.loss, "seed": args.seed, "dropout": args.dropout,
+            "active": args.active, "lam": float(args.lam) if args.active else None, "finetune": bool(args.finetune),
+            "dsp": args.dsp, "dspe": args.dspe, "ch": args.ch}
+
+    def checkpoint_state(epoch):
+        return {"epoch": epoch + 1,
+                "g_model_state_dict": g_model.state_dict(),
+                "g_optimizer_state_dict": g_optimizer.state_dict(),
+                "scaler_state_dict": scaler.state_dict(),
+                "train_losses": ckpt.compact_losses(train_losses),
+                "test_losses": ckpt.compact_losses(test_losses),
+                "test_epochs": torch.tensor(test_epochs, dtype=torch.int64),
+                "test_mses": ckpt.compact_losses(test_mses),
+                "train_time": train_time,
+                "n_rows": params.shape[0],
+                "early_stopping": early_stopping.state_dict(),
+                "rng_state": ckpt.rng_state(),
+                "sampler_state": sample_gen.get_state(),
+                "meta": meta}
+
+    # checkpoints are written on a background thread of rank 0
+    writer = ckpt.CheckpointWriter("models", network_str, keep=args.keep_checkpoints) if rank == 0 else None
+
+    def save_checkpoint(epoch):
+        if writer is None:
+            return
+        print("=> saving checkpoint at epoch {}".format(epoch))
+        writer.save(checkpoint_state(epoch), epoch=epoch + 1)
+
+    # the test split is sharded across ranks and its metrics reduced
+    test_params, test_C42a_data = distributed.shard(test_params, rank, world_size), distributed.shard(test_C42a_data, rank, world_size)
+
+    # opt-in instrumentation, no-ops when disabled
+    timer = profiler.PhaseTimer(args.profile, device)
+    window = profiler.ProfileWindow(profiler.parse_steps(args.profile_steps), args.profile_dir, network_str)
+    # structured records of the run, written by rank 0
+    metrics_log = metrics.MetricsWriter((args.metrics or os.path.join("models", network_str + "_metrics.jsonl")) if rank == 0 else "")
+    # the calibration error takes 40 icdf passes per evaluation, only recorded with an explicit --metrics
+    # (the same on every rank, its mean is reduced across them)
+    log_calibration = bool(args.metrics)
+
+    last_eval = args.start_epoch
+    if resume_rng is not None:
+        # the saved RNG state is rank 0's, the other ranks keep distinct dropout streams
+        ckpt.set_rng_state(resume_rng)
+        if rank > 0:
+            torch.manual_seed(args.seed + rank + args.start_epoch * world_size)
+
     # main loop
     for epoch in range(args.start_epoch, args.epochs):
+        epoch_start = time.time()
         # training...
         g_model.train()
         train_loss = 0.
         train_mse = 0.
 
-        for _ in range(num_batches): 
-            e_rndidx = torch.multinomial(train_sample_weight.flatten(), args.batch_size, replacement=True)
-            sub_params = train_params[e_rndidx]
-            sub_data = train_C42a_data[e_rndidx]
+        for i in range(num_batches): 
+            window.step()
+            step = epoch * num_batches + i
+            for group in g_optimizer.param_groups:
+                group["lr"] = learning_rate(step)
+            with timer.phase("sample"):
+                e_rndidx = distributed.shard(sample_batch(epoch), rank, world_size)
+            with timer.phase("gather"):
+                sub_params = params[train_rows[e_rndidx]]
+                sub_data = C42a_data[train_rows[e_rndidx]]
 
             g_optimizer.zero_grad()
-            fake_data = g_model(sub_params)
-
-            if args.loss == 'Evidential':
-                sub_data = sub_data.unsqueeze(1)
-                loss = loss_helper.EvidentialRegression(sub_data, fake_data, coeff=1e-2)
-                gamma, _, _, _ = torch.chunk(fake_data, out_features, dim=1) 
-                mse = torch.mean((gamma - sub_data) ** 2)
-            elif args.loss == 'Gaussian':
-                sub_data = sub_data.unsqueeze(1)
-                mu, sigma = fake_data.chunk(2, dim=1)
-                loss = loss_helper.Gaussian_NLL(sub_data, mu, sigma)
-                mse = torch.mean((mu - sub_data) ** 2)
-            else:
-                fake_data = fake_data[:, 0]
-                loss = criterion(sub_data, fake_data)
-                mse = torch.mean((fake_data - sub_data) ** 2)
-
-            loss.backward()
-            g_optimizer.step()
-            train_loss += loss.item()
-            train_mse += mse.item()
-
-
-        if (epoch + 1) % args.log_every == 0:
+            with timer.phase("forward"), memory.phase("forward"):
+                fake_data = g_forward(sub_params)
+
+            with timer.phase("loss"):
+                if args.loss == 'Evidential':
+                    sub_data = sub_data.unsqueeze(1)
+                    loss = evidential_loss(sub_data, fake_data, coeff=args.coeff)
+                    gamma, _, _, _ = torch.chunk(fake_data, out_features, dim=1) 
+                    mse = torch.mean((gamma - sub_data) ** 2)
+                elif args.loss == 'Gaussian':
+                    sub_data = sub_data.unsqueeze(1)
+                    mu, sigma = fake_data.chunk(2, dim=1)
+                    loss = loss_helper.Gaussian_NLL(sub_data, mu, sigma)
+                    mse = torch.mean((mu - sub_data) ** 2)
+                else:
+                    fake_data = fake_data[:, 0]
+                    loss = criterion(sub_data, fake_data)
+                    mse = torch.mean((fake_data - sub_data) ** 2)
+
+            with timer.phase("backward"), memory.phase("backward"):
+                scaler.scale(loss).backward()
+            with timer.phase("step"):
+                scaler.step(g_optimizer)
+                scaler.update()
+            # accumulated on the device, read once per epoch
+            train_loss += loss.detach()
+            train_mse += mse.detach()
+            timer.add_samples(e_rndidx.shape[0])
+            if args.metrics_every and (step + 1) % args.metrics_every == 0:
+                metrics_log.log(step + 1, epoch + 1, step_loss=loss.detach(), step_mse=mse.detach(), lr=learning_rate(step))
+        train_loss, train_mse = train_loss.item(), train_mse.item()
+
+        train_loss, train_mse = distributed.all_mean(train_loss), distributed.all_mean(train_mse)
+        epoch_time = time.time() - epoch_start
+        metrics_log.log((epoch + 1) * num_batches, epoch + 1, train_loss=train_loss / num_batches, train_mse=train_mse / num_batches,
+                        lr=learning_rate((epoch + 1) * num_batches - 1), samples_per_sec=num_batches * args.batch_size / epoch_time)
+        if (epoch + 1) % args.log_every == 0 and rank == 0:
             print("====> Epoch: {} Average loss: {:.6f}, Average MSE: {:.6f}".format(
                         epoch + 1, train_loss / num_batches, train_mse / num_batches))
+            if args.profile:
+                print(timer.summary())
 
         # testing...
         # g_model.eval()
+        evaluate = (epoch + 1) % args.eval_every == 0 or (epoch + 1) % args.check_every == 0 or epoch + 1 == args.epochs
+        if not evaluate:
+            train_time += time.time() - epoch_start
+            continue
         test_loss = 0.
-        with torch.no_grad():
-            fake_data = g_model(test_params)
+        with timer.phase("eval"), memory.phase("eval"), torch.no_grad():
+            fake_data = g_eval(test_params)
             if args.loss == 'Evidential':
-                test_loss = loss_helper.EvidentialRegression(test_C42a_data.unsqueeze(1), fake_data, coeff=1e-2)
-                gamma, _, _, _ = torch.chunk(fake_data, out_features, dim=1) 
+                test_loss = evidential_loss(test_C42a_data.unsqueeze(1), fake_data, coeff=args.coeff)
+                gamma, v, alpha, beta = torch.chunk(fake_data, out_features, dim=1) 
                 test_mse = torch.mean((gamma - test_C42a_data.unsqueeze(1)) ** 2)
+                test_nll = loss_helper.NIG_NLL(test_C42a_data.unsqueeze(1), gamma, v, alpha, beta).item()
+                calibration_err = None
+                if log_calibration:
+                    calibration_err, _ = utils.gen_calibration(gamma[:, 0], torch.sqrt(beta / (v * (alpha - 1 + 1e-6)))[:, 0], test_C42a_data)
             elif args.loss == 'Gaussian':
                 mu, sigma = fake_data.chunk(2, dim=1)
                 test_loss = loss_helper.Gaussian_NLL(test_C42a_data.unsqueeze(1), mu, sigma)
                 test_mse = torch.mean((mu - test_C42a_data.unsqueeze(1)) ** 2)
+                test_nll = test_loss.item()
+                calibration_err = None
+                if log_calibration:
+                    calibration_err, _ = utils.gen_calibration(mu[:, 0], sigma[:, 0], test_C42a_data)
             else:
                 fake_data = fake_data[:, 0]
                 test_loss = criterion(test_C42a_data, fake_data).item()
                 test_mse = torch.mean((fake_data - test_C42a_data) ** 2)
-
+                test_nll = test_mse.item()
+                calibration_err = None
+
+        n_test = test_params.shape[0]
+        test_loss, test_mse, test_nll = [distributed.all_mean(x, n_test) for x in (test_loss, test_mse, test_nll)]
+        if calibration_err is not None:
+            # the mean over the shards, close to the calibration error of the whole split
+            calibration_err = distributed.all_mean(calibration_err, n_test)
         test_losses.append(test_loss)
-        if (epoch + 1) % args.log_every == 0:
+        test_epochs.append(epoch + 1)
+        test_mses.append(test_mse)
+        if (epoch + 1) % args.log_every == 0 and rank == 0:
             print("====> Epoch: {} Test set loss: {:.6f}, Test set MSE {:.6f}".format(
                         epoch + 1, test_losses[-1], test_mse))
 
+        train_time += time.time() - epoch_start
+        record = dict(test_loss=test_loss, test_mse=test_mse, test_nll=test_nll, psnr=metrics.psnr(test_mse, float(dmax)),
+                      train_time=train_time, **metrics.memory_mb(device))
+        if calibration_err is not None:
+            record["calibration_err"] = calibration_err
+        metrics_log.log((epoch + 1) * num_batches, epoch + 1, **record)
+
+        improved = early_stopping.step(test_nll, epoch + 1, epoch + 1 - last_eval)
+        last_eval = epoch + 1
+        if improved and args.save_best and writer is not None:
+            with timer.phase("checkpoint"):
+                writer.save(checkpoint_state(epoch), best=True)
+        stop = early_stopping.should_stop
+        if stop and rank == 0:
+            print("=> test NLL has not improved for {} epochs, stopping at epoch {} (best {:.6f} at epoch {})".format(
+                early_stopping.bad_epochs, epoch + 1, early_stopping.best, early_stopping.best_epoch))
+
         # saving...
-        if (epoch + 1) % args.check_every == 0:
-            print("=> saving checkpoint at epoch {}".format(epoch))
-            torch.save({"epoch": epoch + 1,
-                        "g_model_state_dict": g_model.state_dict(),
-                        "g_optimizer_state_dict": g_optimizer.state_dict(),
-                        "train_losses": train_losses,
-                        "test_losses": test_losses},
-                        os.path.join("models", network_str + "_" + str(epoch + 1) + ".pth.tar"))
-
-            torch.save(g_model.state_dict(), 
-                       os.path.join("models", network_str + "_" + str(epoch + 1) + ".pth"))
+        if (epoch + 1) % args.check_every == 0 or stop:
+            with timer.phase("checkpoint"):
+                save_checkpoint(epoch)
+
+        if stop:
+            break
+
+    window.close()
+    if args.profile and rank == 0:
+        print(timer.summary())
+    if args.memory and rank == 0:
+        print(memory.summary())
+    metrics_log.close()
+    if writer is not None:
+        writer.close()
+    distributed.cleanup()
 
 if __name__ == "__main__":
     main(parse_args())
@@ -7,4 +7,10 @@ python -u train.py --seed 0 --dsp 28 --lr 5e-4 --loss Evidential --log-every 10
 # python -u train.py --seed 0 --dsp 28 --dropout --lr 5e-4 --loss MSE --log-every 20 --check-every 200
 # python -u train.py --seed 0 --dsp 28 --lr 5e-4 --loss MSE --log-every 20 --check-every 200
 # python -u train.py --seed 0 --dsp 28 --lr 5e-4 --loss Gaussian --log-every 20 --check-every 200
-# python -u new_MLP_Yeast_dropout.py 
\ No newline at end of file
+# python -u new_MLP_Yeast_dropout.py
+# python -u train.py --seed 0 --dsp 28 --lr 1e-4 --loss Evidential --log-every 10 --check-every 150 --active --lam 25 --finetune models/model_Evidential_600.pth.tar --freeze-sparams --replay-ratio 0.5 --replay-epochs 100 --patience 50
+# python -u compare_retrain.py --dsp 28 --lam 25 --finetuned models/model_Evidential_seed0_active25_ft_150.pth.tar --scratch models/model_Evidential_seed0_active25_150.pth.tar
+# python -u train.py --seed 0 --dsp 28 --lr 5e-4 --loss Evidential --log-every 10 --check-every 150 --amp bf16
+# python -u train.py --seed 0 --dsp 28 --lr 5e-4 --loss Evidential --batch-size 256 --scale-lr --warmup-epochs 5 --lr-schedule cosine --epochs 5000 --eval-every 10 --log-every 50 --check-every 500
+# python -u train.py --seed 0 --dsp 28 --lr 5e-4 --loss Evidential --log-every 10 --check-every 150 --patience 300 --save-best --keep-checkpoints 2
+# python -u launch.py --nproc-per-node 4 train.py --data-parallel --seed 0 --dsp 28 --lr 5e-4 --loss Evidential --batch-size 256 --scale-lr --warmup-epochs 5 --log-every 10 --check-every 150
@@ -5,6 +5,7 @@ from __future__ import absolute_import, division, print_function
 import os
 import argparse
 import math
+import time
 
 import numpy as np
 from tqdm import tqdm
@@ -16,6 +17,12 @@ import torch.optim as optim
 
 from yeast import *
 from NF.FlowNet_surrogate import ParamFlowNetCond
+import accel
+import checkpoint as ckpt
+import distributed
+from shared_data import SharedDataset
+import profiler
+import metrics
 
 import pdb
 
@@ -26,13 +33,16 @@ def parse_args():
     parser.add_argument("--no-cuda", action="store_true", default=False,
                         help="disables CUDA training")
     parser.add_argument("--data-parallel", action="store_true", default=False,
-                        help="enable data parallelism")
+                        help="enable multi-process data parallelism on CPU, run through launch.py or torchrun")
     parser.add_argument("--seed", type=int, default=1,
                         help="random seed (default: 1)")
 
     parser.add_argument("--resume", type=str, default="",
                         help="path to the latest checkpoint (default: none)")
 
+    parser.add_argument("--data-cache", type=str, default="",
+                        help="attach to the dataset shared by shared_data.SharedDataset at the given path (default: none)")
+
     parser.add_argument("--K", type=int, default=3,
                         help="the number of unconditional transformations")
     parser.add_argument("--K_cond", type=int, default=3,
@@ -51,6 +61,8 @@ def parse_args():
                         help="variance reduction loss (default: 0)")
     parser.add_argument("--mean_loss", type=float, default=0, 
                         help="mean loss (default: 0)")
+    parser.add_argument("--amp", type=str, default="none",
+                        help="mixed precision training: none, bf16 or fp16 (default: none)")
     parser.add_argument("--beta1", type=float, default=0.9,
                         help="beta1 of Adam (default: 0.9)")
     parser.add_argument("--beta2", type=float, default=0.999,
@@ -61,11 +73,33 @@ def parse_args():
                         help="start epoch number (default: 0)")
     parser.add_argument("--epochs", type=int, default=50000,
                         help="number of epochs to train")
+    parser.add_argument("--patience", type=int, default=0,
+                        help="stop after the given number of epochs without test NLL improvement (default: 0, disabled)")
+    parser.add_argument("--min-delta", type=float, default=1e-4,
+                        help="smallest test NLL decrease counted as an improvement (default: 1e-4)")
+    parser.add_argument("--save-best", action="store_true", default=False,
+                        help="keep a rolling checkpoint of the epoch with the best test NLL")
+    parser.add_argument("--keep-checkpoints", type=int, default=0,
+                        help="number of latest periodic checkpoints to keep (default: 0, all)")
 
     parser.add_argument("--log-every", type=int, default=40,
                         help="log training status every given number of batches")
     parser.add_argument("--check-every", type=int, default=200,
                         help="save checkpoint every given number of epochs")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="time the training phases and report them with the log")
+    parser.add_argument("--profile-steps", type=str, default="",
+                        help="capture torch.profiler over the training steps START:END (default: none)")
+    parser.add_argument("--profile-dir", type=str, default="profile",
+                        help="directory of the torch.profiler traces (default: profile)")
+    parser.add_argument("--memory", action="store_true", default=False,
+                        help="report the peak memory and the largest live tensors per phase")
+    parser.add_argument("--memory-top", type=int, default=5,
+                        help="largest live tensors reported per phase (default: 5)")
+    parser.add_argument("--metrics", type=str, default="",
+                        help="append-only metrics file of the run (default: models/NETWORK_metrics.jsonl)")
+    parser.add_argument("--metrics-every", type=int, default=0,
+                        help="also record the loss of every given number of steps as step_loss (default: 0, epoch means only)")
 
     return parser.parse_args()
 
@@ -74,15 +108,26 @@ def main(args):
     # log hyperparameters
     print(args)
 
+    # join the process group, the gloo backend trains on CPU
+    rank, world_size = distributed.init_distributed() if args.data_parallel else (0, 1)
+    if args.batch_size % world_size != 0:
+        raise ValueError("batch size {} is not divisible by {} processes".format(args.batch_size, world_size))
+
     # select device
-    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    args.cuda = not args.no_cuda and torch.cuda.is_available() and world_size == 1
     device = torch.device("cuda:0" if args.cuda else "cpu")
 
+    # opt-in, a no-op unless --memory
+    memory = profiler.MemoryTracker(args.memory, device, args.memory_top)
+
     network_str = "model_NF"
 
     # set random seed
+    # batches are drawn from a generator seeded alike on all ranks, the flows' noise from per-rank seeds
     np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
+    torch.manual_seed(args.seed + rank)
+    sample_gen = torch.Generator(device=device)
+    sample_gen.manual_seed(args.seed)
 
     # model
     def weights_init(m):
@@ -104,7 +149,8 @@ def main(args):
             return m
 
     g_model = ParamFlowNetCond(C=1, K=args.K, K_cond=args.K_cond)
-    print(g_model)
+    if rank == 0:
+        print(g_model)
     # g_model.apply(weights_init)
     # if args.sn:
     #     g_model = add_sn(g_model)
@@ -115,7 +161,13 @@ def main(args):
     g_optimizer = optim.Adam(g_model.parameters(), lr=args.lr,
         betas=(args.beta1, args.beta2))
 
+    # stop once the test NLL in bits per dimension has plateaued
+    early_stopping = ckpt.EarlyStopping(args.patience, args.min_delta)
+    # the test NLL is needed every epoch only by these, the same on every rank
+    track_nll = args.patience > 0 or args.save_best or bool(args.metrics)
+
     # load checkpoint
+    resume_rng = None
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint {}".format(args.resume))
@@ -123,21 +175,82 @@ def main(args):
             args.start_epoch = checkpoint["epoch"]
             g_model.load_state_dict(checkpoint["g_model_state_dict"])
             g_optimizer.load_state_dict(checkpoint["g_optimizer_state_dict"])
+            if checkpoint.get("early_stopping"):
+                early_stopping.load_state_dict(checkpoint["early_stopping"])
+            resume_rng = checkpoint.get("rng_state")
+            if checkpoint.get("sampler_state") is not None:
+                sample_gen.set_state(checkpoint["sampler_state"])
             print("=> loaded checkpoint {} (epoch {})"
                           .format(args.resume, checkpoint["epoch"]))
             
-    params, C42a_data, sample_weight = ReadYeastDataset()
-    params, C42a_data, sample_weight = torch.from_numpy(params).float().cuda(), torch.from_numpy(C42a_data).float().cuda(), torch.from_numpy(sample_weight).float().cuda()
-    train_split = torch.from_numpy(np.load('train_split.npy'))
-    train_params, train_C42a_data, train_sample_weight = params[train_split], C42a_data[train_split], sample_weight[train_split]
-    test_params, test_C42a_data = params[~train_split], C42a_data[~train_split]
-    len_train = train_params.shape[0]
+    with memory.phase("data_load"):
+        if args.data_cache:
+            # zero-copy on CPU, the training batches are gathered from the shared rows
+            shared_data = SharedDataset.attach(args.data_cache)
+            params, C42a_data, sample_weight, _, dmax, train_split = shared_data.tensors()
+        else:
+            params, C42a_data, sample_weight, _, dmax = ReadYeastDataset(active=False)
+            params, C42a_data, sample_weight = torch.from_numpy(params).float(), torch.from_numpy(C42a_data).float(), torch.from_numpy(sample_weight).float()
+            train_split = torch.from_numpy(np.load('train_split.npy'))
+        params, C42a_data, sample_weight = params.to(device), C42a_data.to(device), sample_weight.to(device)
+        train_rows = torch.nonzero(train_split).flatten().to(device)
+        train_sample_weight = sample_weight[train_rows]
+        test_params, test_C42a_data = params[~train_split], C42a_data[~train_split]
+    len_train = train_rows.shape[0]
     num_batches = (len_train - 1) // args.batch_size + 1
 
     MAE = nn.L1Loss()
 
+    # the flows keep their log-determinants, slogdet and inverses in fp32 under autocast
+    if args.amp != "none":
+        print("=> {} mixed precision training".format(args.amp))
+    amp_dtype = accel.AMP_DTYPES.get(args.amp, torch.float32)
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp == "fp16")
+    if args.resume and os.path.isfile(args.resume) and checkpoint.get("scaler_state_dict"):
+        scaler.load_state_dict(checkpoint["scaler_state_dict"])
+
+    # indexed by ckpt.CheckpointRegistry
+    meta = {"run": network_str, "model": "NF", "loss": "NF", "seed": args.seed, "dropout": False,
+            "active": False, "lam": None, "finetune": False, "K": args.K, "K_cond": args.K_cond}
+
+    def checkpoint_state(epoch):
+        return {"epoch": epoch + 1,
+                "g_model_state_dict": g_model.state_dict(),
+                "g_optimizer_state_dict": g_optimizer.state_dict(),
+                "scaler_state_dict": scaler.state_dict(),
+                "early_stopping": early_stopping.state_dict(),
+                "rng_state": ckpt.rng_state(),
+                "sampler_state": sample_gen.get_state(),
+                "meta": meta}
+
+    # ActNorm initializes from the first batch it sees, the wrapper then broadcasts rank 0's
+    g_forward = g_model
+    if world_size > 1:
+        with torch.no_grad():
+            g_model(C42a_data[train_rows[:args.batch_size]].unsqueeze(1), params[train_rows[:args.batch_size]])
+        # the parameter head is unused without --param_l1_loss
+        g_forward = distributed.wrap_model(g_model, find_unused_parameters=True)
+
+    # the test split is sharded across ranks and its metrics reduced
+    test_params, test_C42a_data = distributed.shard(test_params, rank, world_size), distributed.shard(test_C42a_data, rank, world_size)
+
+    # checkpoints are written on a background thread of rank 0
+    writer = ckpt.CheckpointWriter("models", network_str, keep=args.keep_checkpoints) if rank == 0 else None
+    if resume_rng is not None:
+        # the saved RNG state is rank 0's, the other ranks keep distinct noise streams
+        ckpt.set_rng_state(resume_rng)
+        if rank > 0:
+            torch.manual_seed(args.seed + rank + args.start_epoch * world_size)
+
+    # opt-in instrumentation, no-ops when disabled
+    timer = profiler.PhaseTimer(args.profile, device)
+    window = profiler.ProfileWindow(profiler.parse_steps(args.profile_steps), args.profile_dir, network_str)
+    # structured records of the run, written by rank 0
+    metrics_log = metrics.MetricsWriter((args.metrics or os.path.join("models", network_str + "_metrics.jsonl")) if rank == 0 else "")
+
     # main loop
     for epoch in range(args.start_epoch, args.epochs):
+        epoch_start = time.time()
         # training...
         g_model.train()
 
@@ -146,60 +259,111 @@ def main(args):
         epoch_var_loss = 0
         epoch_mean_loss = 0
 
-        for _ in range(num_batches): 
-            e_rndidx = torch.multinomial(train_sample_weight.flatten(), args.batch_size, replacement=True)
-            sub_params = train_params[e_rndidx]
-            sub_data = train_C42a_data[e_rndidx]
+        for i in range(num_batches): 
+            window.step()
+            step = epoch * num_batches + i
+            with timer.phase("sample"):
+                e_rndidx = torch.multinomial(train_sample_weight.flatten(), args.batch_size, replacement=True, generator=sample_gen)
+                e_rndidx = distributed.shard(e_rndidx, rank, world_size)
+            with timer.phase("gather"):
+                sub_params = params[train_rows[e_rndidx]]
+                sub_data = C42a_data[train_rows[e_rndidx]]
 
             g_optimizer.zero_grad()
-            dummy_z, param_z, logdet, var_loss, mean_loss = g_model(sub_data.unsqueeze(1), sub_params)
-            loss_x = (-logdet / (math.log(2) * sub_data.shape[1])).mean()
-            loss = args.logx_loss * loss_x
-            epoch_logpx_loss += args.logx_loss * loss_x.item()
-
-            if args.mean_loss > 0:
-                mean_loss = args.mean_loss * mean_loss
-                loss += args.mean_loss * mean_loss 
-                epoch_mean_loss += args.mean_loss * mean_loss.item()
-            
-            if args.var_loss > 0:
-                var_loss = args.var_loss * var_loss
-                loss += args.var_loss * var_loss 
-                epoch_var_loss += args.var_loss * var_loss.item()
-            
-            if args.param_l1_loss > 0:
-                param_l1_loss = MAE(param_z, sub_params)
-                loss += args.param_l1_loss * param_l1_loss 
-                epoch_param_l1_loss += args.param_l1_loss * param_l1_loss.item()
+            with timer.phase("forward"), memory.phase("forward"), torch.autocast(device.type, dtype=amp_dtype, enabled=args.amp != "none"):
+                dummy_z, param_z, logdet, var_loss, mean_loss = g_forward(sub_data.unsqueeze(1), sub_params)
+            with timer.phase("loss"):
+                param_z, var_loss, mean_loss = param_z.float(), var_loss.float(), mean_loss.float()
+                loss_x = (-logdet / (math.log(2) * sub_data.shape[1])).mean()
+                loss = args.logx_loss * loss_x
+                epoch_logpx_loss += args.logx_loss * loss_x.item()
+
+                if args.mean_loss > 0:
+                    mean_loss = args.mean_loss * mean_loss
+                    loss += args.mean_loss * mean_loss 
+                    epoch_mean_loss += args.mean_loss * mean_loss.item()
+                
+                if args.var_loss > 0:
+                    var_loss = args.var_loss * var_loss
+                    loss += args.var_loss * var_loss 
+                    epoch_var_loss += args.var_loss * var_loss.item()
+                
+                if args.param_l1_loss > 0:
+                    param_l1_loss = MAE(param_z, sub_params)
+                    loss += args.param_l1_loss * param_l1_loss 
+                    epoch_param_l1_loss += args.param_l1_loss * param_l1_loss.item()
                
-            loss.backward()
-            g_optimizer.step()
-
-        if (epoch + 1) % args.log_every == 0:
+            with timer.phase("backward"), memory.phase("backward"):
+                scaler.scale(loss).backward()
+            with timer.phase("step"):
+                scaler.step(g_optimizer)
+                scaler.update()
+            timer.add_samples(e_rndidx.shape[0])
+            if args.metrics_every and (step + 1) % args.metrics_every == 0:
+                metrics_log.log(step + 1, epoch + 1, step_loss=loss.detach(), step_logpx_loss=loss_x.detach())
+
+        epoch_logpx_loss, epoch_mean_loss, epoch_param_l1_loss = [distributed.all_mean(x) for x in (epoch_logpx_loss, epoch_mean_loss, epoch_param_l1_loss)]
+        metrics_log.log((epoch + 1) * num_batches, epoch + 1, train_logpx_loss=epoch_logpx_loss / num_batches,
+                        train_mean_loss=epoch_mean_loss / num_batches, train_param_l1_loss=epoch_param_l1_loss / num_batches,
+                        samples_per_sec=num_batches * args.batch_size / (time.time() - epoch_start))
+        if (epoch + 1) % args.log_every == 0 and rank == 0:
             print("====> Epoch: {} Average logp_x_loss: {:.6f}, Average mean_loss: {:.6f}, Average var_loss: {:.6f}， Average param_l1_loss: {:.6f}".format(
                         epoch + 1, epoch_logpx_loss / num_batches, epoch_mean_loss / num_batches, var_loss / num_batches, epoch_param_l1_loss / num_batches))
+            if args.profile:
+                print(timer.summary())
 
         # testing...
         g_model.eval()
-        with torch.no_grad():
+        # the NLL takes a second pass over the test split, only run on log epochs and when
+        # early stopping, the best checkpoint or an explicit --metrics file use it
+        compute_nll = track_nll or (epoch + 1) % args.log_every == 0
+        test_nll = None
+        with timer.phase("eval"), memory.phase("eval"), torch.no_grad():
             fake_data, _, _ = g_model.sample(dummy_z=None, d_param=test_params, eps_std=0.8)
             fake_data = fake_data[:, 0]
             test_mse = torch.mean((fake_data - test_C42a_data) ** 2)
-
-        if (epoch + 1) % args.log_every == 0:
-            print("====> Epoch: {} Test set MSE {:.6f}".format(
-                        epoch + 1, test_mse))
+            if compute_nll:
+                _, _, logdet, _, _ = g_model(test_C42a_data.unsqueeze(1), test_params)
+                test_nll = (-logdet / (math.log(2) * test_C42a_data.shape[1])).mean().item()
+        n_test = test_params.shape[0]
+        test_mse = distributed.all_mean(test_mse, n_test)
+        record = dict(test_mse=test_mse, psnr=metrics.psnr(test_mse, float(dmax)),
+                      epoch_time=time.time() - epoch_start, **metrics.memory_mb(device))
+        if compute_nll:
+            test_nll = distributed.all_mean(test_nll, n_test)
+            record["test_nll"] = test_nll
+        metrics_log.log((epoch + 1) * num_batches, epoch + 1, **record)
+
+        if (epoch + 1) % args.log_every == 0 and rank == 0:
+            print("====> Epoch: {} Test set MSE {:.6f}, Test set NLL {:.6f}".format(
+                        epoch + 1, test_mse, test_nll))
+
+        if track_nll and early_stopping.step(test_nll, epoch + 1) and args.save_best and writer is not None:
+            with timer.phase("checkpoint"):
+                writer.save(checkpoint_state(epoch), best=True)
+        stop = early_stopping.should_stop
+        if stop and rank == 0:
+            print("=> test NLL has not improved for {} epochs, stopping at epoch {} (best {:.6f} at epoch {})".format(
+                early_stopping.bad_epochs, epoch + 1, early_stopping.best, early_stopping.best_epoch))
 
         # saving...
-        if (epoch + 1) % args.check_every == 0:
+        if ((epoch + 1) % args.check_every == 0 or stop) and writer is not None:
             print("=> saving checkpoint at epoch {}".format(epoch))
-            torch.save({"epoch": epoch + 1,
-                        "g_model_state_dict": g_model.state_dict(),
-                        "g_optimizer_state_dict": g_optimizer.state_dict()},
-                        os.path.join("models", network_str + "_" + str(epoch + 1) + ".pth.tar"))
-
-            torch.save(g_model.state_dict(), 
-                       os.path.join("models", network_str + "_" + str(epoch + 1) + ".pth"))
+            with timer.phase("checkpoint"):
+                writer.save(checkpoint_state(epoch), epoch=epoch + 1)
+
+        if stop:
+            break
+
+    window.close()
+    if args.profile and rank == 0:
+        print(timer.summary())
+    if args.memory and rank == 0:
+        print(memory.summary())
+    metrics_log.close()
+    if writer is not None:
+        writer.close()
+    distributed.cleanup()
 
 if __name__ == "__main__":
     main(parse_args())
@@ -3,4 +3,7 @@
 #PBS -l walltime=2:00:00
 #PBS -l nodes=1:ppn=1:gpus=1
 
-python -u train_NF.py --lr 1e-4 --param_l1_loss 1 --var_loss 10 --mean_loss 1 --log-every 5 --check-every 60
\ No newline at end of file
+python -u train_NF.py --lr 1e-4 --param_l1_loss 1 --var_loss 10 --mean_loss 1 --log-every 5 --check-every 60
+# python -u train_NF.py --lr 1e-4 --param_l1_loss 1 --var_loss 10 --mean_loss 1 --log-every 5 --check-every 60 --amp bf16
+# python -u train_NF.py --lr 1e-4 --param_l1_loss 1 --var_loss 10 --mean_loss 1 --log-every 5 --check-every 60 --patience 120 --save-best --keep-checkpoints 2
+# python -u launch.py --nproc-per-node 4 train_NF.py --data-parallel --lr 1e-4 --param_l1_loss 1 --var_loss 10 --mean_loss 1 --batch-size 128 --log-every 5 --check-every 60
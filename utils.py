@@ -21,7 +21,8 @@ def norm_ppf(p, mean=0.0, std=1.0):
     normal_dist = Normal(mean, std)
     return normal_dist.icdf(torch.tensor(p))
 
-def gen_cutoff_uncertainty(all_mse, var, method):
+def cutoff_uncertainty_psnrs(all_mse, var):
+    # PSNR of the predictions left after dropping the most uncertain 0%..99%
     percentiles = np.linspace(0, 1, 100, endpoint=False)
     cutoff_inds = (percentiles * var.numel()).astype(int)
     _, sorted_varidx = torch.sort(var.flatten(), descending=True)
@@ -30,9 +31,10 @@ def gen_cutoff_uncertainty(all_mse, var, method):
     for cutoff in cutoff_inds:
         cutoff_mse = all_mse.flatten()[sorted_varidx[cutoff:]].mean().item()
         cutoff_psnrs.append(20. * np.log10(2.) - 10. * np.log10(cutoff_mse))
-    np.save(os.path.join("figs", method + "_cutoff_uncertainty_psnrs"), np.array(cutoff_psnrs))
+    return np.array(cutoff_psnrs)
 
-def gen_ret_value(all_mse, data, active_method):
+def ret_value_psnrs(all_mse, data):
+    # PSNR of the 2%..100% predictions of the largest data values
     percentiles = np.linspace(0, 1, 51, endpoint=True)
     ret_inds = (percentiles * data.numel()).astype(int)
     _, sorted_dataidx = torch.sort(data.flatten(), descending=True)
@@ -41,9 +43,10 @@ def gen_ret_value(all_mse, data, active_method):
     for ret in ret_inds[1:]:
         ret_mse = all_mse.flatten()[sorted_dataidx[:ret]].mean().item()
         ret_psnrs.append(20. * np.log10(2.) - 10. * np.log10(ret_mse))
-    np.save(os.path.join("figs", active_method + "_ret_value_psnrs"), np.array(ret_psnrs))
+    return np.array(ret_psnrs)
 
-def gen_ret_uncertainty(all_mse, uncertainty, active_method):
+def ret_uncertainty_psnrs(all_mse, uncertainty):
+    # PSNR of the 1/30..100% most uncertain predictions
     percentiles = np.linspace(0, 1, 31, endpoint=True)
     ret_inds = (percentiles * uncertainty.numel()).astype(int)
     _, sorted_dataidx = torch.sort(uncertainty.flatten(), descending=True)
@@ -52,7 +55,16 @@ def gen_ret_uncertainty(all_mse, uncertainty, active_method):
     for ret in ret_inds[1:]:
         ret_mse = all_mse.flatten()[sorted_dataidx[:ret]].mean().item()
         ret_psnrs.append(20. * np.log10(2.) - 10. * np.log10(ret_mse))
-    np.save(os.path.join("figs", active_method + "_ret_uncertainty_psnrs"), np.array(ret_psnrs))
+    return np.array(ret_psnrs)
+
+def gen_cutoff_uncertainty(all_mse, var, method):
+    np.save(os.path.join("figs", method + "_cutoff_uncertainty_psnrs"), cutoff_uncertainty_psnrs(all_mse, var))
+
+def gen_ret_value(all_mse, data, active_method):
+    np.save(os.path.join("figs", active_method + "_ret_value_psnrs"), ret_value_psnrs(all_mse, data))
+
+def gen_ret_uncertainty(all_mse, uncertainty, active_method):
+    np.save(os.path.join("figs", active_method + "_ret_uncertainty_psnrs"), ret_uncertainty_psnrs(all_mse, uncertainty))
 
 def gen_calibration(mu, var, gt):
     expected_p = np.linspace(0, 1, 40, endpoint=True)
@@ -67,6 +79,30 @@ def gen_calibration(mu, var, gt):
     calibration_err = np.abs(expected_p - observed_p).mean()
     return calibration_err, observed_p
 
+def evidential_metrics(fake_data, gt, dmax):
+    """
+    Test metrics of an evidential prediction, as reported by eval.py.
+
+    Args:
+    fake_data (Tensor): Generator output of shape (B, 4, L).
+    gt (Tensor): scaled ground truth of shape (B, L).
+    dmax (float): maximum of the unscaled data.
+
+    Returns:
+    dict: PSNR, median NLL and calibration error.
+    """
+    import loss_helper
+
+    gamma, v, alpha, beta = torch.chunk(fake_data, 4, dim=1)
+    nll = loss_helper.NIG_NLL(gt.unsqueeze(1), gamma, v, alpha, beta, reduce=False)
+    mu = gamma[:, 0]
+    mse = (((gt - mu) ** 2) / (696.052 / dmax) ** 2).mean().item()
+    var = torch.sqrt(beta / (v * (alpha - 1 + 1e-6)))[:, 0]
+    calibration_err, _ = gen_calibration(mu, var, gt)
+    return {"psnr": 20. * np.log10(2.) - 10. * np.log10(mse),
+            "nll": nll.median().item(),
+            "calibration_err": calibration_err}
+
 def render_one_circle(approach, uncertainty_type, input_id, example_test, example_mu, example_var, active_method=""):
     # Create angles for the points on the circle
     angles = np.linspace(0, 2 * np.pi, 400, endpoint=False)
@@ -3,6 +3,7 @@
 from __future__ import absolute_import, division, print_function
 
 import os
+import hashlib
 
 import numpy as np
 
@@ -17,7 +18,55 @@ def read_data_from_file(filename):
     return np.array(data)
 
 
-def ReadYeastDataset(active, lam):
+ACTIVE_ROOT = '/fs/ess/PAS0027/yeast_polarization_Neng'
+DATA_ROOT = '/fs/ess/PAS0027/yeast_polarization_data/yeast_polarization/all_rerun_data'
+
+def active_set_indices(run_dir):
+    # indices of the set* folders of an active learning run, in order
+    if not os.path.isdir(run_dir):
+        return []
+    return sorted(int(d[3:]) for d in os.listdir(run_dir) if d.startswith('set') and d[3:].isdigit())
+
+def active_data_range(lam, active_root=ACTIVE_ROOT):
+    # minimum and maximum of the rows added by an active learning run, None if it has none
+    run_dir = os.path.join(active_root, 'run_lambda' + str(int(lam)))
+    ranges = []
+    for i in active_set_indices(run_dir):
+        path = os.path.join(run_dir, f'set{i}', 'C42a_dat')
+        if os.path.exists(path):
+            data = read_data_from_file(path)
+            ranges.append((data.min(), data.max()))
+    if not ranges:
+        return None
+    return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+def dataset_files(active, lam=None, active_root=ACTIVE_ROOT, data_root=DATA_ROOT):
+    # the files ReadYeastDataset reads, in order
+    files = []
+    for folder, n_sets, pf_name in (('rerun', 40, 'PF_C42a_set_of_50'), ('rerun_imp_sample', 10, 'PF_C42a_set_of_100')):
+        for i in range(1, n_sets + 1):
+            set_dir = os.path.join(data_root, folder, f'set{i}')
+            files += [os.path.join(set_dir, name) for name in ('list_of_parameters', 'C42a_dat', pf_name)]
+    if active:
+        run_dir = os.path.join(active_root, 'run_lambda' + str(int(lam)))
+        for i in active_set_indices(run_dir):
+            set_dir = os.path.join(run_dir, f'set{i}')
+            if os.path.exists(os.path.join(set_dir, 'C42a_dat')):
+                files += [os.path.join(set_dir, name) for name in ('list_of_parameters', 'C42a_dat', 'PF_C42a_set_of_100')]
+    return files
+
+def dataset_version(active, lam=None, active_root=ACTIVE_ROOT, data_root=DATA_ROOT):
+    """
+    Fingerprint of the dataset ReadYeastDataset would read, from the names,
+    sizes and modification times of its files, without reading them.
+    """
+    version = hashlib.sha256()
+    for path in dataset_files(active, lam, active_root, data_root):
+        stat = os.stat(path) if os.path.exists(path) else None
+        version.update("{} {} {}\n".format(path, stat.st_size if stat else -1, stat.st_mtime_ns if stat else -1).encode())
+    return version.hexdigest()[:16]
+
+def ReadYeastDataset(active, lam=None, active_root=ACTIVE_ROOT, data_root=DATA_ROOT):
     params = []
     C42a_dat = []
     PF_C42a = []
@@ -25,7 +74,7 @@ def ReadYeastDataset(active, lam):
     set_range = range(1, 41)
     # Load the data from files
     for i in set_range:
-        set_dir = os.path.join('/fs/ess/PAS0027/yeast_polarization_data/yeast_polarization/all_rerun_data/rerun', f'set{i}')
+        set_dir = os.path.join(data_root, 'rerun', f'set{i}')
         params.append(read_data_from_file(os.path.join(set_dir, 'list_of_parameters')))
         C42a_dat.append(read_data_from_file(os.path.join(set_dir, 'C42a_dat')))
         PF_C42a.append(read_data_from_file(os.path.join(set_dir, 'PF_C42a_set_of_50')))
@@ -33,16 +82,17 @@ def ReadYeastDataset(active, lam):
     set_range = range(1, 11)
     # Load the data from files
     for i in set_range:
-        set_dir = os.path.join('/fs/ess/PAS0027/yeast_polarization_data/yeast_polarization/all_rerun_data/rerun_imp_sample', f'set{i}')
+        set_dir = os.path.join(data_root, 'rerun_imp_sample', f'set{i}')
         params.append(read_data_from_file(os.path.join(set_dir, 'list_of_parameters')))
         C42a_dat.append(read_data_from_file(os.path.join(set_dir, 'C42a_dat')))
         PF_C42a.append(read_data_from_file(os.path.join(set_dir, 'PF_C42a_set_of_100')))
 
     if active:
-        set_range = range(1, 25)
+        run_dir = os.path.join(active_root, 'run_lambda' + str(int(lam)))
+        set_range = active_set_indices(run_dir)
         # Load the data from files
         for i in set_range:
-            set_dir = os.path.join('/fs/ess/PAS0027/yeast_polarization_Neng/run_lambda' + str(int(lam)), f'set{i}')
+            set_dir = os.path.join(run_dir, f'set{i}')
             if os.path.exists(os.path.join(set_dir, 'C42a_dat')):
                 params.append(read_data_from_file(os.path.join(set_dir, 'list_of_parameters')))
                 C42a_dat.append(read_data_from_file(os.path.join(set_dir, 'C42a_dat')))